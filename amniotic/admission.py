@@ -0,0 +1,148 @@
+import asyncio
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Iterable
+
+from amniotic.memory import MemoryManager
+from amniotic.obs import logger
+
+RETRY_AFTER = 10
+CPU_INTERVAL = 5.0
+
+
+@dataclass
+class Rejection:
+    """
+
+    Why a stream was refused, and how long the client should wait before retrying.
+
+    """
+    reason: str
+    retry_after: int = RETRY_AFTER
+
+
+class Admission:
+    """
+
+    Admission control for the stream endpoint. Every admitted stream runs a full decode/mix/encode pipeline, so
+    connections are refused up-front (before any pipeline is built) when any of the following apply:
+
+    - The global or per-theme concurrent stream limit has been reached.
+    - The client has reconnected more than `reconnect_limit` times within `reconnect_window` seconds.
+    - System CPU usage is above `cpu_limit` percent.
+    - The process is over its memory budget, even after evicting caches (see `MemoryManager`).
+
+    Any limit set to `None` is disabled.
+
+    Only streams that actually sent something are recorded as connects (see `record`), so refused attempts and
+    probes don't count, and a client retrying too early doesn't extend its own lockout. CPU usage is sampled every
+    `cpu_interval` seconds by a background task, and admission reads the latest sample.
+
+    """
+
+    def __init__(self, stream_limit: int | None = None, stream_limit_theme: int | None = None, reconnect_limit: int | None = 10, reconnect_window: int = 60, cpu_limit: float | None = 90.0,
+                 memory: MemoryManager | None = None, retry_after: int = RETRY_AFTER, cpu_interval: float = CPU_INTERVAL):
+        self.stream_limit = stream_limit
+        self.stream_limit_theme = stream_limit_theme
+        self.reconnect_limit = reconnect_limit
+        self.reconnect_window = reconnect_window
+        self.cpu_limit = cpu_limit
+        self.memory = memory
+        self.retry_after = retry_after
+        self.cpu_interval = cpu_interval
+        self.cpu_usage: float | None = None
+        self.is_cpu_sampled = False
+        self.connects: dict[str, deque[float]] = {}
+
+    def check(self, streams: Iterable, theme_def, host: str | None) -> Rejection | None:
+        """
+
+        Return a Rejection if a new stream of `theme_def` for client `host` should be refused, otherwise None.
+
+        """
+        rejection = self.check_rate(host) or self.check_limits(streams, theme_def) or self.check_cpu() or self.check_memory()
+        if rejection:
+            logger.warning(f'Refusing stream of Theme "{theme_def.name}" for client {host}: {rejection.reason} Retry after {rejection.retry_after}s.')
+        return rejection
+
+    def check_limits(self, streams: Iterable, theme_def) -> Rejection | None:
+        streams = list(streams)
+
+        if self.stream_limit is not None and len(streams) >= self.stream_limit:
+            return Rejection(f'Global stream limit ({self.stream_limit}) reached.', self.retry_after)
+
+        if self.stream_limit_theme is not None:
+            count = sum(1 for stream in streams if stream.theme_def is theme_def)
+            if count >= self.stream_limit_theme:
+                return Rejection(f'Per-theme stream limit ({self.stream_limit_theme}) reached.', self.retry_after)
+
+        return None
+
+    def prune(self, now: float):
+        for host in list(self.connects):
+            connects = self.connects[host]
+            while connects and now - connects[0] > self.reconnect_window:
+                connects.popleft()
+            if not connects:
+                del self.connects[host]
+
+    def record(self, host: str | None):
+        """
+
+        Count a stream for client `host` towards its reconnect rate.
+
+        """
+        if self.reconnect_limit is None or host is None:
+            return
+        now = time.monotonic()
+        self.prune(now)
+        self.connects.setdefault(host, deque()).append(now)
+
+    def check_rate(self, host: str | None) -> Rejection | None:
+        if self.reconnect_limit is None or host is None:
+            return None
+
+        now = time.monotonic()
+        self.prune(now)
+        connects = self.connects.get(host, ())
+        if len(connects) < self.reconnect_limit:
+            return None
+
+        retry_after = max(int(self.reconnect_window - (now - connects[0])) + 1, 1)
+        return Rejection(f'Client reconnected {len(connects)} times in {self.reconnect_window}s.', retry_after)
+
+    def check_cpu(self) -> Rejection | None:
+        usage = self.cpu_usage
+        if self.cpu_limit is None or usage is None or usage < self.cpu_limit:
+            return None
+
+        return Rejection(f'CPU usage {usage:.0f}% is above the admission limit of {self.cpu_limit:.0f}%.', self.retry_after)
+
+    def sample_cpu(self):
+        """
+
+        CPU usage since the last sample. The first only sets the baseline, so it's not kept.
+
+        """
+        import psutil
+        usage = psutil.cpu_percent(interval=None)
+        if self.is_cpu_sampled:
+            self.cpu_usage = usage
+        self.is_cpu_sampled = True
+
+    async def run(self):
+        if self.cpu_limit is None:
+            return
+        while True:
+            try:
+                self.sample_cpu()
+            except Exception:
+                logger.exception('Error in CPU sampling task.')
+            await asyncio.sleep(self.cpu_interval)
+
+    def check_memory(self) -> Rejection | None:
+        if self.memory is None or not self.memory.is_exhausted:
+            return None
+
+        return Rejection(f'Memory usage {self.memory.rss / 1024 ** 2:.0f}MB is over the budget of {self.memory.budget}MB.', self.retry_after)
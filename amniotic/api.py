@@ -1,11 +1,56 @@
-from fastapi.responses import StreamingResponse
+from functools import partial
+
+import anyio
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from starlette.background import BackgroundTask
 from starlette.requests import Request
 
 from amniotic.obs import logger
 from amniotic.paths import paths
+from amniotic.quarantine import quarantine
 from amniotic.theme import ThemeDefinition, ThemeStream
 from corio import api, mqtt
+from corio.strings import sanitize
+
+RETRY_AFTER_STARTUP = 2
+STREAM_MEDIA_TYPE = 'audio/mpeg'
+STREAM_HEADERS = {'Cache-Control': 'no-cache, no-store', 'Accept-Ranges': 'none'}
+STOP_POLL = 1.0
+
+
+class StreamResponse(StreamingResponse):
+    """
+
+    Streaming response that can also be ended from the event loop. A stream told to `stop` normally ends itself at its
+    next block. A player that paused without disconnecting has stopped reading, though, so there is no next block: the
+    response just sits blocked sending to it. If the stream still hasn't ended `grace` seconds after being stopped, the
+    response is cancelled, which closes the connection, and its background task (releasing the stream) is run.
+
+    """
+
+    def __init__(self, stream: ThemeStream, grace: float, **kwargs):
+        super().__init__(stream, **kwargs)
+        self.stream = stream
+        self.grace = grace
+
+    async def watch(self, cancel_scope: anyio.CancelScope):
+        while not self.stream.stop_reason:
+            await anyio.sleep(STOP_POLL)
+        await anyio.sleep(self.grace)
+        logger.warning(f'{repr(self.stream)}: Still not ended {self.grace}s after being stopped. Closing connection.')
+        cancel_scope.cancel()
+
+    async def __call__(self, scope, receive, send):
+        is_finished = False
+        async with anyio.create_task_group() as task_group:
+            task_group.start_soon(self.watch, task_group.cancel_scope)
+            await super().__call__(scope, receive, send)
+            is_finished = True
+            task_group.cancel_scope.cancel()
+
+        if not is_finished and self.background is not None:
+            with anyio.CancelScope(shield=True):
+                await self.background()
 
 class ApiAmniotic(api.Base):
     TITLE = f'Amniotic {paths.metadata.version} Streaming API'
@@ -19,28 +64,113 @@ class ApiAmniotic(api.Base):
 
     @property
     def ENDPOINTS(self):
-        return [Stream]
+        return [Stream, ChannelStream, DebugStreams, DebugUndecodable]
+
 
+class StreamAPI(api.endpoint.API):
+    """
 
-class Stream(api.endpoint.API):
+    Base for endpoints that stream audio. These also answer HEAD, which many players send to probe a URL before
+    streaming it.
+
+    """
+
+    @property
+    def method(self):
+        return partial(self.api.app.api_route, methods=['GET', 'HEAD'])
+
+
+class Stream(StreamAPI):
     """Stream a theme's audio."""
 
     PATH = '/stream/{id}'
 
     async def run(self, id: str, request: Request):
         logger.info(f'Got streaming audio request {id=} {request.client=}')
-        theme_def: ThemeDefinition = self.api.client.device.themes.id[id]
-        stream = ThemeStream(theme_def=theme_def, request=request)
-
-        if not stream.is_enabled:
-            logger.warning(f'Theme "{theme_def.name}" is streaming, but it has no recordings enabled. The stream will be silent. Enable some recordings to hear output.')
-
-        response = StreamingResponse(
-            stream,
-            media_type="audio/mpeg",
-            background=BackgroundTask(stream.close),
-        )
-        return response
+        device = self.api.client.device
+        if not device.is_loaded:
+            return PlainTextResponse('Starting up.', status_code=503, headers={'Retry-After': str(RETRY_AFTER_STARTUP)})
+
+        theme_def: ThemeDefinition = device.themes.id[id]
+        return await start_stream(device, theme_def, request)
+
+
+class ChannelStream(StreamAPI):
+    """Stream a media player's channel: whichever theme was last streamed to it, switched in place, with a crossfade, when another one is."""
+
+    PATH = '/channel/{id}'
+
+    async def run(self, id: str, request: Request):
+        logger.info(f'Got channel streaming request {id=} {request.client=}')
+        device = self.api.client.device
+        if not device.is_loaded:
+            return PlainTextResponse('Starting up.', status_code=503, headers={'Retry-After': str(RETRY_AFTER_STARTUP)})
+
+        channel = device.channels.id.get(id)
+        if not channel or not channel.theme_def:
+            # Not streamed to since startup, or its theme has since been deleted, but the player is still connected to
+            # it, so carry on with the current theme.
+            player = {sanitize(state.entity_id): state for state in device.media_player_states}.get(id)
+            if not player or not device.themes.current:
+                return PlainTextResponse(f'No channel "{id}".', status_code=404)
+            channel = device.get_channel(player.entity_id)
+            channel.theme_def = device.themes.current
+
+        return await start_stream(device, channel.theme_def, request, channel=channel)
+
+
+async def start_stream(device, theme_def: ThemeDefinition, request: Request, channel=None):
+    """
+
+    Admit and start a stream of `theme_def`, optionally on a channel, so it can later be switched to another theme.
+
+    A HEAD probe just gets the headers a stream would, without admission, or anything else, being involved. Nothing
+    expensive happens for a GET either, until the response body starts being read (see `ThemeStream.__iter__`).
+
+    """
+    if request.method == 'HEAD':
+        return StreamingResponse(iter(()), media_type=STREAM_MEDIA_TYPE, headers=STREAM_HEADERS)
+
+    host = request.client[0] if request.client else None
+    rejection = device.admission.check(streams=device.streams, theme_def=theme_def, host=host)
+    if rejection:
+        return PlainTextResponse(rejection.reason, status_code=503, headers={'Retry-After': str(rejection.retry_after)})
+
+    stream = ThemeStream(theme_def=theme_def, request=request, block_duration=device.block_duration, is_float=device.float_bus, quality=device.quality, crossfade=device.crossfade, sessions=device.sessions)
+    await device.add_stream(stream)
+    if channel:
+        channel.add(stream)
+
+    if not stream.is_enabled:
+        logger.warning(f'Theme "{theme_def.name}" is streaming, but it has no recordings enabled. The stream will be silent. Enable some recordings to hear output.')
+
+    response = StreamResponse(
+        stream,
+        grace=device.reaper.grace,
+        media_type=STREAM_MEDIA_TYPE,
+        headers=STREAM_HEADERS,
+        background=BackgroundTask(device.release_stream, stream),
+    )
+    return response
+
+
+class DebugStreams(api.endpoint.API):
+    """List live streams, with their clients, progress, real-time lag and open recordings."""
+
+    PATH = '/debug/streams'
+
+    async def run(self):
+        device = self.api.client.device
+        return [stream.get_status() for stream in list(device.streams)]
+
+
+class DebugUndecodable(api.endpoint.API):
+    """List recordings that failed to decode, with their errors and how long until they're next tried."""
+
+    PATH = '/debug/undecodable'
+
+    async def run(self):
+        return quarantine.get_status()
 
 
 
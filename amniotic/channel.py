@@ -0,0 +1,114 @@
+from __future__ import annotations
+
+import math
+import typing
+import weakref
+from functools import cached_property
+
+from amniotic.obs import logger
+from corio.strings import sanitize
+
+if typing.TYPE_CHECKING:
+    from amniotic.theme import ThemeDefinition, ThemeStream
+
+CROSSFADE = 1_000
+
+
+class Crossfade:
+    """
+
+    Equal-power crossfade from one mix to another, over `size` samples, a block at a time. The two mixes are unrelated
+    recordings, so their levels add in power rather than amplitude: fading with sine/cosine gains keeps the overall
+    loudness steady throughout, where a linear fade would dip in the middle.
+
+    Like the `Limiter`, it works in place, in reused float32 buffers, so nothing is allocated per block.
+
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.position = 0
+        self.ramp = None
+        self.gains = None
+        self.scratch = None
+
+    @property
+    def is_done(self) -> bool:
+        return self.position >= self.size
+
+    def process(self, mix, mix_old):
+        """
+
+        Fade `mix_old` out and `mix` in, writing the result to `mix`.
+
+        """
+        import numpy as np
+
+        if self.ramp is None or self.ramp.size != mix.size:
+            self.ramp = np.arange(mix.size, dtype=np.float32)
+            self.gains = np.empty_like(self.ramp)
+            self.scratch = np.empty_like(self.ramp)
+
+        np.add(self.ramp, np.float32(self.position), out=self.gains)
+        np.multiply(self.gains, np.float32(math.pi / 2 / max(self.size, 1)), out=self.gains)
+        np.minimum(self.gains, np.float32(math.pi / 2), out=self.gains)
+        np.cos(self.gains, out=self.scratch)
+        np.sin(self.gains, out=self.gains)
+
+        np.multiply(self.scratch, mix_old, out=self.scratch)
+        np.multiply(self.gains, mix, out=self.gains)
+        np.add(self.gains, self.scratch, out=self.gains)
+        np.copyto(mix, self.gains, casting='unsafe')
+
+        self.position += mix.size
+        return mix
+
+
+class Channel:
+    """
+
+    A stable stream URL for one media player, whose theme is switched server-side. Switching a player between theme
+    URLs means it tearing down its connection and reconnecting, which takes seconds on some players (Sonos,
+    Chromecast), and builds a whole new pipeline. A player connected to its channel just keeps its connection, and
+    each of its streams crossfades to the new theme (see `ThemeStream.switch`).
+
+    """
+
+    def __init__(self, player: str, theme_def: ThemeDefinition | None = None):
+        self.player = player
+        self.theme_def = theme_def
+        self.streams: weakref.WeakSet[ThemeStream] = weakref.WeakSet()
+
+    @cached_property
+    def id(self) -> str:
+        return sanitize(self.player)
+
+    @cached_property
+    def url(self) -> str:
+        from amniotic.settings import settings
+        return f'{settings.stream_url}/channel/{self.id}'
+
+    @property
+    def live(self) -> list[ThemeStream]:
+        return [stream for stream in list(self.streams) if not stream._is_closed]
+
+    def add(self, stream: ThemeStream):
+        self.streams.add(stream)
+
+    def switch(self, theme_def: ThemeDefinition) -> bool:
+        """
+
+        Set the channel's theme, switching any live streams over to it. Returns whether there were any, i.e. whether
+        the player is already connected and hears the change without being sent anywhere.
+
+        """
+        self.theme_def = theme_def
+        streams = self.live
+        for stream in streams:
+            stream.switch(theme_def)
+        if streams:
+            logger.info(f'Switched {len(streams)} stream(s) on channel "{self.id}" to Theme "{theme_def.name}".')
+        return bool(streams)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(player={self.player!r}, theme={self.theme_def and self.theme_def.name!r})'
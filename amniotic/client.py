@@ -1,32 +1,70 @@
 import asyncio
+import typing
+from functools import cached_property
+from typing import Awaitable
 
-from amniotic.api import ApiAmniotic
-from amniotic.device import Amniotic
 from amniotic.obs import logger
+from amniotic.publisher import StatePublisher
 from corio import https as http
 from haco.client import ClientHaco
 
+if typing.TYPE_CHECKING:
+    from amniotic.device import Amniotic
+
 
 class ClientAmniotic(ClientHaco):
     """
     Take an extra API argument, and gather with super.start
     """
 
-    API_CLASS = ApiAmniotic
+    @cached_property
+    def API_CLASS(self):
+        """
+
+        Deferred, so FastAPI is only imported once the API is actually launched.
+
+        """
+        from amniotic.api import ApiAmniotic
+        return ApiAmniotic
 
-    def __init__(self, device: Amniotic, *args, **kwargs):
+    def __init__(self, device: 'Amniotic', *args, **kwargs):
         super().__init__(device=device, *args, **kwargs)
+        self.publisher = StatePublisher(publish=super().publish)
 
-    async def start(self):
-        logger.info(f'Connecting MQTT client to {self._client.username}@{self._hostname}:{self._port}...')
+    async def __aenter__(self):
+        self.publisher.reset()
+        return await super().__aenter__()
+
+    async def publish(self, topic, payload=None, qos=0, retain=False, **kwargs):
+        """
+
+        Route retained messages (states and announcements) through the coalescing publisher. Anything else goes straight out.
+
+        """
+        if not retain or kwargs:
+            return await super().publish(topic, payload, qos=qos, retain=retain, **kwargs)
+        await self.publisher.publish(topic, payload, qos=qos)
+
+    async def start(self, loading: Awaitable | None = None):
+        """
+
+        Serve the stream API straight away, and connect MQTT once `loading` (if any) has completed.
+
+        """
         await asyncio.gather(
-            super().start(),
+            self.start_mqtt(loading),
             self.API_CLASS.launch_async(self)
         )
 
+    async def start_mqtt(self, loading: Awaitable | None = None):
+        if loading:
+            await loading
+        logger.info(f'Connecting MQTT client to {self._client.username}@{self._hostname}:{self._port}...')
+        await super().start()
+
     @classmethod
     @logger.instrument('Instantiating MQTT client from Supervisor API...')
-    def from_supervisor(cls, device: Amniotic, **kwargs):
+    def from_supervisor(cls, device: 'Amniotic', **kwargs):
         from amniotic.settings import settings
 
         response = http.client.get(
@@ -1,12 +1,13 @@
-import asyncio
-import shutil
 from functools import cached_property
 
-from amniotic.ha_api import client_ha
+from amniotic.ha_api import client_ha, STATE_PLAYING
 from amniotic.obs import logger
+from amniotic.profiling import profiler
+from amniotic.quarantine import quarantine
 from amniotic.recording import RecordingThemeInstance
 from amniotic.theme import ThemeDefinition
-from corio import youtube, Constants
+from amniotic.throttle import Throttle
+from corio import Constants
 from haco import binary_sensor
 from haco.binary_sensor import BinarySensor
 from haco.button import Button
@@ -73,15 +74,59 @@ class SelectTheme(Select, ThemeRelativeControl):
         await self.device.bsn_theme_streamable.state()
         return name
 
+class SelectCategory(Select, ThemeRelativeControl):
+    """
+
+    Narrows the recording select to one folder (or one page of a large folder). See `amniotic.library`.
+
+    """
+    icon: str = 'folder-music-outline'
+    name: str = 'Recording Category'
+
+    @logger.instrument('Browsing recording category "{value}"...')
+    async def command(self, value):
+        metas = self.device.metas.options.get(value)
+        if not metas:
+            return None
+
+        select_recording = self.device.select_recording
+        if select_recording.meta not in metas.values():
+            select_recording.set_default(next(iter(metas.values())))
+        await select_recording.state()
+        return value
+
+    async def state(self, value=None):
+        options = list(self.device.metas.options)
+        if self.options != options:
+            self.options = options
+            await self.announce()
+
+        return self.device.metas.get_option(self.device.select_recording.meta)
+
+
 class SelectRecording(Select, ThemeRelativeControl):
     icon: str = 'waveform'
     name: str = 'Recording'
 
-    def set_default(self, value):
-        instance = self.instances.name.get(value)
+    @property
+    def meta(self):
+        if not self.theme or not self.instance:
+            return None
+        return self.instance.meta
+
+    @property
+    def metas(self) -> dict:
+        """
+
+        Recordings in the category (page) of the current recording, by label.
+
+        """
+        return self.device.metas.get_page(self.meta)
+
+    def set_default(self, meta):
+        instance = self.instances.path.get(meta.path_str)
         if not instance:
-            logger.info(f'Creating new recording instance "{value}" for Theme "{self.theme.name}"...')
-            meta = self.device.metas.name[value]
+            logger.info(f'Creating new recording instance "{meta.name}" for Theme "{self.theme.name}"...')
             instance = RecordingThemeInstance(path=meta.path_str, device=self.device)
             self.instances.append(instance)
 
@@ -90,27 +135,25 @@ class SelectRecording(Select, ThemeRelativeControl):
 
     @logger.instrument('Setting Theme "{self.theme.name}" current recording instance to "{value}"...')
     async def command(self, value):
-        self.set_default(value)
+        self.set_default(self.metas[value])
         return value
 
     async def state(self, value=None):
 
-        options = sorted(self.device.metas.name.keys())
-        if self.options != options:
-            self.options = options
-            await self.announce()
-
         if not self.instance:
             if not self.device.metas.current:
                 return None
+            self.set_default(self.device.metas.current)
 
-            name = self.device.metas.current.name
-            instance = self.set_default(name)
+        options = list(self.metas)
+        if self.options != options:
+            self.options = options
+            await self.announce()
 
+        await self.device.select_category.state()
         await self.device.swt_play.state()
         await self.device.nbr_volume.state()
-        return self.instance.name
-
+        return self.device.metas.get_label(self.meta)
 
 
 class EnableRecording(Switch, ThemeRelativeControl):
@@ -141,21 +184,43 @@ class NumberVolume(Number, ThemeRelativeControl):
     icon: str = 'volume-medium'
     name: str = 'Recording Volume'
 
-    @logger.instrument('Setting volume to {value} for recording instance "{self.instances.current.name}" for Theme "{self.theme.name}"...')
+    throttle: Throttle = Field(default_factory=Throttle, exclude=True, repr=False)
+    value_pending: tuple[RecordingThemeInstance, float] | None = Field(default=None, exclude=True, repr=False)
+
     async def command(self, value):
+        """
+
+        Slider drags arrive as bursts of commands, so they're throttled: the latest value is applied (and persisted) at most once per throttle interval, and the final value always lands.
+
+        """
 
         if not self.instance:
             return None
 
-        self.instance.volume = value / 100
+        instance = self.instance
+        self.value_pending = instance, value
+        await self.throttle.submit(
+            apply=lambda: self.apply(instance, value),
+            apply_deferred=lambda: self.apply(instance, value, is_deferred=True),
+        )
+
+    async def apply(self, instance, value, is_deferred=False):
+        logger.info(f'Setting volume to {value} for recording instance "{instance.name}" for Theme "{self.theme.name}"...')
+        if self.value_pending and self.value_pending[0] is instance:
+            self.value_pending = None
+        instance.volume = value / 100
         self.themes.save()
 
+        if is_deferred:
+            await self.state()
 
     async def state(self, value=None):
 
         if not self.instance:
             return None
 
+        if self.value_pending and self.value_pending[0] is self.instance:
+            return int(self.value_pending[1])
 
         return int(self.instance.volume * 100)
 
@@ -172,6 +237,11 @@ class SelectMediaPlayer(Select, ThemeRelativeControl):
         return value
 
     async def state(self, value):
+        options = list(self.device.media_player_states.friendly_name.keys())
+        if self.options != options:
+            self.options = options
+            await self.announce()
+
         player = self.device.media_player_states.current
         if player:
             return player.friendly_name
@@ -204,20 +274,25 @@ class PlayStreamButton(Button, ThemeRelativeControl):
         if not state:
             return
 
-        with logger.span(f'Posting request to HA API {self.url} {state.entity_id=} {self.theme.url=}') as span:
+        channel = self.device.get_channel(state.entity_id)
+        if channel.switch(self.theme) and state.state == STATE_PLAYING:
+            # The player is connected, and still reading, so it hears the switch without being told to play anything.
+            return
+
+        with logger.span(f'Posting request to HA API {self.url} {state.entity_id=} {channel.url=}') as span:
             try:
-                await self.post(state)
+                await self.post(state, channel.url)
             except Exception as exception:
                 logger.error(f'Error posting to HA API: {repr(exception)}.')
                 span.record_exception(exception=exception)
 
-    async def post(self, state):
-        response = client_ha.post(
+    async def post(self, state, url: str):
+        response = await client_ha.post(
             self.url,
             headers=client_ha.headers_auth,
             json={
                 "entity_id": state.entity_id,
-                "media_content_id": self.theme.url,
+                "media_content_id": url,
                 "media_content_type": "music",
             }
         )
@@ -251,6 +326,7 @@ class DeleteTheme(Button, ThemeRelativeControl):
 
     @logger.instrument('Deleting Theme "{self.theme.name}"...')
     async def command(self, value):
+        self.device.forget_theme(self.theme)
         self.themes.remove(self.theme)
         self.themes.save()
         await self.device.select_theme.state()
@@ -260,71 +336,21 @@ class DeleteTheme(Button, ThemeRelativeControl):
 class DownloadLink(Text):
     """
 
-    YouTube audio stream downloader URL input.
+    YouTube audio stream downloader URL input. Each URL is queued on the device's download manager.
 
     """
 
     icon: str = 'cloud-download-outline'
     name: str = 'Download from YouTube'
-    downloader: youtube.AudioStreamDownloader | None = Field(default=None, exclude=True, repr=False)
-
-    @cached_property
-    def status_state(self):
-        return self.device.sns_download_status.state
 
-    @cached_property
-    def percent_state(self):
-        return self.device.sns_download_percent.state
-
-    @logger.instrument('Downloading YouTube Link "{value}"...')
+    @logger.instrument('Queueing YouTube Link "{value}" for download...')
     async def command(self, value):
-        asyncio.create_task(self.download(value))
+        await self.device.downloads.submit(value)
         return value
 
     async def state(self, value=None):
         return value or Constants.PROMPT_NONE_SPECIFIED
 
-    @logger.instrument('Downloading "{url}"...')
-    async def download(self, url: str):
-
-        if self.downloader:
-            message = f'Cannot download "{url}". Downloader already running.'
-            logger.warning(message)
-            await self.status_state(value=message)
-            return None
-
-        self.downloader = youtube.AudioStreamDownloader(url_or_id=url)
-
-        try:
-            async for data in self.downloader.download():
-
-                if data.message:
-                    logger.info(data.message)
-                    await self.status_state(value=data.message)
-                if data.percentage is not None:
-                    message = f"Downloading: {data.percentage}% complete..."
-                    logger.info(message)
-                    await self.percent_state(value=data.percentage)
-
-            await self.status_state(value='Moving download to audio directory...')
-            src = self.downloader.path
-            dst = self.device.path_audio / src.name
-            shutil.move(src, dst)
-            await self.device.refresh_metas_task(loop=False)
-            await self.device.select_recording.state()
-
-            await self.status_state(value='Finished')
-
-        except Exception as exception:
-            message = 'Error downloading. See container logs for details.'
-            logger.exception(message)
-            await self.status_state(value=message)
-            raise exception
-        finally:
-            await self.status_state(value=None)
-            await self.percent_state(value=None)
-            self.downloader = None
-
 
 class DownloadStatus(Sensor):
     icon: str = 'cloud-sync-outline'
@@ -360,3 +386,64 @@ class ThemeStreamable(BinarySensor, ThemeRelativeControl):
     async def state(self, value=None):
         value = self.theme.is_enabled
         return value
+
+
+class ProfileStreams(Switch):
+    """
+
+    Debug switch for sampled per-stage timing of live streams. See `amniotic.profiling`.
+
+    """
+    icon: str = 'timer-cog-outline'
+    name: str = 'Profile Streams'
+    entity_category: str = 'config'
+
+    @logger.instrument('Setting stream profiling to {value=}...')
+    async def command(self, value):
+        profiler.set_enabled(value)
+
+    async def state(self, value=None):
+        return profiler.is_enabled
+
+
+class ActiveStreams(Sensor):
+    """
+
+    Diagnostic count of live streams. See the API's `/debug/streams` endpoint for details of each.
+
+    """
+    icon: str = 'access-point-network'
+    name: str = 'Active Streams'
+    entity_category: str = 'diagnostic'
+
+    async def state(self, value=None):
+        return len(self.device.streams)
+
+
+class UndecodableRecordings(Sensor):
+    """
+
+    Diagnostic count of recordings being skipped because they couldn't be decoded. See `amniotic.quarantine`, and the
+    API's `/debug/undecodable` endpoint for which ones and why.
+
+    """
+    icon: str = 'file-alert-outline'
+    name: str = 'Undecodable Recordings'
+    entity_category: str = 'diagnostic'
+
+    async def state(self, value=None):
+        return len(quarantine)
+
+
+class StreamQuality(Sensor):
+    """
+
+    Diagnostic for the current stream quality step. See `amniotic.quality`.
+
+    """
+    icon: str = 'speedometer-medium'
+    name: str = 'Stream Quality'
+    entity_category: str = 'diagnostic'
+
+    async def state(self, value=None):
+        return self.device.quality.level.name
@@ -1,16 +1,24 @@
 import asyncio
-import homeassistant_api
-import psutil
 from dataclasses import dataclass
 from dataclasses import fields
 from functools import cached_property
 from typing import Self
 
-from amniotic.controls import SelectTheme, SelectRecording, EnableRecording, NumberVolume, SelectMediaPlayer, PlayStreamButton, StreamURL, NewTheme, DeleteTheme, DownloadLink, DownloadStatus, DownloadPercent, RecordingsPresent, ThemeStreamable
-from amniotic.ha_api import client_ha
+from amniotic.admission import Admission
+from amniotic.channel import CROSSFADE, Channel
+from amniotic.memory import MemoryManager
+from amniotic.downloads import DownloadManager, DownloadJob, DOWNLOAD_WORKERS
+from amniotic.controls import SelectTheme, SelectCategory, SelectRecording, EnableRecording, NumberVolume, SelectMediaPlayer, PlayStreamButton, StreamURL, NewTheme, DeleteTheme, DownloadLink, DownloadStatus, DownloadPercent, RecordingsPresent, ThemeStreamable, ProfileStreams, ActiveStreams, UndecodableRecordings, StreamQuality
+from amniotic.ha_api import client_ha, MediaPlayerEvents
+from amniotic.library import Library, iter_paths_audio, get_category
 from amniotic.obs import logger
+from amniotic.quality import QualityController
+from amniotic.reaper import Reaper
 from amniotic.recording import RecordingMetadata
-from amniotic.theme import ThemeDefinition, IndexThemes
+from amniotic.renditions import Transcoder, TRANSCODE_WORKERS, clear_metadata_cache
+from amniotic.sessions import SessionCache
+from amniotic.startup import Timeline
+from amniotic.theme import ThemeDefinition, IndexThemes, ThemeStream
 from corio import Path
 from corio.iterator import IndexList, IterDiffer
 from haco.device import Device
@@ -38,35 +46,57 @@ class MediaState:
 
 class Amniotic(Device):
     themes: IndexList[ThemeDefinition] = Field(default_factory=IndexList, exclude=True, repr=False)
-    metas: IndexList[RecordingMetadata] = Field(default_factory=IndexList, exclude=True, repr=False)
+    metas: Library = Field(default_factory=Library, exclude=True, repr=False)
     media_player_states: IndexList[MediaState] = Field(default_factory=IndexList, exclude=True, repr=False)
-
-    client_ha: homeassistant_api.Client | None = Field(default=None, exclude=True, repr=False)
+    streams: IndexList[ThemeStream] = Field(default_factory=IndexList, exclude=True, repr=False)
+    channels: IndexList[Channel] = Field(default_factory=IndexList, exclude=True, repr=False)
+
+    admission: Admission = Field(default_factory=Admission, exclude=True, repr=False)
+    admission_task: asyncio.Task | None = Field(default=None, exclude=True, repr=False)
+    memory: MemoryManager = Field(default_factory=MemoryManager, exclude=True, repr=False)
+    block_duration: int | None = Field(default=None, exclude=True, repr=False)
+    float_bus: bool = Field(default=False, exclude=True, repr=False)
+    crossfade: int = Field(default=CROSSFADE, exclude=True, repr=False)
+    sessions: SessionCache = Field(default_factory=SessionCache, exclude=True, repr=False)
+    sessions_task: asyncio.Task | None = Field(default=None, exclude=True, repr=False)
+    reaper: Reaper = Field(default_factory=Reaper, exclude=True, repr=False)
+    reaper_task: asyncio.Task | None = Field(default=None, exclude=True, repr=False)
+    quality: QualityController = Field(default_factory=QualityController, exclude=True, repr=False)
+    quality_task: asyncio.Task | None = Field(default=None, exclude=True, repr=False)
+    memory_task: asyncio.Task | None = Field(default=None, exclude=True, repr=False)
 
     path_audio: Path = Field(exclude=True, repr=False)
     path_audio_schedule_duration: int = Field(default=10, exclude=True, repr=False)
 
     path_audio_schedule_task: asyncio.Task | None = Field(default=None, exclude=True, repr=False)
 
+    media_player_events_task: asyncio.Task | None = Field(default=None, exclude=True, repr=False)
+
+    download_workers: int = Field(default=DOWNLOAD_WORKERS, exclude=True, repr=False)
+    transcode_workers: int = Field(default=TRANSCODE_WORKERS, exclude=True, repr=False)
+    ingest_task: asyncio.Task | None = Field(default=None, exclude=True, repr=False)
+    ingest_tasks: set[asyncio.Task] = Field(default_factory=set, exclude=True, repr=False)
+
     monitor_interval: int = Field(default=30, exclude=True, repr=False)
     monitor_task: asyncio.Task | None = Field(default=None, exclude=True, repr=False)
 
+    timeline: Timeline = Field(default_factory=Timeline, exclude=True, repr=False)
+    is_loaded: bool = Field(default=False, exclude=True, repr=False)
+
     def model_post_init(self, __context):
+        """
+
+        Only cheap setup happens here. Recordings, themes and media players are loaded concurrently by `load`.
+
+        """
         if not self.path_audio.exists():
             logger.warning(f'Audio path "{self.path_audio}" does not exist. Will be created.')
             self.path_audio.mkdir()
-        self.metas = IndexList()
-        self.refresh_metas()
-
-        if not self.metas:
-            logger.warning(f'No audio files found in "{self.path_audio}". You will need to add some before you can stream anything.')
-
-        self.themes = IndexThemes.load(self)
-
-        self.media_player_states = IndexList(self.get_media_players())
+        self.metas = Library()
 
         self.controls = [
             self.select_theme,
+            self.select_category,
             self.select_recording,
             self.btn_delete_theme,
             self.txt_new_theme,
@@ -80,16 +110,51 @@ class Amniotic(Device):
             self.sns_download_percent,
             self.bsn_recordings_present,
             self.bsn_theme_streamable,
+            self.swt_profile,
+            self.sns_streams,
+            self.sns_undecodable,
+            self.sns_quality,
         ]
 
 
+    async def load(self):
+        """
+
+        Load the recording library (then themes, which reference recordings) and media players concurrently, and sync the select options to the results.
+
+        """
+        await asyncio.gather(
+            self.timeline.run('library', asyncio.to_thread(self.load_library)),
+            self.timeline.run('media_players', self.refresh_media_players()),
+        )
+
+        self.select_theme.options = sorted(self.themes.name.keys())
+        theme = self.themes.current
+        instance = theme.instances.current if theme else None
+        self.select_category.options = list(self.metas.options)
+        self.select_recording.options = list(self.metas.get_page(instance.meta if instance else None))
+        self.select_media_player.options = list(self.media_player_states.friendly_name.keys())
+        self.is_loaded = True
+
+    def load_library(self):
+        self.refresh_metas()
+
+        if not self.metas:
+            logger.warning(f'No audio files found in "{self.path_audio}". You will need to add some before you can stream anything.')
+
+        self.themes = IndexThemes.load(self)
+
     @cached_property
     def select_theme(self):
         return SelectTheme(options=[str(defin.name) for defin in self.themes])
 
+    @cached_property
+    def select_category(self):
+        return SelectCategory(options=list(self.metas.options))
+
     @cached_property
     def select_recording(self):
-        return SelectRecording(options=sorted(self.metas.name.keys()))
+        return SelectRecording(options=[])
 
     @cached_property
     def select_media_player(self):
@@ -139,21 +204,135 @@ class Amniotic(Device):
     def bsn_theme_streamable(self):
         return ThemeStreamable()
 
-    def refresh_metas(self) -> bool:
+    @cached_property
+    def swt_profile(self):
+        return ProfileStreams()
+
+    @cached_property
+    def sns_streams(self):
+        return ActiveStreams()
+
+    @cached_property
+    def sns_undecodable(self):
+        return UndecodableRecordings()
+
+    @cached_property
+    def sns_quality(self):
+        return StreamQuality()
+
+    def get_channel(self, player: str) -> Channel:
+        """
+
+        The channel for media player entity `player`, created on first use.
+
+        """
+        channel = self.channels.player.get(player)
+        if not channel:
+            channel = Channel(player=player)
+            self.channels.append(channel)
+        return channel
+
+    def forget_theme(self, theme_def: ThemeDefinition):
+        """
+
+        Take a theme being deleted off any channels, so players reconnecting to them don't stream it.
+
+        """
+        for channel in self.channels:
+            if channel.theme_def is theme_def:
+                channel.theme_def = None
+
+    async def add_stream(self, stream: ThemeStream):
+        self.streams.append(stream)
+        await self.publish_streams()
+
+    async def release_stream(self, stream: ThemeStream):
+        stream.close()
+        if stream in self.streams:
+            self.streams.remove(stream)
+        if stream.chunks_sent:
+            self.admission.record(stream.request.client[0] if stream.request.client else None)
+            await asyncio.to_thread(self.save_offsets)
+        await self.publish_streams()
+
+    def save_offsets(self):
+        """
+
+        Persist where each recording stopped, so the next stream of it resumes from there. Blocking, so run in a thread.
+
+        """
+        try:
+            self.themes.save()
+        except Exception:
+            logger.exception('Error saving recording offsets.')
+
+    async def publish_streams(self):
+        try:
+            await self.sns_streams.state()
+        except Exception:
+            logger.exception('Error publishing active streams state.')
+
+    async def monitor_quality_task(self):
+        """
+
+        Watch real-time headroom across live streams, degrading or restoring stream quality as needed.
+
+        """
+        while True:
+            try:
+                if self.quality.update(list(self.streams)):
+                    await self.sns_quality.state()
+            except Exception:
+                logger.exception('Error in stream quality task.')
+            await asyncio.sleep(self.quality.interval)
+
+    async def reap_streams_task(self):
+        """
+
+        Stop idle streams, and optionally their media players. See `Reaper`.
+
+        """
+        while True:
+            await asyncio.sleep(self.reaper.interval)
+            try:
+                for stream, reason in self.reaper.check(list(self.streams)):
+                    await self.reap_stream(stream, reason)
+            except Exception:
+                logger.exception('Error in idle stream task.')
+
+    async def reap_stream(self, stream: ThemeStream, reason: str):
+        logger.warning(f'Stopping idle stream {repr(stream)}: {reason}')
+        if self.reaper.stop_player:
+            # Stopped first, so it doesn't just reconnect once the stream ends.
+            players = [channel.player for channel in self.channels if stream in channel.live]
+            if not players:
+                logger.info(f'Media player for {repr(stream)} is unknown, as it was not streamed to a channel. Not stopping it.')
+            for player in players:
+                try:
+                    await client_ha.stop_media_player(player)
+                except Exception:
+                    logger.exception(f'Error stopping media player "{player}".')
+        stream.stop(reason)
+
+    def refresh_metas(self, paths_disk: set[Path] | None = None) -> bool:
+        """
 
+        Add recordings in `paths_disk` that aren't in the library yet. Without `paths_disk`, the audio path is walked
+        for them, which blocks, so the background task walks it in a thread first.
+
+        """
         logger.debug(f'Refreshing Recordings from "{self.path_audio}"...')
 
         paths_existing = self.metas.path.keys()
-        paths_disk = {path for path in self.path_audio.iterdir() if path.is_file()}
+        if paths_disk is None:
+            paths_disk = set(iter_paths_audio(self.path_audio))
 
         diff = IterDiffer(paths_existing, paths_disk)
 
-        for path in diff.added:
+        for path in sorted(diff.added):
             logger.info(f'Adding new recording: "{path}"...')
-            meta = RecordingMetadata(path)
+            meta = RecordingMetadata(path, category=get_category(self.path_audio, path))
             self.metas.append(meta)
-            if not self.metas.current:
-                self.metas.current = meta
 
         return bool(diff.added)
 
@@ -171,14 +350,56 @@ class Amniotic(Device):
 
     async def _refresh_metas_task_logic(self):
         try:
-            is_changed = self.refresh_metas()
+            await self.sns_undecodable.state()
+            paths_disk = await asyncio.to_thread(lambda: set(iter_paths_audio(self.path_audio)))
+            is_changed = self.refresh_metas(paths_disk)
             if is_changed:
                 logger.info(f'Audio file monitoring task found changes. Directory: "{self.path_audio}"...')
                 await self.bsn_recordings_present.state()
                 await self.select_recording.state()
+                task = asyncio.create_task(self.ingest())
+                self.ingest_tasks.add(task)
+                task.add_done_callback(self.ingest_tasks.discard)
         except Exception:
             logger.exception('Error in audio file monitoring task logic.')
 
+    @cached_property
+    def downloads(self) -> DownloadManager:
+        return DownloadManager(path=self.path_audio, on_progress=self.publish_downloads, on_complete=self.add_download, workers=self.download_workers)
+
+    @cached_property
+    def transcoder(self) -> Transcoder:
+        return Transcoder(on_progress=self.publish_downloads, workers=self.transcode_workers)
+
+    async def ingest(self, prune: bool = False):
+        """
+
+        Transcode any recordings without a current rendition, so streams can read those instead. Optionally remove orphaned renditions first.
+
+        """
+        paths = list(self.metas.path.keys())
+        if prune:
+            await asyncio.to_thread(self.transcoder.prune, self.path_audio, paths)
+        await self.transcoder.ingest(paths)
+
+    async def publish_downloads(self):
+        """
+
+        Downloads and transcoding share the download status sensors. Downloads take precedence for the percentage.
+
+        """
+        statuses = [status for status in (self.downloads.status, self.transcoder.status) if status]
+        percentage = self.downloads.percentage
+        if percentage is None:
+            percentage = self.transcoder.percentage
+        await self.sns_download_status.state(value=' '.join(statuses) or None)
+        await self.sns_download_percent.state(value=percentage)
+
+    async def add_download(self, job: DownloadJob):
+        logger.info(f'Downloaded "{job.id}" to "{job.path}".')
+        await self.refresh_metas_task(loop=False)
+        await self.select_recording.state()
+
     async def monitor_objects_task(self):
         try:
             import gc
@@ -226,25 +447,100 @@ class Amniotic(Device):
             logger.exception('Fatal error in object monitoring task initialization.')
 
     @logger.instrument('Refreshing Media Player Entities from HA API...')
-    def get_media_players(self) -> list[MediaState]:
+    async def get_media_players(self) -> list[MediaState]:
 
-        response = client_ha.get(
-            f"{client_ha.url_api}/states",
-            headers=client_ha.headers_auth,
-        )
-
-        response.raise_for_status()
-        data_all = response.json()
-        data_mps = [datum for datum in data_all if datum["entity_id"].startswith("media_player.")]
+        data_mps = await client_ha.get_states_media_player()
         objs = [MediaState.from_state(datum) for datum in data_mps]
 
         logger.info(f'Found {len(objs)} Media Player Entities.')
         return objs
 
+    async def refresh_media_players(self):
+        try:
+            states = await self.get_media_players()
+        except Exception:
+            logger.exception('Error fetching Media Player Entities from HA API. Keeping existing list.')
+            return
+
+        current = self.media_player_states.current
+        self.media_player_states = IndexList(states)
+        if current:
+            self.media_player_states.current = self.media_player_states.entity_id.get(current.entity_id)
+
+    async def resync_media_players(self):
+        await self.refresh_media_players()
+        await self.publish_media_players()
+
+    async def update_media_player(self, entity_id: str, data: dict | None):
+        """
+
+        Apply a single media player state change from the HA event stream. Options are only re-published when players are added, removed or renamed.
+
+        """
+        states = self.media_player_states
+        existing = states.entity_id.get(entity_id)
+
+        if data is None:
+            if not existing:
+                return
+            logger.info(f'Media Player removed: "{entity_id}".')
+            states.remove(existing)
+            if states.current is existing:
+                states.current = None
+        else:
+            state = MediaState.from_state(data)
+            if existing:
+                states[states.index(existing)] = state
+                if states.current is existing:
+                    states.current = state
+                if existing.friendly_name == state.friendly_name:
+                    return
+            else:
+                logger.info(f'Media Player added: "{entity_id}".')
+                states.append(state)
+
+        await self.publish_media_players()
+
+    async def publish_media_players(self):
+        try:
+            await self.select_media_player.state()
+        except Exception:
+            logger.exception('Error publishing Media Player options.')
+
+    @cached_property
+    def media_player_events(self) -> MediaPlayerEvents:
+        return MediaPlayerEvents(client=client_ha, on_state=self.update_media_player, on_connect=self.resync_media_players)
+
     async def initialise(self):
-        await super().initialise()
+        await self.timeline.run('announce', super().initialise())
+        self.timeline.log()
+
+        if not self.media_player_events_task:
+            self.media_player_events_task = asyncio.create_task(self.media_player_events.run())
+
         if not self.path_audio_schedule_task:
             self.path_audio_schedule_task = asyncio.create_task(self.refresh_metas_task())
 
         if not self.monitor_task:
             self.monitor_task = asyncio.create_task(self.monitor_objects_task())
+
+        if not self.ingest_task:
+            self.ingest_task = asyncio.create_task(self.ingest(prune=True))
+
+        if not self.admission_task:
+            self.admission_task = asyncio.create_task(self.admission.run())
+
+        if not self.quality_task:
+            self.quality_task = asyncio.create_task(self.monitor_quality_task())
+
+        if not self.reaper_task:
+            self.reaper_task = asyncio.create_task(self.reap_streams_task())
+
+        if not self.sessions_task:
+            self.sessions.on_close = self.save_offsets
+            self.sessions_task = asyncio.create_task(self.sessions.run())
+
+        if not self.memory_task:
+            self.memory.register('rendition metadata', clear_metadata_cache)
+            self.memory.register('stream sessions', self.sessions.clear)
+            self.memory_task = asyncio.create_task(self.memory.run())
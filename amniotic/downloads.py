@@ -0,0 +1,215 @@
+import asyncio
+import shutil
+import tempfile
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+
+from amniotic.library import iter_paths_audio
+from amniotic.obs import logger
+from amniotic.throttle import Throttle
+from corio import Path
+
+DOWNLOAD_WORKERS = 2
+PROGRESS_INTERVAL = 1.0
+STATUS_LENGTH_MAX = 255
+
+
+@dataclass
+class DownloadJob:
+    url: str
+    id: str
+    status: str = 'Queued'
+    percentage: int | None = None
+    path: Path | None = None
+    is_finished: bool = False
+    is_failed: bool = False
+
+    @property
+    def is_active(self) -> bool:
+        return not (self.is_finished or self.is_failed)
+
+    @property
+    def is_running(self) -> bool:
+        return self.is_active and self.status != 'Queued'
+
+
+class DownloadManager:
+    """
+
+    Queue of audio downloads, run by a bounded pool of workers.
+
+    Jobs are keyed by source ID, so submitting a URL that is already queued, running or downloaded is a no-op. Failed jobs
+    can be resubmitted. Downloaded files have their source ID in their name, e.g. "Rain [abc123].m4a", so videos with the
+    same title don't overwrite each other, and earlier downloads are found on disk (anywhere under `path`, in case
+    they've been moved into a category) after a restart. Progress from every job is summarised in `status` and `percentage`, and `on_progress` is called,
+    throttled to once per `progress_interval`, whenever they change.
+
+    Downloading blocks, so each runs in a worker thread, staging to a directory of its own, and sends its progress
+    back to the event loop. Each finished download is moved into `path` off the event loop, then handed to
+    `on_complete`.
+
+    """
+
+    def __init__(self, path: Path, on_progress: Callable[[], Awaitable], on_complete: Callable[[DownloadJob], Awaitable], workers: int = DOWNLOAD_WORKERS, progress_interval: float = PROGRESS_INTERVAL, downloader_class: type | None = None):
+        self.path = path
+        self.on_progress = on_progress
+        self.on_complete = on_complete
+        self.workers = max(workers, 1)
+        self.downloader_class = downloader_class
+        self.throttle = Throttle(interval=progress_interval)
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.jobs: dict[str, DownloadJob] = {}
+        self.worker_tasks: list[asyncio.Task] = []
+
+    def get_downloader(self, url: str):
+        if self.downloader_class:
+            return self.downloader_class(url_or_id=url)
+        from amniotic.youtube import AudioStreamDownloader
+        return AudioStreamDownloader(url_or_id=url)
+
+    async def submit(self, url: str) -> DownloadJob:
+        downloader = self.get_downloader(url)
+
+        job = self.jobs.get(downloader.id)
+        if job and not job.is_failed:
+            logger.info(f'Download of "{job.id}" already {job.status.lower() if job.is_active else "finished"}. Skipping "{url}".')
+            return job
+
+        path = await asyncio.to_thread(self.find_download, downloader.id)
+        if path:
+            logger.info(f'Download of "{downloader.id}" already exists at "{path}". Skipping "{url}".')
+            job = DownloadJob(url=url, id=downloader.id, status='Finished', percentage=100, path=path, is_finished=True)
+            self.jobs[job.id] = job
+            return job
+
+        job = DownloadJob(url=url, id=downloader.id)
+        self.jobs[job.id] = job
+        self.queue.put_nowait((job, downloader))
+        logger.info(f'Queued download of "{job.id}". {self.queue.qsize()} job(s) waiting.')
+
+        self.start()
+        await self.publish_progress()
+        return job
+
+    def get_path(self, downloader) -> Path:
+        path = downloader.path
+        return self.path / f'{path.stem} [{downloader.id}]{path.suffix}'
+
+    def find_download(self, id: str) -> Path | None:
+        """
+
+        An earlier download of source `id`, if there is one.
+
+        """
+        tag = f'[{id}]'
+        for path in iter_paths_audio(self.path):
+            if path.stem.endswith(tag):
+                return path
+        return None
+
+    def start(self):
+        self.worker_tasks = [task for task in self.worker_tasks if not task.done()]
+        while len(self.worker_tasks) < self.workers:
+            self.worker_tasks.append(asyncio.create_task(self.work()))
+
+    async def work(self):
+        while True:
+            job, downloader = await self.queue.get()
+            try:
+                await self.download(job, downloader)
+            except Exception:
+                job.is_failed = True
+                job.status = 'Error downloading. See container logs for details.'
+                logger.exception(f'Error downloading "{job.id}".')
+            finally:
+                self.queue.task_done()
+                await self.publish_progress()
+
+    async def download(self, job: DownloadJob, downloader):
+        with logger.span(f'Downloading "{job.url}"...'):
+            job.status = 'Starting...'
+            staging = Path(await asyncio.to_thread(tempfile.mkdtemp, prefix=f'amniotic-download-{job.id}-'))
+            try:
+                async for data in self.iter_download(downloader, staging):
+                    if data.message:
+                        logger.info(f'{job.id}: {data.message}')
+                        job.status = data.message
+                    if data.percentage is not None:
+                        job.percentage = data.percentage
+                    await self.publish_progress()
+
+                job.status = 'Moving download to audio directory...'
+                await self.publish_progress()
+                job.path = self.get_path(downloader)
+                await asyncio.to_thread(shutil.move, downloader.path, job.path)
+            finally:
+                await asyncio.to_thread(shutil.rmtree, staging, ignore_errors=True)
+
+            job.status = 'Finished'
+            job.percentage = 100
+            job.is_finished = True
+
+        await self.on_complete(job)
+
+    async def iter_download(self, downloader, staging: Path):
+        """
+
+        Run `downloader` in a worker thread, and yield its progress on the event loop. Data chunks are left in the
+        thread, and only changes in message or percentage are sent over.
+
+        """
+        loop = asyncio.get_running_loop()
+        updates: asyncio.Queue = asyncio.Queue()
+
+        def run():
+            percentage = None
+            try:
+                for data in downloader.iter_download(staging):
+                    if data.message or data.percentage != percentage:
+                        percentage = data.percentage
+                        loop.call_soon_threadsafe(updates.put_nowait, data)
+            finally:
+                loop.call_soon_threadsafe(updates.put_nowait, None)
+
+        thread = asyncio.create_task(asyncio.to_thread(run))
+        try:
+            while (data := await updates.get()) is not None:
+                yield data
+        finally:
+            await thread
+
+    async def publish_progress(self):
+        await self.throttle.submit(self.publish)
+
+    async def publish(self):
+        try:
+            await self.on_progress()
+        except Exception:
+            logger.exception('Error publishing download progress.')
+
+    @property
+    def status(self) -> str | None:
+        """
+
+        One line summary of active jobs, or `None` when idle.
+
+        """
+        active = [job for job in self.jobs.values() if job.is_active]
+        if not active:
+            return None
+        running = [job for job in active if job.is_running]
+        details = '; '.join(f'{job.id}: {job.status}' for job in running)
+        status = f'{len(running)} downloading, {len(active) - len(running)} queued. {details}'.strip()
+        return status[:STATUS_LENGTH_MAX]
+
+    @property
+    def percentage(self) -> int | None:
+        """
+
+        Mean progress of running jobs.
+
+        """
+        running = [job for job in self.jobs.values() if job.is_running]
+        if not running:
+            return None
+        return round(sum(job.percentage or 0 for job in running) / len(running))
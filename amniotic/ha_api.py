@@ -1,7 +1,52 @@
+import asyncio
+import json
+from functools import cached_property
+from typing import Awaitable, Callable
+
+import httpx
+import websockets
+from httpx_retries import RetryTransport
+
+from amniotic.obs import logger
 from corio import https as http
 
+DOMAIN_MEDIA_PLAYER = 'media_player'
+STATE_PLAYING = 'playing'
+
+TEMPLATE_MEDIA_PLAYERS = """
+{%- set ns = namespace(items=[]) -%}
+{%- for state in states.media_player -%}
+{%- set ns.items = ns.items + [{
+    "entity_id": state.entity_id,
+    "state": state.state,
+    "attributes": {
+        "friendly_name": state.attributes.get("friendly_name"),
+        "supported_features": state.attributes.get("supported_features")
+    }
+}] -%}
+{%- endfor -%}
+{{ ns.items | to_json }}
+"""
+
+
+class ClientHA(http.AsyncClient):
+    """
+
+    Async, connection-pooled client for the Home Assistant Core API. Connections are kept alive between calls, so
+    requests from the event loop don't pay for a new TCP/TLS handshake each time, and never block it.
+
+    """
+
+    TIMEOUT = httpx.Timeout(10, connect=5)
+    LIMITS = httpx.Limits(max_connections=10, max_keepalive_connections=5, keepalive_expiry=60)
+
+    @cached_property
+    def transport(self) -> RetryTransport:
+        return RetryTransport(
+            transport=httpx.AsyncHTTPTransport(limits=self.LIMITS),
+            retry=self.retry
+        )
 
-class ClientHA(http.Client):
     @property
     def url_api(self):
         from amniotic.settings import settings
@@ -9,9 +54,125 @@ class ClientHA(http.Client):
         return f"{settings.ha_core_api}"
 
     @property
-    def headers_auth(self):
+    def url_websocket(self):
+        """
+
+        Websocket API URL. The Supervisor proxies Core's `/api/websocket` at `/core/websocket`.
+
+        """
+        url = self.url_api.rstrip('/').removesuffix('/api')
+        if not url.endswith('/core'):
+            url = f'{url}/api'
+        url = f'{url}/websocket'
+        return url.replace('http://', 'ws://', 1).replace('https://', 'wss://', 1)
+
+    @property
+    def token(self):
         from amniotic.settings import settings
-        return {"Authorization": f"Bearer {settings.token}"}
+        return settings.token
+
+    @property
+    def headers_auth(self):
+        return {"Authorization": f"Bearer {self.token}"}
+
+    async def get_states_media_player(self) -> list[dict]:
+        """
+
+        Fetch media player states only. Rendering a template filters them server-side, rather than downloading every entity from `/states`.
+
+        """
+        response = await self.post(
+            f"{self.url_api}/template",
+            headers=self.headers_auth,
+            json={"template": TEMPLATE_MEDIA_PLAYERS},
+        )
+        response.raise_for_status()
+        return json.loads(response.text)
+
+    async def stop_media_player(self, entity_id: str):
+        response = await self.post(
+            f"{self.url_api}/services/{DOMAIN_MEDIA_PLAYER}/media_stop",
+            headers=self.headers_auth,
+            json={"entity_id": entity_id},
+        )
+        response.raise_for_status()
+
+
+class MediaPlayerEvents:
+    """
+
+    Subscription to Home Assistant `state_changed` events, filtered to media players, over the websocket API.
+
+    `on_state` is awaited with the entity ID and the new state (`None` if the entity was removed) for each media player change.
+    `on_connect` is awaited after each (re)subscription, so the caller can resync anything missed while disconnected.
+
+    """
+
+    RECONNECT_DELAY = 5
+    PREFIX = f'"{DOMAIN_MEDIA_PLAYER}.'
+
+    def __init__(self, client: ClientHA, on_state: Callable[[str, dict | None], Awaitable], on_connect: Callable[[], Awaitable] | None = None):
+        self.client = client
+        self.on_state = on_state
+        self.on_connect = on_connect
+        self.ids = iter(range(1, 2 ** 31))
+
+    async def run(self):
+        while True:
+            try:
+                await self.subscribe()
+            except asyncio.CancelledError:
+                raise
+            except Exception as exception:
+                logger.warning(f'Home Assistant websocket disconnected: {repr(exception)}. Retrying in {self.RECONNECT_DELAY}s.')
+            await asyncio.sleep(self.RECONNECT_DELAY)
+
+    async def subscribe(self):
+        url = self.client.url_websocket
+        logger.info(f'Subscribing to media player state changes at "{url}"...')
+
+        async with websockets.connect(url) as websocket:
+            await self.authenticate(websocket)
+
+            await websocket.send(json.dumps({'id': next(self.ids), 'type': 'subscribe_events', 'event_type': 'state_changed'}))
+            result = json.loads(await websocket.recv())
+            if not result.get('success'):
+                raise ConnectionError(f'Error subscribing to state changes: {result.get("error")}')
+
+            if self.on_connect:
+                await self.on_connect()
+
+            async for message in websocket:
+                await self.handle(message)
+
+    async def authenticate(self, websocket):
+        message = json.loads(await websocket.recv())
+        if message.get('type') != 'auth_required':
+            raise ConnectionError(f'Unexpected websocket greeting: {message}')
+
+        await websocket.send(json.dumps({'type': 'auth', 'access_token': self.client.token}))
+        message = json.loads(await websocket.recv())
+        if message.get('type') != 'auth_ok':
+            raise ConnectionError(f'Websocket authentication failed: {message.get("message")}')
+
+    async def handle(self, message: str | bytes):
+        if isinstance(message, bytes):
+            message = message.decode()
+
+        # Most events are for other domains, so skip them before paying to parse.
+        if self.PREFIX not in message:
+            return
+
+        data = json.loads(message)
+        if data.get('type') != 'event':
+            return
+
+        event = data['event']['data']
+        entity_id = event['entity_id']
+        if not entity_id.startswith(f'{DOMAIN_MEDIA_PLAYER}.'):
+            return
+
+        await self.on_state(entity_id, event.get('new_state'))
 
 
 client_ha = ClientHA()
@@ -0,0 +1,126 @@
+from collections import Counter
+from typing import Iterable, Iterator
+
+from amniotic.recording import RecordingMetadata
+from corio import Path
+from corio.iterator import IndexList
+
+CATEGORY_ROOT = 'Top Level'
+PAGE_SIZE = 100
+
+
+def get_category(path_audio: Path, path: Path) -> str:
+    """
+
+    Folder of `path`, relative to the audio path. Empty at the top level.
+
+    """
+    category = path.parent.relative_to(path_audio)
+    if category == Path('.'):
+        return ''
+    return category.as_posix()
+
+
+def iter_paths_audio(path: Path) -> Iterator[Path]:
+    """
+
+    Every file under `path`, recursively, skipping anything hidden (including rendition directories).
+
+    """
+    for root, dirs, files in path.walk():
+        dirs[:] = sorted(name for name in dirs if not name.startswith('.'))
+        for name in files:
+            if not name.startswith('.'):
+                yield root / name
+
+
+class Library(IndexList[RecordingMetadata]):
+    """
+
+    Index of recordings, by path and by category (the folder they're in, relative to the audio path).
+
+    Path lookups are kept up to date as recordings are added, instead of being rebuilt on every access. Categories are
+    split into pages of at most `page_size` recordings, and each page is one category select option, so the recording
+    select only ever announces one page, however large the library grows. Options are rebuilt only when the library changes.
+    Recordings are labelled by name, or by file name where names clash within a page, e.g. "Rain.mp3" and "Rain.flac".
+
+    """
+
+    def __init__(self, iterable: Iterable[RecordingMetadata] = (), page_size: int = PAGE_SIZE):
+        super().__init__()
+        self.page_size = page_size
+        self.by_path: dict[Path, RecordingMetadata] = {}
+        self.by_path_str: dict[str, RecordingMetadata] = {}
+        self.by_category: dict[str, list[RecordingMetadata]] = {}
+        self._options: dict[str, dict[str, RecordingMetadata]] | None = None
+        self._option_by_path: dict[Path, str] = {}
+        self._label_by_path: dict[Path, str] = {}
+        for meta in iterable:
+            self.append(meta)
+
+    @property
+    def path(self) -> dict[Path, RecordingMetadata]:
+        return self.by_path
+
+    @property
+    def path_str(self) -> dict[str, RecordingMetadata]:
+        return self.by_path_str
+
+    def append(self, meta: RecordingMetadata):
+        super().append(meta)
+        self.by_path[meta.path] = meta
+        self.by_path_str[meta.path_str] = meta
+        self.by_category.setdefault(meta.category, []).append(meta)
+        self._options = None
+        if not self.current:
+            self.current = meta
+
+    @property
+    def options(self) -> dict[str, dict[str, RecordingMetadata]]:
+        """
+
+        Category select options, each mapping recording labels to recordings, sorted by name.
+
+        """
+        if self._options is None:
+            self._options, self._option_by_path, self._label_by_path = {}, {}, {}
+            for category in sorted(self.by_category, key=lambda category: (category != '', category.lower())):
+                metas = sorted(self.by_category[category], key=lambda meta: meta.name.lower())
+                pages = [metas[i:i + self.page_size] for i in range(0, len(metas), self.page_size)]
+                label = category or CATEGORY_ROOT
+                for number, page in enumerate(pages, start=1):
+                    option = label if len(pages) == 1 else f'{label} ({number}/{len(pages)})'
+                    counts = Counter(meta.name for meta in page)
+                    labels = {meta.path: meta.path.name if counts[meta.name] > 1 else meta.name for meta in page}
+                    self._options[option] = {labels[meta.path]: meta for meta in page}
+                    self._option_by_path |= {meta.path: option for meta in page}
+                    self._label_by_path |= labels
+        return self._options
+
+    def get_option(self, meta: RecordingMetadata | None) -> str | None:
+        """
+
+        The category option containing `meta`, or the first option if it's not in the library.
+
+        """
+        options = self.options
+        if meta and meta.path in self._option_by_path:
+            return self._option_by_path[meta.path]
+        return next(iter(options), None)
+
+    def get_label(self, meta: RecordingMetadata) -> str:
+        """
+
+        The label of `meta` in its category option.
+
+        """
+        self.options
+        return self._label_by_path.get(meta.path, meta.name)
+
+    def get_page(self, meta: RecordingMetadata | None) -> dict[str, RecordingMetadata]:
+        """
+
+        Recordings in the same category option as `meta`, by label.
+
+        """
+        return self.options.get(self.get_option(meta), {})
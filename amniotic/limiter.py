@@ -0,0 +1,54 @@
+LIMITER_CEILING = 0.98
+LIMITER_RELEASE = 0.5
+
+
+class Limiter:
+    """
+
+    Peak limiter for the float mixing bus: the one place a mix is kept within full scale, instead of each recording and
+    then the mix being clipped along the way.
+
+    Works a block at a time. When a block would peak over `ceiling`, the gain drops straight away to exactly what brings
+    it under. Afterwards, it recovers towards unity over `release` seconds, ramped across each block so there are no
+    steps. The final clip to full scale is only a safety net, that shouldn't ever actually change a sample.
+
+    """
+
+    def __init__(self, rate: int, ceiling: float = LIMITER_CEILING, release: float = LIMITER_RELEASE):
+        self.rate = rate
+        self.ceiling = ceiling
+        self.release = release
+        self.gain = 1.0
+        self.ramp = None
+        self.scratch = None
+
+    def process(self, data):
+        """
+
+        Limit a block of float32 samples, in place.
+
+        """
+        import numpy as np
+
+        if self.ramp is None or self.ramp.size != data.size:
+            self.ramp = np.linspace(0, 1, data.size, endpoint=False, dtype=np.float32)
+            self.scratch = np.empty_like(self.ramp)
+
+        peak = max(float(data.max()), -float(data.min()))
+        target = min(self.ceiling / peak, 1.0) if peak else 1.0
+        recovery = data.size / self.rate / self.release
+
+        if target <= self.gain:
+            self.gain = target
+            if target < 1.0:
+                np.multiply(data, np.float32(target), out=data)
+        else:
+            gain = min(self.gain + recovery, target)
+            np.multiply(self.ramp, np.float32(gain - self.gain), out=self.scratch)
+            np.add(self.scratch, np.float32(self.gain), out=self.scratch)
+            np.multiply(data, self.scratch, out=data)
+            self.gain = gain
+
+        np.minimum(data, np.float32(1.0), out=data)
+        np.maximum(data, np.float32(-1.0), out=data)
+        return data
@@ -0,0 +1,118 @@
+import asyncio
+import ctypes
+import gc
+import math
+import sys
+import time
+from functools import cached_property
+from typing import Callable
+
+from amniotic.obs import logger
+
+MEMORY_BUDGET = 768
+CHECK_INTERVAL = 5.0
+TRIM_INTERVAL = 30.0
+COLLECT_INTERVAL = 60.0
+MB = 1024 ** 2
+
+
+class MemoryManager:
+    """
+
+    Keeps the process under an RSS budget (in MB), from a background task, off the audio path. Every `interval`
+    seconds, RSS is measured. When it's over budget, registered caches are evicted in the order they were registered,
+    re-measuring after each, followed by a full garbage collection and a native heap trim if that wasn't enough. A full
+    collection holds the GIL, stalling every stream, so it's done at most once every `collect_interval` seconds, rather
+    than on every check while over budget. If RSS is still over budget after all that, `is_exhausted` is set, and
+    admission refuses new streams until it isn't.
+
+    Released PyAV/NumPy allocations are also handed back to the OS every `trim_interval` seconds, over budget or not.
+    On Linux that's `malloc_trim`, which releases the GIL, so unlike a collection it doesn't stall the streams.
+
+    A budget of `None` disables everything but the periodic trim.
+
+    """
+
+    def __init__(self, budget: int | None = MEMORY_BUDGET, interval: float = CHECK_INTERVAL, trim_interval: float = TRIM_INTERVAL, collect_interval: float = COLLECT_INTERVAL):
+        self.budget = budget
+        self.interval = interval
+        self.trim_interval = trim_interval
+        self.collect_interval = collect_interval
+        self.collected_at = -math.inf
+        self.caches: dict[str, Callable[[], None]] = {}
+        self.rss = None
+        self.is_exhausted = False
+        self.trimmed_at = time.monotonic()
+
+    @cached_property
+    def libc(self):
+        if not sys.platform.startswith('linux'):
+            return None
+        libc = ctypes.CDLL(None)
+        if not hasattr(libc, 'malloc_trim'):
+            return None
+        return libc
+
+    def register(self, name: str, evict: Callable[[], None]):
+        """
+
+        Register a cache that can be dropped under memory pressure, via `evict`.
+
+        """
+        self.caches[name] = evict
+
+    def get_rss(self) -> int:
+        import psutil
+        return psutil.Process().memory_info().rss
+
+    def trim(self):
+        libc = self.libc
+        if libc:
+            libc.malloc_trim(0)
+        self.trimmed_at = time.monotonic()
+
+    def is_over(self) -> bool:
+        self.rss = self.get_rss()
+        return self.budget is not None and self.rss > self.budget * MB
+
+    def check(self):
+        """
+
+        Measure RSS and, if over budget, free what can be freed. Blocking, so run in a thread.
+
+        """
+        if not self.is_over():
+            if self.is_exhausted:
+                logger.info(f'Memory usage {self.rss / MB:.0f}MB is back under budget ({self.budget}MB).')
+            self.is_exhausted = False
+            if time.monotonic() - self.trimmed_at >= self.trim_interval:
+                self.trim()
+            return
+
+        logger.warning(f'Memory usage {self.rss / MB:.0f}MB is over budget ({self.budget}MB). Evicting caches...')
+        for name, evict in list(self.caches.items()):
+            logger.info(f'Evicting cache: {name}...')
+            evict()
+            if not self.is_over():
+                break
+        else:
+            now = time.monotonic()
+            if now - self.collected_at >= self.collect_interval:
+                gc.collect()
+                self.trim()
+                self.collected_at = now
+            else:
+                logger.debug(f'Skipping collection, as the last was {now - self.collected_at:.0f}s ago.')
+
+        is_exhausted = self.is_over()
+        if is_exhausted and not self.is_exhausted:
+            logger.warning(f'Memory usage {self.rss / MB:.0f}MB is still over budget ({self.budget}MB) after eviction. New streams will be refused.')
+        self.is_exhausted = is_exhausted
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.check)
+            except Exception:
+                logger.exception('Error in memory budget task.')
+            await asyncio.sleep(self.interval)
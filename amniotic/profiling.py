@@ -0,0 +1,112 @@
+import threading
+import time
+from dataclasses import dataclass
+
+from amniotic.obs import logger
+
+PROFILE_EVERY = 50
+PROFILE_FLUSH_INTERVAL = 30
+
+
+@dataclass
+class StageStats:
+    """
+
+    Aggregated timings for a single pipeline stage.
+
+    """
+    count: int = 0
+    total_ns: int = 0
+    max_ns: int = 0
+
+    def add(self, duration_ns: int):
+        self.count += 1
+        self.total_ns += duration_ns
+        if duration_ns > self.max_ns:
+            self.max_ns = duration_ns
+
+    @property
+    def mean_ms(self) -> float:
+        if not self.count:
+            return 0.0
+        return self.total_ns / self.count / 1e6
+
+    @property
+    def max_ms(self) -> float:
+        return self.max_ns / 1e6
+
+
+class Profiler:
+    """
+
+    Sampled per-stage timing for the audio hot path (decode, resample, mix, encode).
+
+    Only one iteration in `every` is timed, and only while enabled, so the cost when switched off is a single attribute
+    check per chunk. Timings are aggregated per stage and flushed to the logger as spans every `flush_interval` seconds.
+
+    Usage in a loop:
+
+        sampled = profiler.is_sampled(i)
+        if sampled:
+            started = time.perf_counter_ns()
+        ...
+        if sampled:
+            started = profiler.record('decode', started)
+
+    """
+
+    def __init__(self, every: int = PROFILE_EVERY, flush_interval: float = PROFILE_FLUSH_INTERVAL):
+        self.every = every
+        self.flush_interval = flush_interval
+        self.is_enabled = False
+        self.stats: dict[str, StageStats] = {}
+        self.flushed_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def is_sampled(self, i: int) -> bool:
+        return self.is_enabled and i % self.every == 0
+
+    def record(self, stage: str, started_ns: int) -> int:
+        """
+
+        Record the time elapsed since `started_ns` against `stage`. Returns the current counter, so consecutive stages can be chained.
+
+        """
+        now_ns = time.perf_counter_ns()
+        flushed = None
+
+        with self._lock:
+            stats = self.stats.get(stage)
+            if stats is None:
+                stats = self.stats[stage] = StageStats()
+            stats.add(now_ns - started_ns)
+
+            now = time.monotonic()
+            if now - self.flushed_at >= self.flush_interval:
+                flushed, self.stats, self.flushed_at = self.stats, {}, now
+
+        if flushed:
+            self.flush(flushed)
+
+        return time.perf_counter_ns()
+
+    def flush(self, stats: dict[str, StageStats]):
+        for stage, stat in sorted(stats.items()):
+            with logger.span(
+                    f'Profiled stage "{stage}": samples={stat.count} mean={stat.mean_ms:.3f}ms max={stat.max_ms:.3f}ms',
+                    stage=stage,
+                    samples=stat.count,
+                    mean_ms=stat.mean_ms,
+                    max_ms=stat.max_ms,
+            ):
+                pass
+
+    def set_enabled(self, value: bool):
+        with self._lock:
+            self.is_enabled = bool(value)
+            self.stats = {}
+            self.flushed_at = time.monotonic()
+        logger.info(f'Stream profiling {"enabled" if self.is_enabled else "disabled"}. Sampling one chunk in {self.every}.')
+
+
+profiler = Profiler()
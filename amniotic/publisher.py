@@ -0,0 +1,50 @@
+import asyncio
+from typing import Any, Awaitable, Callable
+
+from amniotic.obs import logger
+
+
+class StatePublisher:
+    """
+
+    Coalescing, diff-only publisher for retained MQTT messages (control states and discovery announcements).
+
+    A single command can cascade through several controls' `state` methods, each re-publishing the same values. Instead,
+    publishes are queued, the latest value per topic wins, and the queue is flushed once, on the next event loop tick.
+    Anything identical to the last value published on that topic is skipped. Because the messages are retained, the
+    broker still holds the skipped value. Call `reset` whenever the broker connection is re-established.
+
+    """
+
+    def __init__(self, publish: Callable[..., Awaitable]):
+        self._publish = publish
+        self.published: dict[str, Any] = {}
+        self.pending: dict[str, tuple[Any, int]] = {}
+        self.flush_task: asyncio.Task | None = None
+
+    async def publish(self, topic, payload, qos: int = 0):
+        self.pending[str(topic)] = (payload, qos)
+        if not self.flush_task or self.flush_task.done():
+            self.flush_task = asyncio.create_task(self.flush())
+
+    async def flush(self):
+        # Let the rest of the current cascade queue its publishes first.
+        await asyncio.sleep(0)
+
+        while self.pending:
+            pending, self.pending = self.pending, {}
+            count = 0
+            for topic, (payload, qos) in pending.items():
+                if topic in self.published and self.published[topic] == payload:
+                    continue
+                try:
+                    await self._publish(topic, payload, qos=qos, retain=True)
+                except Exception:
+                    logger.exception(f'Error publishing to "{topic}".')
+                    continue
+                self.published[topic] = payload
+                count += 1
+            logger.debug(f'Flushed {count} of {len(pending)} queued retained message(s). Skipped {len(pending) - count} unchanged.')
+
+    def reset(self):
+        self.published.clear()
@@ -0,0 +1,116 @@
+import math
+import statistics
+import time
+from dataclasses import dataclass
+from functools import cached_property
+from typing import Iterable
+
+from amniotic.obs import logger
+
+LAG_LIMIT = 0.1
+HOLD = 10.0
+RECOVER_AFTER = 60.0
+CHECK_INTERVAL = 2.0
+
+
+@dataclass(frozen=True)
+class QualityLevel:
+    """
+
+    One step of degradation. `compression_level` is LAME's speed/quality trade-off, from 0 (best, slowest) to 9, with
+    `None` meaning the encoder default. `block_duration` is a minimum block duration, in milliseconds (see
+    `get_block_size`): larger blocks cut the per-block overhead, at the cost of latency.
+
+    """
+    name: str
+    compression_level: int | None = None
+    block_duration: int | None = None
+
+
+QUALITY_LEVELS = (
+    QualityLevel('Full'),
+    QualityLevel('Fast Encoder', compression_level=7),
+    QualityLevel('Fast Encoder, 100ms Blocks', compression_level=7, block_duration=100),
+    QualityLevel('Fast Encoder, 250ms Blocks', compression_level=7, block_duration=250),
+)
+
+
+class QualityController:
+    """
+
+    Degrades stream quality in steps when the box can't keep up, and restores it once it can.
+
+    Headroom is how far ahead of real-time the median live stream is, in seconds. It's only negative when most streams
+    are falling behind together, i.e. the box is overloaded. It's the median, rather than the furthest-behind stream,
+    so that one client on a poor link, or bursting to catch up after backpressure, doesn't cost every listener quality.
+    Once headroom drops below `-lag_limit`, quality steps down a level, at most once every `hold` seconds, so each step
+    has time to take effect. It steps back up a level after `recover_after` seconds without headroom dropping again.
+
+    Streams read `level` when they start, and again at every block, so a cheaper encoder applies to them straight away,
+    while larger blocks only apply to new streams. The level and headroom are also published as metrics.
+
+    """
+
+    def __init__(self, levels: tuple[QualityLevel, ...] = QUALITY_LEVELS, lag_limit: float = LAG_LIMIT, hold: float = HOLD, recover_after: float = RECOVER_AFTER,
+                 interval: float = CHECK_INTERVAL, clock=time.monotonic):
+        self.levels = levels
+        self.lag_limit = lag_limit
+        self.hold = hold
+        self.recover_after = recover_after
+        self.interval = interval
+        self.clock = clock
+        self.index = 0
+        self.changed_at = -math.inf
+        self.healthy_since = None
+        self.headroom = None
+
+    @property
+    def level(self) -> QualityLevel:
+        return self.levels[self.index]
+
+    def get_headroom(self, streams: Iterable) -> float | None:
+        aheads = [stream.ahead for stream in streams if stream.chunks_sent]
+        return statistics.median(aheads) if aheads else None
+
+    def update(self, streams: Iterable) -> bool:
+        """
+
+        Take a headroom reading across `streams`, and step the level if need be. Returns whether it changed.
+
+        """
+        now = self.clock()
+        self.headroom = self.get_headroom(streams)
+        index = self.index
+
+        if self.headroom is not None and self.headroom < -self.lag_limit:
+            self.healthy_since = None
+            if self.index < len(self.levels) - 1 and now - self.changed_at >= self.hold:
+                self.index += 1
+        else:
+            if self.healthy_since is None:
+                self.healthy_since = now
+            if self.index > 0 and now - self.healthy_since >= self.recover_after:
+                self.index -= 1
+                self.healthy_since = now
+
+        self.publish()
+        if self.index == index:
+            return False
+
+        self.changed_at = now
+        change = 'Degrading' if self.index > index else 'Restoring'
+        logger.warning(f'{change} stream quality to level {self.index} "{self.level.name}". Headroom: {self.headroom}s.')
+        return True
+
+    @cached_property
+    def gauge_level(self):
+        return logger.metric_gauge('amniotic.stream.quality_level', description='Stream quality degradation step (0 is full quality).')
+
+    @cached_property
+    def gauge_headroom(self):
+        return logger.metric_gauge('amniotic.stream.headroom', unit='s', description='How far ahead of real-time the median stream is.')
+
+    def publish(self):
+        self.gauge_level.set(self.index)
+        if self.headroom is not None:
+            self.gauge_headroom.set(self.headroom)
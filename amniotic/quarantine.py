@@ -0,0 +1,94 @@
+import threading
+import time
+from dataclasses import dataclass
+
+from amniotic.obs import logger
+from corio import Path
+
+BACKOFF_INITIAL = 60.0
+BACKOFF_MAX = 24 * 60 * 60.0
+
+
+@dataclass
+class Failure:
+    """
+
+    A recording that couldn't be decoded, and when it's next worth trying again.
+
+    """
+    error: str
+    mtime: float | None
+    failures: int
+    retry_at: float
+
+    @property
+    def backoff(self) -> float:
+        return max(self.retry_at - time.monotonic(), 0.0)
+
+
+class Quarantine:
+    """
+
+    Negative cache of recordings that failed to decode, so streams skip them (mixing in silence) rather than probing a
+    bad file over and over. Each further failure doubles how long a recording is skipped for, from `initial` up to
+    `maximum`. Replacing the file on disk (a new mtime) lifts it straight away.
+
+    Checked by every live stream, on every chunk, from their own threads, so lookups are a single dict access when
+    nothing has failed, and the (rare) updates take a lock.
+
+    """
+
+    def __init__(self, initial: float = BACKOFF_INITIAL, maximum: float = BACKOFF_MAX):
+        self.initial = initial
+        self.maximum = maximum
+        self.failures: dict[Path, Failure] = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_mtime(path: Path) -> float | None:
+        try:
+            return Path(path).stat().st_mtime
+        except OSError:
+            return None
+
+    def add(self, path: Path, exception: BaseException) -> Failure:
+        with self.lock:
+            failure = self.failures.get(path)
+            mtime = self.get_mtime(path)
+            count = failure.failures + 1 if failure and failure.mtime == mtime else 1
+            backoff = min(self.initial * 2 ** (count - 1), self.maximum)
+            failure = Failure(error=f'{type(exception).__name__}: {exception}', mtime=mtime, failures=count, retry_at=time.monotonic() + backoff)
+            self.failures[path] = failure
+
+        logger.warning(f'Could not decode "{path}" ({failure.error}). Skipping it for {backoff:.0f}s (failure #{count}).')
+        return failure
+
+    def is_blocked(self, path: Path) -> bool:
+        """
+
+        Whether `path` is still backing off. Only then is it worth a `stat`, to notice a replaced file.
+
+        """
+        failure = self.failures.get(path)
+        if not failure or time.monotonic() >= failure.retry_at:
+            return False
+        if self.get_mtime(path) != failure.mtime:
+            self.remove(path)
+            return False
+        return True
+
+    def remove(self, path: Path):
+        with self.lock:
+            self.failures.pop(path, None)
+
+    def get_status(self) -> dict[str, dict]:
+        return {
+            str(path): dict(error=failure.error, failures=failure.failures, retry_in=round(failure.backoff))
+            for path, failure in list(self.failures.items())
+        }
+
+    def __len__(self):
+        return len(self.failures)
+
+
+quarantine = Quarantine()
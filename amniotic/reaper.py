@@ -0,0 +1,83 @@
+from __future__ import annotations
+
+import time
+import typing
+from typing import Iterable
+
+if typing.TYPE_CHECKING:
+    from amniotic.theme import ThemeStream
+
+IDLE_SILENCE = 30
+IDLE_DISABLED = 10
+REAP_INTERVAL = 30.0
+REAP_GRACE = 60.0
+
+
+class Reaper:
+    """
+
+    Finds streams nobody can be listening to, so they can be stopped instead of decoding and encoding all night. A
+    stream is idle once either of the following has gone on for long enough (in minutes):
+
+    - `silence`: It hasn't sent a block with any sound in it. That covers mixes of nothing, and players that have
+      paused but kept the connection open, and so stopped reading.
+    - `disabled`: Its theme has had no recordings enabled.
+
+    Either set to `None` is disabled. Idle streams are told to stop, which they do at their next block. A stream whose
+    player has stopped reading has no next block, so `grace` seconds later, its response is cancelled and the stream
+    released from the event loop instead (see `StreamResponse`).
+
+    With `stop_player`, the media player of an idle channel stream (see `Channel`) is also stopped via Home Assistant,
+    rather than it being left to reconnect.
+
+    """
+
+    def __init__(self, silence: int | None = IDLE_SILENCE, disabled: int | None = IDLE_DISABLED, stop_player: bool = False, interval: float = REAP_INTERVAL, grace: float = REAP_GRACE,
+                 clock=time.monotonic):
+        self.silence = silence
+        self.disabled = disabled
+        self.stop_player = stop_player
+        self.interval = interval
+        self.grace = grace
+        self.clock = clock
+        self.disabled_since: dict[ThemeStream, float] = {}
+
+    def get_reason(self, stream: ThemeStream) -> str | None:
+        """
+
+        Why `stream` is idle, or None if it isn't.
+
+        """
+        now = self.clock()
+
+        if self.disabled is not None:
+            if stream.is_enabled:
+                self.disabled_since.pop(stream, None)
+            else:
+                since = self.disabled_since.setdefault(stream, now)
+                if now - since >= self.disabled * 60:
+                    return f'Theme "{stream.theme_def.name}" has had no recordings enabled for {self.disabled} minutes.'
+
+        if self.silence is not None and now - stream.heard_at >= self.silence * 60:
+            return f'No sound sent for {self.silence} minutes.'
+
+        return None
+
+    def check(self, streams: Iterable[ThemeStream]) -> list[tuple[ThemeStream, str]]:
+        """
+
+        Idle streams, with why, among `streams`, which should be all the live ones.
+
+        """
+        streams = list(streams)
+        for stream in set(self.disabled_since) - set(streams):
+            del self.disabled_since[stream]
+
+        idle = []
+        for stream in streams:
+            if stream.stop_reason:
+                continue
+            reason = self.get_reason(stream)
+            if reason:
+                idle.append((stream, reason))
+        return idle
@@ -1,16 +1,17 @@
 from __future__ import annotations
 
-import ctypes
-import gc
-import sys
+import itertools
+import random
 import threading
 import time
 import typing
-
-import numpy as np
+import weakref
 
 from amniotic.obs import logger
-from corio import av, dt
+from amniotic.profiling import profiler
+from amniotic.quarantine import quarantine
+from amniotic.renditions import RenditionMetadata, get_path_rendition, is_rendition_current, read_metadata
+from corio import dt
 from corio.constants import Constants
 from haco.base import Base
 from pydantic import Field
@@ -22,30 +23,6 @@ else:
     AmnioticRef = object
 
 LOG_THRESHOLD = 500
-HEAP_TRIM_INTERVAL = 30
-_heap_trim_lock = threading.Lock()
-_heap_trim_last = 0.0
-_libc = ctypes.CDLL(None) if sys.platform.startswith('linux') else None
-
-
-def trim_native_heap():
-    """Periodically return released PyAV/NumPy allocations to the OS on Linux."""
-    global _heap_trim_last
-
-    if _libc is None or not hasattr(_libc, 'malloc_trim'):
-        return
-
-    now = time.monotonic()
-    if now - _heap_trim_last < HEAP_TRIM_INTERVAL:
-        return
-
-    with _heap_trim_lock:
-        now = time.monotonic()
-        if now - _heap_trim_last < HEAP_TRIM_INTERVAL:
-            return
-        gc.collect()
-        _libc.malloc_trim(0)
-        _heap_trim_last = now
 
 
 class RecordingMetadata:
@@ -55,8 +32,9 @@ class RecordingMetadata:
 
     """
 
-    def __init__(self, path):
+    def __init__(self, path, category: str = ''):
         self.path = path
+        self.category = category
 
     def get_instance(self, device: 'Amniotic'):
         return RecordingThemeInstance(device=device, path=self.path_str)
@@ -94,6 +72,7 @@ class RecordingThemeInstance(Base):
     path: str
     volume: float = 0.2
     is_enabled: bool = False
+    offset: int | None = None
 
     @property
     def meta(self):
@@ -115,17 +94,32 @@ class RecordingThemeStream:
 
     """
     CHUNK_SIZE = 1_024
+    RING_SIZE = 2
     SAMPLE_RATE = 44_100
-
-    def __init__(self, instance: RecordingThemeInstance):
+    is_rendition = False
+    gain = 1.0
+    position = None
+    is_failed = False
+    is_float = False
+    live = weakref.WeakSet()
+    live_lock = threading.Lock()
+
+    def __init__(self, instance: RecordingThemeInstance, chunk_size: int | None = None, is_float: bool = False):
         self.instance = instance
+        if chunk_size:
+            self.CHUNK_SIZE = chunk_size
+        self.is_float = is_float
+        with self.live_lock:
+            self.live.add(self)
         self.started_at = dt.now()
         self.started_at_str = self.started_at.strftime(Constants.DATETIME_FILENAME_FORMAT)
-        self.resampler = av.AudioResampler(format='s16', layout='mono', rate=self.SAMPLE_RATE)
+        from corio import av
+        self.resampler = av.AudioResampler(format=self.sample_format, layout='mono', rate=self.SAMPLE_RATE)
         self.chunks = self.iter_chunks()
 
         self.container = None
         self.stream = None
+        self.chunks_yielded = 0
         self._is_closed = False
         logger.info(f'Initialized {repr(self)} for path="{self.instance.path}"')
 
@@ -133,19 +127,116 @@ class RecordingThemeStream:
     def name(self):
         return self.instance.name
 
+    @property
+    def sample_format(self) -> str:
+        """
+
+        Samples are 16-bit, or 32-bit float on a float bus (see `ThemeStream`).
+
+        """
+        return 'flt' if self.is_float else 's16'
+
+    @property
+    def dtype(self):
+        import numpy as np
+        return np.float32 if self.is_float else np.int16
+
+    def get_path(self):
+        """
+
+        The recording's rendition if it's been transcoded (see `amniotic.renditions`), otherwise the original.
+
+        """
+        path = self.instance.meta.path
+        if is_rendition_current(path):
+            return get_path_rendition(path)
+        return path
+
+    def get_gain(self, rendition: RenditionMetadata | None) -> float:
+        """
+
+        Loudness normalisation gain, measured at ingest. Only renditions have been measured, so originals are left as they are.
+
+        """
+        if not rendition:
+            return 1.0
+        loudness = rendition.loudness
+        logger.info(f'{repr(self)}: Normalising {loudness.loudness:.1f} LUFS by {loudness.gain_db:+.1f} dB.')
+        return loudness.gain
+
+    def get_offset(self, rendition: RenditionMetadata) -> int:
+        """
+
+        Where to start playing. Resumes where the last stream of this recording left off, unless another stream of it is
+        already playing, in which case a random start keeps the two from sounding phase-identical.
+
+        """
+        samples = rendition.seek.samples
+        offset = self.instance.offset
+        # Snapshotted, as other streams are started and closed on other threads.
+        with self.live_lock:
+            streams = list(self.live)
+        if any(stream is not self and stream.instance is self.instance and not stream._is_closed for stream in streams):
+            offset = None
+        if offset is None or not 0 <= offset < samples:
+            offset = random.randrange(samples) if samples else 0
+        return offset
+
+    def seek(self, rendition: RenditionMetadata) -> int:
+        """
+
+        Jump straight to the packet containing the start offset, by its byte position in the seek table. Returns the
+        sample offset decoding actually starts from.
+
+        """
+        if not rendition.seek.offsets:
+            return 0
+        offset, position = rendition.seek.find(self.get_offset(rendition))
+        if offset:
+            self.container.seek(position, unsupported_byte_offset=True)
+        logger.info(f'{repr(self)}: Starting at sample {offset} of {rendition.seek.samples}.')
+        return offset
+
     def iter_samples(self):
-        while True:
-            self.container = av.open(self.instance.meta.path)
+        import numpy as np
+        from corio import av
+
+        for loop in itertools.count():
+            path = self.get_path()
+            self.is_rendition = path != self.instance.meta.path
+            rendition = read_metadata(self.instance.meta.path) if self.is_rendition else None
+            self.gain = self.get_gain(rendition)
+            self.container = av.open(str(path))
 
             try:
                 if len(self.container.streams.audio) == 0:
                     raise ValueError(f'{repr(self)}. File has no audio stream.')
                 self.stream = next(iter(self.container.streams.audio))
 
+                if rendition:
+                    # Only the first pass starts part way through. Looping always starts from the top.
+                    self.position = self.seek(rendition) if loop == 0 else 0
+                else:
+                    self.position = None
+
                 with logger.span(f'Started transcoding: {repr(self)}'):
                     logger.info(self.description)
 
-                for frame_orig in self.container.decode(self.stream):
+                frames = self.container.decode(self.stream)
+                is_decoded = False
+                for i in itertools.count():
+                    sampled = profiler.is_sampled(i)
+                    if sampled:
+                        started = time.perf_counter_ns()
+
+                    frame_orig = next(frames, None)
+                    if frame_orig is None:
+                        break
+                    is_decoded = True
+
+                    if sampled:
+                        started = profiler.record('decode', started)
+
                     data_orig = frame_orig.to_ndarray()
                     source_dtype = data_orig.dtype
                     if data_orig.shape[0] > 1:
@@ -153,48 +244,113 @@ class RecordingThemeStream:
                     else:
                         data_orig = data_orig.reshape(1, -1)
 
-                    if np.issubdtype(source_dtype, np.floating):
+                    volume = self.instance.volume * self.gain
+                    if self.is_float:
+                        # Volume is applied in the same step as any conversion to float, and nothing is clipped, as
+                        # that's left to the limiter at the end of the bus.
+                        if np.issubdtype(source_dtype, np.floating):
+                            data_orig = data_orig.astype(np.float32, copy=False)
+                            data_orig *= np.float32(volume)
+                        else:
+                            data_orig = data_orig * np.float32(volume / -np.iinfo(source_dtype).min)
+                    elif np.issubdtype(source_dtype, np.floating):
                         data_orig = data_orig.astype(np.float32, copy=False)
-                        data_orig *= self.instance.volume
+                        data_orig *= volume
                         np.clip(data_orig, -1.0, 1.0, out=data_orig)
                         data_orig = (data_orig * np.iinfo(np.int16).max).astype(np.int16)
+                    elif volume > 1:
+                        # Scaling up in place would wrap around, not clip.
+                        data_orig = data_orig * np.float32(volume)
+                        np.clip(data_orig, np.iinfo(np.int16).min, np.iinfo(np.int16).max, out=data_orig)
+                        data_orig = data_orig.astype(np.int16)
                     else:
-                        np.multiply(data_orig, self.instance.volume, out=data_orig, casting='unsafe')
+                        np.multiply(data_orig, volume, out=data_orig, casting='unsafe')
                         np.clip(data_orig, np.iinfo(np.int16).min, np.iinfo(np.int16).max, out=data_orig)
                         data_orig = data_orig.astype(np.int16, copy=False)
-                    frame_mono = av.AudioFrame.from_ndarray(data_orig, format='s16', layout='mono')
+
+                    if self.is_rendition:
+                        # Already mono and at the output rate, so there's nothing to resample.
+                        if sampled:
+                            profiler.record('resample', started)
+                        if self.position is not None:
+                            self.position += data_orig.size
+                        yield data_orig.reshape(-1)
+                        continue
+
+                    frame_mono = av.AudioFrame.from_ndarray(data_orig, format=self.sample_format, layout='mono')
                     frame_mono.rate = self.stream.codec_context.rate
-                    for frame_resamp in self.resampler.resample(frame_mono):
+                    frames_resamp = self.resampler.resample(frame_mono)
+
+                    if sampled:
+                        profiler.record('resample', started)
+
+                    for frame_resamp in frames_resamp:
                         yield frame_resamp.to_ndarray().reshape(-1)
+
+                if not is_decoded:
+                    # Otherwise an empty file would be reopened in a tight loop.
+                    raise ValueError(f'{repr(self)}. No audio could be decoded.')
+                if self.instance.meta.path in quarantine.failures:
+                    quarantine.remove(self.instance.meta.path)
             finally:
                 self._close_container()
 
     def iter_chunks(self):
+        """
+
+        Split sample blocks into fixed-size chunks, without copying them where possible.
+
+        Chunks that fall entirely within a block are handed out as views into it. Only the samples of a chunk that
+        straddles two blocks are copied, into a small ring of chunk buffers, and each sample is still only written once.
+
+        Ownership: every chunk is a read-only view, valid until the next chunk is requested. A consumer that needs one
+        for any longer must copy it.
+
+        """
+        import numpy as np
+
+        def view(data):
+            data = data.reshape(1, -1)
+            data.flags.writeable = False
+            return data
+
         sample_blocks = self.iter_samples()
-        buffer = np.empty(self.CHUNK_SIZE, dtype=np.int16)
+        ring = np.empty((self.RING_SIZE, self.CHUNK_SIZE), dtype=self.dtype)
+        slot = 0
         buffered = 0
         i = 0
         try:
             for block in sample_blocks:
                 offset = 0
-                while offset < block.size:
-                    copied = min(self.CHUNK_SIZE - buffered, block.size - offset)
-                    buffer[buffered:buffered + copied] = block[offset:offset + copied]
-                    buffered += copied
-                    offset += copied
-
-                    if buffered < self.CHUNK_SIZE:
-                        continue
+                chunks = []
 
-                    data = buffer.copy().reshape(1, -1)
-                    buffered = 0
+                if buffered:
+                    copied = min(self.CHUNK_SIZE - buffered, block.size)
+                    ring[slot, buffered:buffered + copied] = block[:copied]
+                    buffered += copied
+                    offset = copied
+                    if buffered == self.CHUNK_SIZE:
+                        chunks.append(ring[slot])
+                        slot = (slot + 1) % self.RING_SIZE
+                        buffered = 0
+
+                while block.size - offset >= self.CHUNK_SIZE:
+                    chunks.append(block[offset:offset + self.CHUNK_SIZE])
+                    offset += self.CHUNK_SIZE
+
+                if offset < block.size:
+                    buffered = block.size - offset
+                    ring[slot, :buffered] = block[offset:]
+
+                for data in chunks:
+                    data = view(data)
                     yield data
 
                     if i % LOG_THRESHOLD == 0:
-                        trim_native_heap()
                         vol_rms = round(float(np.sqrt((data.astype(np.float32) ** 2).mean())), 2)
                         logger.info(f'{repr(self)}: Yielding chunk #{i} {data.shape=}, {vol_rms=}')
                     i += 1
+                    self.chunks_yielded = i
         finally:
             sample_blocks.close()
 
@@ -204,12 +360,21 @@ class RecordingThemeStream:
     def __next__(self):
         """
 
-
+        Next chunk. If the recording can't be decoded, it's quarantined (see `amniotic.quarantine`) and this stream fails
+        with a chunk of silence, rather than taking the whole theme stream down with it.
 
         """
         if self.chunks is None:
             raise StopIteration
-        return next(self.chunks)
+        try:
+            return next(self.chunks)
+        except Exception as exception:
+            quarantine.add(self.instance.meta.path, exception)
+            self.is_failed = True
+            self.position = None
+            self.close()
+            import numpy as np
+            return np.zeros((1, self.CHUNK_SIZE), self.dtype)
 
     def _close_container(self):
         container = self.container
@@ -227,8 +392,13 @@ class RecordingThemeStream:
             logger.debug(f'{repr(self)}: close() called, already closed.')
             return
         self._is_closed = True
+        with self.live_lock:
+            self.live.discard(self)
         logger.info(f'{repr(self)}: Closing recording stream...')
 
+        if self.position is not None:
+            self.instance.offset = self.position
+
         chunks = self.chunks
         self.chunks = None
         if chunks is not None:
@@ -243,6 +413,24 @@ class RecordingThemeStream:
         self._close_container()
         logger.info(f'{repr(self)}: Recording stream closed.')
 
+    def get_status(self) -> dict:
+        """
+
+        Snapshot of this stream's state, for debugging live streams.
+
+        """
+        return dict(
+            name=self.name,
+            path=self.instance.path,
+            is_rendition=self.is_rendition,
+            is_failed=self.is_failed,
+            position=self.position,
+            started_at=self.started_at.isoformat(),
+            chunks=self.chunks_yielded,
+            is_open=self.container is not None,
+            is_closed=self._is_closed,
+        )
+
     @property
     def description(self):
         desc = f'Container: {self.container.format.long_name}. Codec: {self.stream.codec_context.codec.long_name}. Layout: {self.stream.codec_context.layout.name}. Rate: {self.stream.codec_context.rate}'
@@ -0,0 +1,330 @@
+import asyncio
+import bisect
+import json
+import math
+import multiprocessing
+from concurrent.futures import Executor, ProcessPoolExecutor
+from dataclasses import dataclass, asdict
+from functools import cached_property, lru_cache
+from typing import Awaitable, Callable, Iterable
+
+from amniotic.obs import logger
+from amniotic.throttle import Throttle
+from corio import Path
+
+RENDITIONS_DIR = '.renditions'
+RENDITION_SUFFIX = '.flac'
+RENDITION_CODEC = 'flac'
+RENDITION_FORMAT = 's16'
+RENDITION_LAYOUT = 'mono'
+RENDITION_RATE = 44_100
+RENDITION_VERSION = 2
+METADATA_SUFFIX = '.json'
+
+LOUDNESS_TARGET = -18.0
+PEAK_CEILING = -1.0
+GAIN_MAX = 12.0
+
+TRANSCODE_WORKERS = 1
+PROGRESS_INTERVAL = 1.0
+
+
+def get_path_rendition(path: Path) -> Path:
+    """
+
+    Renditions live in a hidden directory next to their original, named after the full original filename, so "a.mp3" and "a.wav" don't collide.
+
+    """
+    path = Path(path)
+    return path.parent / RENDITIONS_DIR / f'{path.name}{RENDITION_SUFFIX}'
+
+
+def get_path_metadata(path: Path) -> Path:
+    path_rendition = get_path_rendition(path)
+    return path_rendition.with_name(f'{path_rendition.name}{METADATA_SUFFIX}')
+
+
+def is_rendition_current(path: Path) -> bool:
+    """
+
+    Whether the rendition is newer than its original and has metadata from the current `RENDITION_VERSION`, so renditions
+    from older versions are transcoded again.
+
+    """
+    path_rendition = get_path_rendition(path)
+    try:
+        if path_rendition.stat().st_mtime < Path(path).stat().st_mtime:
+            return False
+    except FileNotFoundError:
+        return False
+    return read_metadata(path) is not None
+
+
+@dataclass
+class Loudness:
+    """
+
+    EBU R128 integrated loudness (LUFS) and true peak (linear) of a rendition, measured once at ingest.
+
+    """
+    loudness: float
+    peak: float
+
+    @property
+    def gain_db(self) -> float:
+        """
+
+        Gain that brings the recording to `LOUDNESS_TARGET`, without pushing its true peak over `PEAK_CEILING`.
+
+        """
+        gain = LOUDNESS_TARGET - self.loudness
+        if self.peak > 0:
+            gain = min(gain, PEAK_CEILING - 20 * math.log10(self.peak))
+        return min(gain, GAIN_MAX)
+
+    @property
+    def gain(self) -> float:
+        return 10 ** (self.gain_db / 20)
+
+
+@dataclass
+class SeekTable:
+    """
+
+    Sample offset and byte position of every packet in a rendition, built once at ingest, so a stream can start
+    anywhere in it by seeking straight to a packet, rather than decoding from the start and discarding up to the offset.
+
+    """
+    offsets: list[int]
+    positions: list[int]
+    samples: int
+
+    def find(self, offset: int) -> tuple[int, int]:
+        """
+
+        Sample offset and byte position of the packet containing sample `offset`.
+
+        """
+        index = max(bisect.bisect_right(self.offsets, offset) - 1, 0)
+        return self.offsets[index], self.positions[index]
+
+
+@dataclass
+class RenditionMetadata:
+    """
+
+    Everything measured about a rendition at ingest, stored as JSON alongside it.
+
+    """
+    loudness: Loudness
+    seek: SeekTable
+
+    def to_data(self) -> dict:
+        return dict(version=RENDITION_VERSION, loudness=asdict(self.loudness), seek=asdict(self.seek))
+
+    @classmethod
+    def from_data(cls, data: dict) -> 'RenditionMetadata':
+        return cls(loudness=Loudness(**data['loudness']), seek=SeekTable(**data['seek']))
+
+
+def read_metadata(path: Path) -> RenditionMetadata | None:
+    """
+
+    Metadata for the rendition of `path`, or `None` if it's missing or from an older version. Parsed once per change
+    to the file, as seek tables for long recordings aren't small.
+
+    """
+    path_metadata = get_path_metadata(path)
+    try:
+        mtime = path_metadata.stat().st_mtime_ns
+    except FileNotFoundError:
+        return None
+    return _read_metadata(str(path_metadata), mtime)
+
+
+def clear_metadata_cache():
+    _read_metadata.cache_clear()
+
+
+@lru_cache(maxsize=256)
+def _read_metadata(path_metadata: str, mtime: int) -> RenditionMetadata | None:
+    try:
+        data = json.loads(Path(path_metadata).read_text())
+        if data.get('version') != RENDITION_VERSION:
+            return None
+        return RenditionMetadata.from_data(data)
+    except (FileNotFoundError, ValueError, TypeError, KeyError):
+        return None
+
+
+def build_seek_table(path_rendition: Path) -> SeekTable:
+    """
+
+    Index every packet of a rendition by demuxing it, which reads packet headers without decoding any audio.
+
+    """
+    from corio import av
+
+    offsets, positions, samples = [], [], 0
+    with av.open(str(path_rendition)) as container:
+        for packet in container.demux(container.streams.audio[0]):
+            if packet.pts is None or packet.pos is None or packet.pos < 0:
+                continue
+            offsets.append(packet.pts)
+            positions.append(packet.pos)
+            samples = packet.pts + packet.duration
+    return SeekTable(offsets=offsets, positions=positions, samples=samples)
+
+
+def transcode(path: str, path_rendition: str) -> str:
+    """
+
+    Decode `path` and write it as mono, 44.1kHz, 16-bit FLAC to `path_rendition`, measuring its loudness on the way
+    through (FFmpeg's `ebur128` filter) and then indexing its packets (see `SeekTable`) into a JSON file alongside. Runs in a worker process, so takes and returns plain
+    strings. The rendition is written to a temporary file first, so a half-finished one is never picked up by a stream.
+
+    """
+    from corio import av
+    from av.filter import Graph
+
+    path_rendition = Path(path_rendition)
+    path_rendition.parent.mkdir(parents=True, exist_ok=True)
+    path_temp = path_rendition.with_name(f'.{path_rendition.name}.tmp')
+
+    resampler = av.AudioResampler(format=RENDITION_FORMAT, layout=RENDITION_LAYOUT, rate=RENDITION_RATE)
+
+    try:
+        with av.open(path) as input, av.open(str(path_temp), mode='w', format=RENDITION_CODEC) as output:
+            if not input.streams.audio:
+                raise ValueError(f'File has no audio stream: "{path}"')
+            stream_in = input.streams.audio[0]
+            stream_out = output.add_stream(codec_name=RENDITION_CODEC, rate=RENDITION_RATE, layout=RENDITION_LAYOUT, format=RENDITION_FORMAT)
+
+            graph = Graph()
+            meter = graph.add('ebur128', 'peak=true:metadata=1')
+            graph.add_abuffer(format=RENDITION_FORMAT, layout=RENDITION_LAYOUT, sample_rate=RENDITION_RATE, time_base=stream_out.time_base).link_to(meter)
+            meter.link_to(graph.add('abuffersink'))
+            graph.configure()
+            metadata = {}
+
+            def write(frames_resamp):
+                nonlocal metadata
+                for frame_resamp in frames_resamp:
+                    output.mux(stream_out.encode(frame_resamp))
+                    graph.push(frame_resamp)
+                    while True:
+                        try:
+                            metadata = graph.pull().metadata
+                        except (BlockingIOError, EOFError):
+                            break
+
+            for frame in input.decode(stream_in):
+                frame.pts = None
+                write(resampler.resample(frame))
+            write(resampler.resample(None))
+            output.mux(stream_out.encode(None))
+
+        loudness = Loudness(loudness=float(metadata['lavfi.r128.I']), peak=float(metadata['lavfi.r128.true_peak']))
+        rendition = RenditionMetadata(loudness=loudness, seek=build_seek_table(path_temp))
+        get_path_metadata(path).write_text(json.dumps(rendition.to_data()))
+        path_temp.replace(path_rendition)
+    finally:
+        path_temp.unlink(missing_ok=True)
+
+    return str(path_rendition)
+
+
+class Transcoder:
+    """
+
+    Transcodes recordings into canonical renditions (see `transcode`) in a background process pool, so streams only ever
+    decode cheap, already-resampled mono audio. Anything already current, in flight or that has failed is skipped.
+    Progress is handed to `on_progress`, throttled, with `status` and `percentage` describing the current batch.
+
+    """
+
+    def __init__(self, on_progress: Callable[[], Awaitable], workers: int = TRANSCODE_WORKERS, progress_interval: float = PROGRESS_INTERVAL):
+        self.on_progress = on_progress
+        self.workers = max(workers, 1)
+        self.throttle = Throttle(interval=progress_interval)
+        self.pending: dict[Path, asyncio.Future] = {}
+        self.failed: set[Path] = set()
+        self.batch_total = 0
+        self.batch_done = 0
+
+    @cached_property
+    def executor(self) -> Executor:
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+
+    async def ingest(self, paths: Iterable[Path]):
+        """
+
+        Transcode any of `paths` without a current rendition. Returns once all of them are done.
+
+        """
+        paths = [path for path in paths if path not in self.pending and path not in self.failed]
+        paths = await asyncio.to_thread(lambda: [path for path in paths if not is_rendition_current(path)])
+        if not paths:
+            return
+
+        if not self.pending:
+            self.batch_total = self.batch_done = 0
+        self.batch_total += len(paths)
+
+        loop = asyncio.get_running_loop()
+        futures = []
+        for path in paths:
+            future = loop.run_in_executor(self.executor, transcode, str(path), str(get_path_rendition(path)))
+            self.pending[path] = future
+            futures.append(self.wait(path, future))
+
+        logger.info(f'Transcoding {len(paths)} recording(s) into stream-ready renditions...')
+        await self.publish_progress()
+        await asyncio.gather(*futures)
+
+    async def wait(self, path: Path, future: asyncio.Future):
+        try:
+            with logger.span(f'Transcoding "{path}"...'):
+                await future
+        except Exception:
+            self.failed.add(path)
+            logger.exception(f'Error transcoding "{path}". Streams will decode the original.')
+        finally:
+            self.pending.pop(path, None)
+            self.batch_done += 1
+            await self.publish_progress()
+
+    def prune(self, path_audio: Path, paths: Iterable[Path]):
+        """
+
+        Remove renditions (and their metadata) whose original is no longer among `paths`.
+
+        """
+        paths_keep = set()
+        for path in paths:
+            paths_keep |= {get_path_rendition(path), get_path_metadata(path)}
+        for path_rendition in path_audio.glob(f'**/{RENDITIONS_DIR}/*'):
+            if path_rendition.is_file() and not path_rendition.name.startswith('.') and path_rendition not in paths_keep:
+                logger.info(f'Removing orphaned rendition "{path_rendition}"...')
+                path_rendition.unlink(missing_ok=True)
+
+    async def publish_progress(self):
+        await self.throttle.submit(self.publish)
+
+    async def publish(self):
+        try:
+            await self.on_progress()
+        except Exception:
+            logger.exception('Error publishing transcoding progress.')
+
+    @property
+    def status(self) -> str | None:
+        if not self.pending:
+            return None
+        return f'Transcoding {self.batch_done + 1} of {self.batch_total}...'
+
+    @property
+    def percentage(self) -> int | None:
+        if not self.pending:
+            return None
+        return round(100 * self.batch_done / self.batch_total)
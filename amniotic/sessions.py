@@ -0,0 +1,156 @@
+from __future__ import annotations
+
+import asyncio
+import threading
+import time
+import typing
+from dataclasses import dataclass, field
+from typing import Callable
+
+from amniotic.obs import logger
+
+if typing.TYPE_CHECKING:
+    from amniotic.recording import RecordingThemeStream
+    from amniotic.theme import ThemeStream
+
+SESSION_TTL = 10
+
+
+@dataclass
+class Session:
+    """
+
+    The recording streams of a closed stream, still open, and still where it left them.
+
+    """
+    key: tuple[str, str]
+    recording_streams: list[RecordingThemeStream]
+    kept_at: float = field(default_factory=time.monotonic)
+
+
+class SessionCache:
+    """
+
+    Keeps the recording streams of a closed stream open for `ttl` seconds, keyed by client host and theme, so a player
+    that drops its connection for a moment and reconnects picks up where it left off, without reopening, seeking or
+    re-decoding anything. Anything not picked up in time is closed, from a background task.
+
+    Hosts, not ports, identify clients, as a reconnect comes from a new port. A cache of `ttl` 0 keeps nothing.
+
+    Kept recordings' positions are written to their instance offsets straight away, so they're saved along with the
+    closing stream. Closing them later can move them on again, so `on_close` is called after, e.g. to save again.
+
+    """
+
+    def __init__(self, ttl: float = SESSION_TTL, clock=time.monotonic, on_close: Callable[[], None] | None = None):
+        self.ttl = ttl
+        self.clock = clock
+        self.on_close = on_close
+        self.sessions: dict[tuple[str, str], Session] = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def get_key(cls, stream: ThemeStream) -> tuple[str, str] | None:
+        client = stream.request.client
+        if not client:
+            return None
+        host, _port = client
+        return host, stream.theme_def.id
+
+    def keep(self, stream: ThemeStream) -> bool:
+        """
+
+        Take over the recording streams of `stream`, as it closes. Returns whether there were any worth keeping.
+
+        """
+        key = self.get_key(stream)
+        recording_streams = [recording for recording in stream.recording_streams if not recording.is_failed]
+        if not self.ttl or not key or not recording_streams:
+            return False
+
+        session = Session(key=key, recording_streams=recording_streams, kept_at=self.clock())
+        with self.lock:
+            replaced = self.sessions.pop(key, None)
+            self.sessions[key] = session
+        if replaced:
+            self.close(replaced)
+
+        for recording in recording_streams:
+            if recording.position is not None:
+                recording.instance.offset = recording.position
+            stream.recording_streams.remove(recording)
+        logger.info(f'{repr(stream)}: Keeping {len(recording_streams)} recording stream(s) for {self.ttl}s, in case client {key[0]} reconnects.')
+        return True
+
+    def take(self, stream: ThemeStream) -> list[RecordingThemeStream]:
+        """
+
+        The recording streams kept for the same client and theme as `stream`, if any. They're only usable if their chunk
+        size still matches, otherwise they're closed.
+
+        """
+        key = self.get_key(stream)
+        if not key:
+            return []
+        with self.lock:
+            session = self.sessions.pop(key, None)
+        if not session:
+            return []
+
+        if self.is_expired(session) or any(recording.CHUNK_SIZE != stream.block_size for recording in session.recording_streams):
+            self.close(session)
+            return []
+
+        logger.info(f'{repr(stream)}: Resuming {len(session.recording_streams)} recording stream(s) after {self.clock() - session.kept_at:.1f}s.')
+        return session.recording_streams
+
+    def is_expired(self, session: Session) -> bool:
+        return self.clock() - session.kept_at >= self.ttl
+
+    def close(self, session: Session):
+        for recording in session.recording_streams:
+            try:
+                recording.close()
+            except Exception:
+                logger.exception(f'Error closing kept recording stream {repr(recording)}.')
+
+    def expire(self):
+        with self.lock:
+            expired = [self.sessions.pop(key) for key, session in list(self.sessions.items()) if self.is_expired(session)]
+        for session in expired:
+            logger.info(f'Client {session.key[0]} did not reconnect to Theme "{session.key[1]}". Closing its recording stream(s).')
+            self.close(session)
+        if expired:
+            self.closed()
+
+    def clear(self):
+        """
+
+        Close everything kept, e.g. to free memory.
+
+        """
+        with self.lock:
+            sessions, self.sessions = list(self.sessions.values()), {}
+        for session in sessions:
+            self.close(session)
+        if sessions:
+            self.closed()
+
+    def closed(self):
+        if not self.on_close:
+            return
+        try:
+            self.on_close()
+        except Exception:
+            logger.exception('Error after closing kept recording streams.')
+
+    def __len__(self):
+        return len(self.sessions)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(max(self.ttl / 2, 1))
+            try:
+                await asyncio.to_thread(self.expire)
+            except Exception:
+                logger.exception('Error in stream session task.')
@@ -1,13 +1,18 @@
 import asyncio
+import typing
 from functools import cached_property
 from pydantic import Field
 
-import corio
-from amniotic.client import ClientAmniotic
-from amniotic.device import Amniotic
+import corio.mqtt
 from amniotic.paths import paths
 from corio import sets, ha, Path, Constants
 
+if typing.TYPE_CHECKING:
+    from amniotic.client import ClientAmniotic
+    from amniotic.device import Amniotic
+
+NAME = 'Amniotic'
+
 
 class Settings(sets.Base):
 
@@ -19,11 +24,29 @@ class Settings(sets.Base):
     token: str = Field(alias=ha.constants.SUPERVISOR_TOKEN_KEY)
 
     stream_url: str
-    name: str = Amniotic.__name__
+    name: str = NAME
     mqtt: corio.mqtt.Client.Args | None = None
 
+    stream_limit: int | None = None
+    stream_limit_theme: int | None = None
+    stream_reconnect_limit: int | None = 10
+    stream_reconnect_window: int = 60
+    stream_cpu_limit: float | None = 90.0
+    stream_block_duration: int | None = None
+    stream_float_bus: bool = False
+    stream_crossfade: int = 1_000
+    stream_session_ttl: int = 10
+    stream_idle_silence: int | None = 30
+    stream_idle_disabled: int | None = 10
+    stream_idle_stop_player: bool = False
+
+    memory_budget: int | None = 768
+
+    download_workers: int = 2
+    transcode_workers: int = 1
+
     path_audio: Path
-    path_config: Path = ha.constants.PATH_ADDON_CONFIG / Amniotic.__name__.lower()  # todo make add-specific defaults on settings subclass
+    path_config: Path = ha.constants.PATH_ADDON_CONFIG / NAME.lower()  # todo make add-specific defaults on settings subclass
 
     @cached_property
     def path_themes(self):
@@ -37,6 +60,11 @@ class Settings(sets.Base):
         from corio import debug
         debug.trace()
 
+        from amniotic.admission import Admission
+        from amniotic.device import Amniotic
+        from amniotic.memory import MemoryManager
+        from amniotic.reaper import Reaper
+        from amniotic.sessions import SessionCache
         from amniotic.obs import logger
         from amniotic.paths import paths
 
@@ -49,17 +77,40 @@ class Settings(sets.Base):
             logger.warning(f'Config directory does not exist at "{self.path_config}". Will be created.')
             self.path_config.mkdir()
 
-        client_ha = ha.core.Client(api_url=self.ha_core_api, token=self.token)
-        device = Amniotic(name=self.name, client_ha=client_ha, path_audio=self.path_audio, sw_version=paths.metadata.version, manufacturer=Constants.ORG_NAME, model=Amniotic.__name__)
+        memory = MemoryManager(budget=self.memory_budget)
+        admission = Admission(
+            stream_limit=self.stream_limit,
+            stream_limit_theme=self.stream_limit_theme,
+            reconnect_limit=self.stream_reconnect_limit,
+            reconnect_window=self.stream_reconnect_window,
+            cpu_limit=self.stream_cpu_limit,
+            memory=memory,
+        )
+        device = Amniotic(name=self.name, path_audio=self.path_audio, admission=admission, memory=memory, block_duration=self.stream_block_duration, float_bus=self.stream_float_bus, crossfade=self.stream_crossfade, sessions=SessionCache(ttl=self.stream_session_ttl), reaper=Reaper(silence=self.stream_idle_silence, disabled=self.stream_idle_disabled, stop_player=self.stream_idle_stop_player), download_workers=self.download_workers, transcode_workers=self.transcode_workers, sw_version=paths.metadata.version, manufacturer=Constants.ORG_NAME, model=Amniotic.__name__)
+
+        loading = asyncio.create_task(device.load())
+        client = await device.timeline.run('mqtt_config', asyncio.to_thread(self.get_client, device))
+
+        await client.start(loading=loading)
+
+    def get_client(self, device: 'Amniotic') -> 'ClientAmniotic':
+        from amniotic.client import ClientAmniotic
 
         if self.mqtt:
-            client = ClientAmniotic.from_args(self.mqtt, device=device)
-        else:
-            client = ClientAmniotic.from_supervisor(device=device)
+            return ClientAmniotic.from_args(self.mqtt, device=device)
+        return ClientAmniotic.from_supervisor(device=device)
+
+
+def __getattr__(name):
+    """
 
-        await client.start()
+    Instantiate settings on first access, not at import. Parsing the environment needs the add-on env applied, and nothing
+    that merely imports this module should pay for (or fail on) that.
 
+    """
+    if name != 'settings':
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
-ha.apply_addon_env()
-settings = Settings()
-settings
+    ha.apply_addon_env()
+    globals()['settings'] = settings = Settings()
+    return settings
@@ -0,0 +1,49 @@
+import time
+from dataclasses import dataclass
+from typing import Awaitable, TypeVar
+
+from amniotic.obs import logger
+
+T = TypeVar('T')
+
+
+@dataclass
+class Phase:
+    name: str
+    offset: float
+    duration: float
+
+
+class Timeline:
+    """
+
+    Startup timeline. Wrap each startup phase in `run` (phases can run concurrently), then `log` a summary of when each
+    phase started, relative to the start of the timeline, and how long it took.
+
+    """
+
+    def __init__(self, name: str = 'Startup'):
+        self.name = name
+        self.started = time.perf_counter()
+        self.phases: list[Phase] = []
+        self.is_logged = False
+
+    async def run(self, name: str, awaitable: Awaitable[T]) -> T:
+        started = time.perf_counter()
+        try:
+            with logger.span(f'{self.name} phase "{name}"...'):
+                return await awaitable
+        finally:
+            ended = time.perf_counter()
+            self.phases.append(Phase(name=name, offset=started - self.started, duration=ended - started))
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def log(self):
+        if self.is_logged:
+            return
+        self.is_logged = True
+        phases = ', '.join(f'{phase.name} (+{phase.offset:.3f}s, took {phase.duration:.3f}s)' for phase in sorted(self.phases, key=lambda phase: phase.offset))
+        logger.info(f'{self.name} completed in {self.elapsed:.3f}s: {phases}.')
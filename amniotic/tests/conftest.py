@@ -0,0 +1,78 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from amniotic.theme import ThemeStream
+
+CLIENT = ("127.0.0.1", 1234)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeRecordingStream:
+    """
+
+    Stand-in for `RecordingThemeStream`, returning the same block forever: `data`, or if that's not given, a block of
+    `value` sized and typed for the stream mixing it (see the `theme_stream` fixture).
+
+    """
+    CHUNK_SIZE = 1_152
+    position = None
+
+    def __init__(self, data=None, value=1_000, is_failed=False):
+        self.data = None if data is None else data.reshape(1, -1)
+        self.value = value
+        self.is_failed = is_failed
+        self.closed = False
+
+    def __next__(self):
+        return self.data
+
+    def close(self):
+        self.closed = True
+
+    def get_status(self):
+        return dict(closed=self.closed)
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def theme_stream(monkeypatch):
+    """
+
+    Make `ThemeStream`s, of a theme named "Sleep" unless `theme_def` is given, whose client never hangs up, and which
+    run as fast as they're read. With `recordings`, those are mixed in place of the theme's own, and can be added to as
+    the stream runs.
+
+    """
+    monkeypatch.setattr("amniotic.theme.time.sleep", lambda _seconds: None)
+
+    def make(recordings=None, theme_def=None, is_enabled=True, client=CLIENT, **kwargs):
+        theme_def = theme_def or SimpleNamespace(name="Sleep", id="sleep", is_enabled=is_enabled, instances=[])
+        stream = ThemeStream(theme_def=theme_def, request=SimpleNamespace(client=client), **kwargs)
+        monkeypatch.setattr(stream, "_is_disconnected", lambda: False)
+
+        if recordings is not None:
+            def get_streams():
+                for recording in list(recordings):
+                    if recording.data is None:
+                        recording.data = np.full((1, stream.block_size), recording.value, np.float32 if stream.is_float else np.int16)
+                    if recording not in stream.recording_streams:
+                        stream.recording_streams.append(recording)
+                    yield recording
+
+            monkeypatch.setattr(stream, "get_streams", get_streams)
+        return stream
+
+    return make
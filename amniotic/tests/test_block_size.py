@@ -0,0 +1,46 @@
+import av
+import numpy as np
+import pytest
+
+from amniotic.recording import RecordingThemeStream
+from amniotic.theme import OUTPUT_BITRATE, OUTPUT_CODEC, OUTPUT_RATE, get_block_size
+
+MP3_FRAME_SIZE = 1_152
+SECONDS = 5
+
+
+def _encoder():
+    output = av.open(f".{OUTPUT_CODEC}", mode="w")
+    stream = output.add_stream(codec_name=OUTPUT_CODEC, rate=OUTPUT_RATE, bit_rate=OUTPUT_BITRATE)
+    stream.codec_context.open()
+    return output, stream
+
+
+def test_block_size_is_whole_encoder_frames():
+    assert get_block_size(MP3_FRAME_SIZE) == MP3_FRAME_SIZE
+    assert get_block_size(MP3_FRAME_SIZE, duration=100) == 4 * MP3_FRAME_SIZE
+    assert get_block_size(MP3_FRAME_SIZE, duration=5) == MP3_FRAME_SIZE
+    assert get_block_size(0) == RecordingThemeStream.CHUNK_SIZE
+    assert get_block_size(0, duration=100) == 4_410
+
+    output, stream = _encoder()
+    assert stream.codec_context.frame_size == MP3_FRAME_SIZE
+    output.close()
+
+
+@pytest.mark.parametrize("duration", [None, 50, 100])
+def test_aligned_blocks_encode_to_whole_frames_without_buffering(duration):
+    output, stream = _encoder()
+    block_size = get_block_size(stream.codec_context.frame_size, duration)
+    frames = block_size // MP3_FRAME_SIZE
+
+    counts = []
+    for _ in range(20):
+        frame = av.AudioFrame.from_ndarray(np.zeros((1, block_size), np.int16), format="s16", layout="mono")
+        frame.rate = OUTPUT_RATE
+        counts.append(len(stream.encode(frame)))
+    output.close()
+
+    # Past the encoder's initial delay, every block comes straight back out as exactly its own frames.
+    assert set(counts[5:]) == {frames}
+
@@ -0,0 +1,110 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from amniotic.api import ApiAmniotic, ChannelStream
+from amniotic.channel import Channel, Crossfade
+from amniotic.device import Amniotic
+from amniotic.tests.conftest import FakeRecordingStream
+from amniotic.tests.test_stream_lifecycle import FakeDevice
+from corio.iterator import IndexList
+
+BLOCK = 1_152
+
+
+def test_crossfade_keeps_power_steady_and_lands_on_the_new_mix():
+    fade_in, fade_out = Crossfade(size=4 * BLOCK), Crossfade(size=4 * BLOCK)
+    gains_in, gains_out = [], []
+    while not fade_in.is_done:
+        gains_in.append(fade_in.process(np.ones(BLOCK, np.float32), np.zeros(BLOCK, np.float32)))
+        gains_out.append(fade_out.process(np.zeros(BLOCK, np.float32), np.ones(BLOCK, np.float32)))
+    gains_in, gains_out = np.concatenate(gains_in), np.concatenate(gains_out)
+
+    # Unrelated recordings add in power, so the squared gains should always sum to one.
+    assert np.allclose(gains_in ** 2 + gains_out ** 2, 1, atol=1e-5)
+    assert gains_in[0] == 0 and gains_out[0] == 1
+    assert (np.diff(gains_in) > 0).all()
+
+    mix = np.full(BLOCK, 10_000, np.int32)
+    fade_in.process(mix, np.full(BLOCK, 5_000, np.int32))
+    assert (mix == 10_000).all()
+
+
+def test_theme_stream_switch_crossfades_then_closes_the_old_recordings(monkeypatch, theme_stream):
+    stream = theme_stream(crossfade=100)
+    sleep = stream.theme_def
+    rain = SimpleNamespace(name="Rain", is_enabled=True, instances=[])
+
+    recordings = {"Sleep": FakeRecordingStream(np.full(BLOCK, 8_000, np.int16)), "Rain": FakeRecordingStream(np.full(BLOCK, -8_000, np.int16))}
+
+    def get_streams():
+        recording = recordings[stream.theme_def.name]
+        if recording not in stream.recording_streams:
+            stream.recording_streams.append(recording)
+        yield recording
+
+    monkeypatch.setattr(stream, "get_streams", get_streams)
+    chunks = stream.iter_chunks()
+    assert (next(chunks) == 8_000).all()
+
+    stream.switch(rain)
+    assert stream.theme_def is sleep
+
+    faded = [next(chunks).copy() for _ in range(5)]
+    assert stream.theme_def is rain
+    assert faded[0][0, 0] == 8_000
+    assert np.diff(np.concatenate(faded, axis=1)[0].astype(np.int32)).max() <= 0
+    assert (faded[-1] == -8_000).all()
+    assert recordings["Sleep"].closed and not recordings["Rain"].closed
+    assert not stream.fade and not stream.fading_streams
+
+
+def test_channel_switches_live_streams_in_place(theme_stream):
+    sleep = SimpleNamespace(name="Sleep", is_enabled=True, instances=[])
+    rain = SimpleNamespace(name="Rain", is_enabled=True, instances=[])
+
+    channel = Channel(player="media_player.office", theme_def=sleep)
+    assert not channel.switch(rain)
+    assert channel.theme_def is rain
+
+    stream = theme_stream(theme_def=rain)
+    channel.add(stream)
+    assert channel.switch(sleep)
+    assert stream.theme_next is sleep
+
+    stream.close()
+    assert not channel.switch(rain)
+
+
+@pytest.mark.asyncio
+async def test_api_channel_streams_the_channel_theme(monkeypatch):
+    sleep = SimpleNamespace(name="Sleep", id="sleep")
+    device = FakeDevice(themes=IndexList([sleep]))
+    device.channels = IndexList()
+    device.get_channel = lambda player: Amniotic.get_channel(device, player)
+    device.media_player_states = IndexList([SimpleNamespace(entity_id="media_player.office")])
+    api = ApiAmniotic(client=SimpleNamespace(device=device))
+
+    created = []
+
+    class FakeThemeStream:
+        def __init__(self, theme_def, request, crossfade=None, **_kwargs):
+            created.append(self)
+            self.theme_def = theme_def
+            self.crossfade = crossfade
+            self.is_enabled = True
+            self._is_closed = False
+
+    monkeypatch.setattr("amniotic.api.ThemeStream", FakeThemeStream)
+    request = SimpleNamespace(method="GET", client=("127.0.0.1", 1234))
+
+    response = await api.endpoints.cls[ChannelStream].run("unknown", request)
+    assert response.status_code == 404
+
+    # After a restart, a player still connected to its channel carries on with the current theme.
+    await api.endpoints.cls[ChannelStream].run("mediaplayeroffice", request)
+    channel, = device.channels
+    assert channel.player == "media_player.office"
+    assert created[0].theme_def is sleep
+    assert channel.live == created
@@ -0,0 +1,91 @@
+"""
+
+Benchmarks for the copies made between decoding and encoding.
+
+What's left, per chunk, and why:
+
+- Decoding fills a new array per frame (`to_ndarray`), which volume is then applied to in place.
+- Splitting into chunks copies only the samples of chunks that straddle two frames, into a ring buffer. For FLAC
+  renditions (4,608-sample frames, 1,024-sample chunks), that's one chunk in nine.
+- Mixing reads each recording's chunk in place, widening it into a reused 32-bit buffer to sum, so samples can't wrap
+  before clipping.
+- Narrowing back to 16-bit writes into a reused output buffer, which the encoder frame then copies from.
+
+"""
+import tracemalloc
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from amniotic.recording import RecordingThemeStream
+from amniotic.theme import ThemeStream
+
+FRAME_SIZE = 4_608
+CHUNKS = 2_000
+
+
+def _stream(blocks):
+    stream = RecordingThemeStream.__new__(RecordingThemeStream)
+    stream.instance = SimpleNamespace(name="demo")
+    stream.started_at_str = "test"
+    stream.iter_samples = lambda: (block for block in blocks)
+    return stream
+
+
+def _blocks(count, size=FRAME_SIZE):
+    return [np.arange(i * size, (i + 1) * size, dtype=np.int64).astype(np.int16) for i in range(count)]
+
+
+def test_chunks_are_read_only_views_and_only_straddling_chunks_are_copied(monkeypatch):
+    monkeypatch.setattr("amniotic.recording.LOG_THRESHOLD", 10 ** 9)
+    blocks = _blocks(18)
+
+    chunks, copied = [], 0
+    for chunk in _stream(blocks).iter_chunks():
+        assert not chunk.flags.writeable
+        if not any(np.shares_memory(chunk, block) for block in blocks):
+            copied += 1
+        chunks.append(chunk.copy())
+
+    assert np.array_equal(np.concatenate(chunks, axis=1).reshape(-1), np.concatenate(blocks)[:len(chunks) * RecordingThemeStream.CHUNK_SIZE])
+    assert len(chunks) == 81
+    assert copied == 9
+
+
+def _mixer(monkeypatch, count):
+    monkeypatch.setattr("amniotic.theme.LOG_THRESHOLD", 10 ** 9)
+    monkeypatch.setattr("amniotic.recording.LOG_THRESHOLD", 10 ** 9)
+    theme_def = SimpleNamespace(name="Sleep", is_enabled=True, instances=[])
+    stream = ThemeStream(theme_def=theme_def, request=SimpleNamespace(client=("127.0.0.1", 1234)))
+    blocks = _blocks(CHUNKS // 4 + 1)
+    recordings = [_stream(blocks).iter_chunks() for _ in range(count)]
+    monkeypatch.setattr(stream, "get_streams", lambda: recordings)
+    stream.recording_streams = []
+    return stream.iter_chunks()
+
+
+@pytest.mark.parametrize("count", [1, 3])
+def test_mixing_allocates_no_chunk_sized_temporaries(monkeypatch, count):
+    chunks = _mixer(monkeypatch, count)
+    for _ in range(10):
+        next(chunks)
+
+    transients = []
+    tracemalloc.start()
+    try:
+        for _ in range(CHUNKS):
+            tracemalloc.reset_peak()
+            baseline, _ = tracemalloc.get_traced_memory()
+            next(chunks)
+            _, peak = tracemalloc.get_traced_memory()
+            transients.append(peak - baseline)
+    finally:
+        tracemalloc.stop()
+        chunks.close()
+
+    # Stacking, summing, clipping and narrowing used to allocate around 16 bytes per sample, per chunk, the smallest
+    # temporary being the 32-bit sum (4KB). Now what's left is array headers, for the views of each recording's chunks,
+    # a few hundred bytes per recording. The peak also catches the occasional chunk copied into a ring buffer.
+    assert sorted(transients)[len(transients) // 2] < 256 * (count + 1)
+    assert max(transients) < RecordingThemeStream.CHUNK_SIZE * 4
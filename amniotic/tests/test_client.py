@@ -1,3 +1,4 @@
+import asyncio
 import json
 from pathlib import Path
 from types import ModuleType, SimpleNamespace
@@ -58,6 +59,35 @@ async def test_client_start_runs_mqtt_and_api_launch(monkeypatch):
     assert ("api_launch", client) in events
 
 
+@pytest.mark.asyncio
+async def test_client_start_serves_api_before_loading_completes(monkeypatch):
+    events = []
+    loading = asyncio.get_running_loop().create_future()
+
+    async def fake_super_start(self):
+        events.append("mqtt_start")
+
+    async def fake_launch_async(client):
+        events.append("api_launch")
+        loading.set_result(None)
+
+    monkeypatch.setattr(ClientHaco, "start", fake_super_start)
+    monkeypatch.setattr(
+        ClientAmniotic,
+        "API_CLASS",
+        type("DummyApi", (), {"launch_async": staticmethod(fake_launch_async)}),
+    )
+
+    client = object.__new__(ClientAmniotic)
+    client._client = SimpleNamespace(username="tester")
+    client._hostname = "mqtt.local"
+    client._port = 1883
+
+    await ClientAmniotic.start(client, loading=loading)
+
+    assert events == ["api_launch", "mqtt_start"]
+
+
 def test_from_supervisor_uses_mqtt_service_payload(monkeypatch):
     fake_settings = SimpleNamespace(
         ha_supervisor_api="http://supervisor.local",
@@ -142,3 +142,22 @@ async def test_number_volume_command_and_state_replay_publishes_numeric_state():
     assert client.published[0]["topic"].endswith("/recording-volume/default/state")
     assert json.loads(client.published[0]["payload"]) == 37
     assert client.published[0]["retain"] is True
+
+
+@pytest.mark.asyncio
+async def test_number_volume_coalesces_slider_bursts_to_final_value():
+    control = NumberVolume()
+    device, client, _, instance = build_device_for_control(control)
+
+    for value in (10, 20, 30, 40):
+        await control.command(SimpleNamespace(payload=str(value).encode()))
+
+    assert instance.volume == pytest.approx(0.10)
+    assert device.themes.save_calls == 1
+    assert [json.loads(message["payload"]) for message in client.published] == [10, 20, 30, 40]
+
+    await control.throttle.task
+
+    assert instance.volume == pytest.approx(0.40)
+    assert device.themes.save_calls == 2
+    assert json.loads(client.published[-1]["payload"]) == 40
@@ -1,16 +1,4 @@
-import json
-from pathlib import Path
-from types import ModuleType, SimpleNamespace
-import sys
-
-from amniotic.device import Amniotic, MediaState
-
-
-FIXTURES_DIR = Path(__file__).parent / "fixtures"
-
-
-def _fixture_json(name: str):
-    return json.loads((FIXTURES_DIR / name).read_text())
+from amniotic.device import MediaState
 
 
 def test_media_state_from_state_parses_realistic_home_assistant_payload():
@@ -43,37 +31,3 @@ def test_media_state_falls_back_to_entity_id_when_friendly_name_missing():
     state = MediaState.from_state(payload)
 
     assert state.friendly_name == "media_player.office"
-
-
-def test_get_media_players_replays_states_payload(monkeypatch):
-    fake_settings = SimpleNamespace(ha_core_api="http://ha.local/api", token="token123")
-    fake_settings_mod = ModuleType("amniotic.settings")
-    fake_settings_mod.settings = fake_settings
-    monkeypatch.setitem(sys.modules, "amniotic.settings", fake_settings_mod)
-
-    payload = _fixture_json("ha_states.json")
-
-    class DummyResponse:
-        def json(self):
-            return payload
-
-        def raise_for_status(self):
-            return None
-
-    captured = {}
-
-    def fake_get(url, headers):
-        captured["url"] = url
-        captured["headers"] = headers
-        return DummyResponse()
-
-    monkeypatch.setattr("amniotic.device.client_ha.get", fake_get)
-
-    players = Amniotic.get_media_players(object())
-
-    assert captured["url"] == "http://ha.local/api/states"
-    assert captured["headers"]["Authorization"] == "Bearer token123"
-    assert [player.entity_id for player in players] == [
-        "media_player.living_room",
-        "media_player.office",
-    ]
@@ -0,0 +1,170 @@
+import asyncio
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from amniotic.downloads import DownloadManager
+from corio import Path
+
+
+class FakeDownloader:
+    """
+
+    Stand-in for `AudioStreamDownloader`: blocks like a real one, yields progress, then writes a small file, named from
+    the title and holding its ID, to its staging directory.
+
+    """
+    gate: threading.Event = None
+    lock = threading.Lock()
+    running = 0
+    running_max = 0
+    fetched = []
+    stagings = []
+
+    def __init__(self, url_or_id: str):
+        self.id = url_or_id.split("v=")[-1]
+        self.path = None
+
+    def get_title(self):
+        return self.id
+
+    def iter_download(self, staging):
+        cls = type(self)
+        with cls.lock:
+            cls.running += 1
+            cls.running_max = max(cls.running_max, cls.running)
+            cls.fetched.append(self.id)
+            cls.stagings.append(staging)
+        try:
+            yield SimpleNamespace(message="Downloading...", percentage=None)
+            assert cls.gate.wait(timeout=5)
+            for percentage in range(0, 101, 5):
+                yield SimpleNamespace(message=None, percentage=percentage)
+            self.path = staging / f"{self.get_title()}.m4a"
+            self.path.write_text(self.id)
+        finally:
+            with cls.lock:
+                cls.running -= 1
+
+
+@pytest.fixture
+def downloader_class():
+    return type("Downloader", (FakeDownloader,), dict(gate=threading.Event(), lock=threading.Lock(), fetched=[], stagings=[]))
+
+
+def _manager(tmp_path, downloader_class, **kwargs):
+    progress, completed = [], []
+
+    async def on_progress():
+        progress.append((manager.status, manager.percentage))
+
+    async def on_complete(job):
+        completed.append(job)
+
+    path = Path(tmp_path / "audio")
+    path.mkdir()
+    manager = DownloadManager(path=path, on_progress=on_progress, on_complete=on_complete, downloader_class=downloader_class, **kwargs)
+    return manager, progress, completed
+
+
+async def _wait_idle(manager):
+    await asyncio.wait_for(manager.queue.join(), timeout=5)
+    while manager.throttle.task:
+        await manager.throttle.task
+
+
+@pytest.mark.asyncio
+async def test_download_manager_bounds_concurrency_and_moves_results(tmp_path, downloader_class):
+    manager, progress, completed = _manager(tmp_path, downloader_class, workers=2, progress_interval=0.01)
+
+    for id in ["a", "b", "c"]:
+        await manager.submit(f"https://youtube.com/watch?v={id}")
+
+    await asyncio.sleep(0.05)
+    assert downloader_class.running == 2
+    assert "2 downloading, 1 queued." in manager.status
+
+    downloader_class.gate.set()
+    await _wait_idle(manager)
+
+    assert downloader_class.running_max == 2
+    assert sorted(job.id for job in completed) == ["a", "b", "c"]
+    assert sorted(path.name for path in manager.path.iterdir()) == ["a [a].m4a", "b [b].m4a", "c [c].m4a"]
+    assert not any(staging.exists() for staging in downloader_class.stagings)
+    assert progress[-1] == (None, None)
+
+
+@pytest.mark.asyncio
+async def test_download_manager_runs_blocking_downloads_off_the_event_loop(tmp_path, downloader_class):
+    downloader_class.get_title = lambda self: "Rain"
+    manager, _, _ = _manager(tmp_path, downloader_class, workers=2, progress_interval=0.01)
+
+    for id in ["abc", "xyz"]:
+        await manager.submit(id)
+
+    # Both downloads are blocked mid-way, in their threads, and the event loop carries on regardless.
+    for _ in range(100):
+        if downloader_class.running == 2:
+            break
+        await asyncio.sleep(0.01)
+    assert downloader_class.running == 2
+
+    downloader_class.gate.set()
+    await _wait_idle(manager)
+
+    # Same titles, staged at the same time, but each in its own directory.
+    assert len(set(downloader_class.stagings)) == 2
+    assert {path.name: path.read_text() for path in manager.path.iterdir()} == {"Rain [abc].m4a": "abc", "Rain [xyz].m4a": "xyz"}
+
+
+@pytest.mark.asyncio
+async def test_download_manager_deduplicates_by_source_id(tmp_path, downloader_class):
+    manager, _, completed = _manager(tmp_path, downloader_class, progress_interval=0.01)
+    downloader_class.gate.set()
+
+    first = await manager.submit("https://youtube.com/watch?v=abc")
+    second = await manager.submit("abc")
+    await _wait_idle(manager)
+    third = await manager.submit("https://www.youtube.com/watch?v=abc")
+    await _wait_idle(manager)
+
+    assert first is second is third
+    assert downloader_class.fetched == ["abc"]
+    assert len(completed) == 1
+
+
+@pytest.mark.asyncio
+async def test_download_manager_keeps_same_titled_videos_and_skips_them_after_restart(tmp_path, downloader_class):
+    downloader_class.get_title = lambda self: "Rain"
+    manager, _, completed = _manager(tmp_path, downloader_class, progress_interval=0.01)
+    downloader_class.gate.set()
+
+    for id in ["abc", "xyz"]:
+        await manager.submit(id)
+    await _wait_idle(manager)
+    assert sorted(path.name for path in manager.path.iterdir()) == ["Rain [abc].m4a", "Rain [xyz].m4a"]
+
+    category = manager.path / "Nature"
+    category.mkdir()
+    (manager.path / "Rain [abc].m4a").rename(category / "Rain [abc].m4a")
+
+    restarted = DownloadManager(path=manager.path, on_progress=manager.on_progress, on_complete=manager.on_complete, downloader_class=downloader_class)
+    job = await restarted.submit("https://youtube.com/watch?v=abc")
+
+    assert job.is_finished and job.path == category / "Rain [abc].m4a"
+    assert downloader_class.fetched == ["abc", "xyz"]
+    assert len(completed) == 2
+
+
+@pytest.mark.asyncio
+async def test_download_manager_throttles_progress(tmp_path, downloader_class):
+    manager, progress, _ = _manager(tmp_path, downloader_class, progress_interval=0.05)
+    downloader_class.gate.set()
+
+    await manager.submit("abc")
+    await _wait_idle(manager)
+
+    # Over 20 progress updates and status changes collapse into a handful of publishes.
+    assert len(progress) <= 4
+    assert progress[-1] == (None, None)
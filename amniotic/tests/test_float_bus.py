@@ -0,0 +1,81 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from amniotic.limiter import Limiter
+from amniotic.recording import RecordingThemeStream
+from amniotic.renditions import get_path_rendition, transcode
+from amniotic.tests.conftest import FakeRecordingStream
+from amniotic.tests.test_renditions import _write_wav
+from amniotic.theme import OUTPUT_RATE
+
+BLOCK = 1_152
+
+
+def _sine(peak, size=BLOCK):
+    return (np.sin(2 * np.pi * 440 * np.arange(size) / OUTPUT_RATE) * peak).astype(np.float32)
+
+
+def test_limiter_turns_loud_blocks_down_and_recovers_smoothly():
+    limiter = Limiter(rate=OUTPUT_RATE, release=0.1)
+
+    quiet = _sine(0.5)
+    assert np.array_equal(limiter.process(quiet.copy()), quiet)
+
+    loud = _sine(2.0)
+    limited = limiter.process(loud.copy())
+    assert np.abs(limited).max() == pytest.approx(limiter.ceiling)
+    assert np.allclose(limited, loud * limiter.ceiling / np.abs(loud).max())
+
+    gains = []
+    for _ in range(10):
+        limiter.process(_sine(0.5))
+        gains.append(limiter.gain)
+    assert gains == sorted(gains)
+    assert gains[0] < 1 and gains[-1] == 1
+
+
+def _mix(theme_stream, is_float, *recordings):
+    stream = theme_stream(recordings=[FakeRecordingStream(recording) for recording in recordings], is_float=is_float)
+    return next(stream.iter_chunks()).reshape(-1).copy()
+
+
+def test_float_bus_limits_loud_mixes_instead_of_clipping(theme_stream):
+    recording = _sine(0.8)
+
+    mixed = _mix(theme_stream, True, recording, recording)
+    assert mixed.dtype == np.float32
+    assert np.abs(mixed).max() <= 0.98
+    assert np.allclose(mixed / np.abs(mixed).max(), recording / np.abs(recording).max(), atol=1e-5)
+
+    # The 16-bit bus clips the same mix, flattening every peak.
+    clipped = _mix(theme_stream, False, *[(recording * 32_767).astype(np.int16)] * 2)
+    assert (np.abs(clipped) == 32_767).sum() > BLOCK / 10
+
+
+def test_recording_stream_decodes_renditions_to_float(tmp_path):
+    path = _write_wav(tmp_path / "rain.wav")
+    transcode(str(path), str(get_path_rendition(path)))
+
+    chunks = {}
+    for is_float in [False, True]:
+        instance = SimpleNamespace(path=str(path), volume=2.0, meta=SimpleNamespace(path=path), name="rain", offset=0)
+        stream = RecordingThemeStream(instance=instance, is_float=is_float)
+        chunks[is_float] = np.concatenate([next(stream).copy() for _ in range(5)], axis=1)
+        stream.close()
+
+    assert chunks[True].dtype == np.float32
+    assert np.allclose(chunks[True], chunks[False] / 32_768, atol=1 / 32_768)
+
+
+def test_float_bus_feeds_encoder_its_native_format(theme_stream):
+    stream = theme_stream(recordings=[FakeRecordingStream(value=2.4)], is_float=True)
+
+    output = stream.__iter__()
+    data = next(output)
+    out_stream = stream.output.streams.audio[0]
+    output.close()
+
+    assert out_stream.codec_context.format.name == "fltp"
+    assert data.nbytes > 0
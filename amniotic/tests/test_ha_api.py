@@ -0,0 +1,261 @@
+import asyncio
+import json
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from types import ModuleType, SimpleNamespace
+
+import pytest
+import websockets
+
+from amniotic.controls import PlayStreamButton
+from amniotic.device import Amniotic, MediaState
+from amniotic.ha_api import ClientHA, MediaPlayerEvents
+from corio.iterator import IndexList
+
+FIXTURES_DIR = Path(__file__).parent / "fixtures"
+
+
+def _fixture_json(name: str):
+    return json.loads((FIXTURES_DIR / name).read_text())
+
+
+class FakeHomeAssistantHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.requests.append(dict(method="GET", path=self.path, headers=dict(self.headers), port=self.client_address[1]))
+        self.send_json(self.server.states)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.requests.append(dict(method="POST", path=self.path, headers=dict(self.headers), port=self.client_address[1], json=json.loads(body)))
+        if self.path == "/api/template":
+            states = [state for state in self.server.states if state["entity_id"].startswith("media_player.")]
+            self.send_text(json.dumps(states))
+            return
+        self.send_json([])
+
+    def send_json(self, data):
+        self.send_text(json.dumps(data), content_type="application/json")
+
+    def send_text(self, text, content_type="text/plain"):
+        payload = text.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeHomeAssistant(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, states):
+        super().__init__(("127.0.0.1", 0), FakeHomeAssistantHandler)
+        self.states = states
+        self.requests = []
+
+    @property
+    def url(self):
+        host, port = self.server_address
+        return f"http://{host}:{port}/api"
+
+
+@pytest.fixture
+def fake_ha(monkeypatch):
+    server = FakeHomeAssistant(_fixture_json("ha_states.json"))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    fake_settings_mod = ModuleType("amniotic.settings")
+    fake_settings_mod.settings = SimpleNamespace(ha_core_api=server.url, token="token123", stream_url="http://amniotic.local:8007")
+    monkeypatch.setitem(sys.modules, "amniotic.settings", fake_settings_mod)
+
+    client = ClientHA()
+    monkeypatch.setattr("amniotic.device.client_ha", client)
+    monkeypatch.setattr("amniotic.controls.client_ha", client)
+
+    yield server
+
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.asyncio
+async def test_get_media_players_fetches_filtered_states_over_pooled_connection(fake_ha):
+    players = await Amniotic.get_media_players(object())
+    players_again = await Amniotic.get_media_players(object())
+
+    assert [player.entity_id for player in players] == [
+        "media_player.living_room",
+        "media_player.office",
+    ]
+    assert players == players_again
+
+    first, second = fake_ha.requests
+    assert first["method"] == "POST"
+    assert first["path"] == "/api/template"
+    assert "states.media_player" in first["json"]["template"]
+    assert first["headers"]["Authorization"] == "Bearer token123"
+    assert first["port"] == second["port"]
+
+
+@pytest.mark.asyncio
+async def test_play_stream_button_posts_play_media(fake_ha):
+    button = SimpleNamespace(url=f"{fake_ha.url}/services/media_player/play_media")
+    state = SimpleNamespace(entity_id="media_player.office")
+
+    await PlayStreamButton.post(button, state, "http://amniotic.local:8007/channel/mediaplayeroffice")
+
+    request, = fake_ha.requests
+    assert request["method"] == "POST"
+    assert request["path"] == "/api/services/media_player/play_media"
+    assert request["headers"]["Authorization"] == "Bearer token123"
+    assert request["json"] == {
+        "entity_id": "media_player.office",
+        "media_content_id": "http://amniotic.local:8007/channel/mediaplayeroffice",
+        "media_content_type": "music",
+    }
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("player_state, is_posted", [("playing", False), ("paused", True)])
+async def test_play_stream_button_only_skips_play_media_for_players_still_playing(fake_ha, player_state, is_posted):
+    from amniotic.channel import Channel
+    from amniotic.theme import ThemeStream
+
+    sleep = SimpleNamespace(name="Sleep", is_enabled=True, instances=[])
+    rain = SimpleNamespace(name="Rain", is_enabled=True, instances=[])
+    channel = Channel(player="media_player.office", theme_def=sleep)
+    stream = ThemeStream(theme_def=sleep, request=SimpleNamespace(client=("127.0.0.1", 1234)))
+    channel.add(stream)
+
+    state = MediaState(entity_id="media_player.office", state=player_state)
+    device = SimpleNamespace(media_player_states=SimpleNamespace(current=state), get_channel=lambda _player: channel)
+    button = SimpleNamespace(instance=object(), device=device, theme=rain, url=f"{fake_ha.url}/services/media_player/play_media")
+    button.post = lambda state, url: PlayStreamButton.post(button, state, url)
+
+    await PlayStreamButton.command(button, None)
+
+    assert stream.theme_next is rain
+    assert [request["json"]["media_content_id"] for request in fake_ha.requests] == ([channel.url] if is_posted else [])
+
+
+def test_deleting_a_theme_takes_it_off_channels():
+    from amniotic.channel import Channel
+
+    sleep, rain = SimpleNamespace(name="Sleep"), SimpleNamespace(name="Rain")
+    device = SimpleNamespace(channels=IndexList([Channel(player="media_player.office", theme_def=sleep), Channel(player="media_player.kitchen", theme_def=rain)]))
+
+    Amniotic.forget_theme(device, sleep)
+
+    assert [channel.theme_def for channel in device.channels] == [None, rain]
+
+
+@pytest.mark.asyncio
+async def test_reaping_a_channel_stream_stops_its_media_player(fake_ha):
+    from amniotic.channel import Channel
+    from amniotic.reaper import Reaper
+    from amniotic.theme import ThemeStream
+
+    theme_def = SimpleNamespace(name="Sleep", is_enabled=False, instances=[])
+    stream = ThemeStream(theme_def=theme_def, request=SimpleNamespace(client=("127.0.0.1", 1234)))
+    channel = Channel(player="media_player.office", theme_def=theme_def)
+    channel.add(stream)
+    device = SimpleNamespace(reaper=Reaper(stop_player=True), channels=IndexList([channel]))
+
+    await Amniotic.reap_stream(device, stream, "Idle.")
+
+    request, = fake_ha.requests
+    assert request["path"] == "/api/services/media_player/media_stop"
+    assert request["json"] == {"entity_id": "media_player.office"}
+    assert stream.stop_reason == "Idle."
+
+
+class FakeHomeAssistantWebsocket:
+    def __init__(self, events):
+        self.events = events
+        self.auth = None
+        self.subscription = None
+
+    async def handler(self, websocket):
+        await websocket.send(json.dumps({"type": "auth_required"}))
+        self.auth = json.loads(await websocket.recv())
+        await websocket.send(json.dumps({"type": "auth_ok"}))
+
+        self.subscription = json.loads(await websocket.recv())
+        await websocket.send(json.dumps({"id": self.subscription["id"], "type": "result", "success": True}))
+
+        for data in self.events:
+            await websocket.send(json.dumps({"id": self.subscription["id"], "type": "event", "event": {"event_type": "state_changed", "data": data}}))
+
+        await websocket.wait_closed()
+
+
+def _state_changed(entity_id, new_state):
+    return {"entity_id": entity_id, "old_state": None, "new_state": new_state}
+
+
+@pytest.mark.asyncio
+async def test_media_player_events_forwards_media_player_changes_only():
+    stand_in = FakeHomeAssistantWebsocket([
+        _state_changed("sensor.temperature_hallway", {"entity_id": "sensor.temperature_hallway", "state": "21.5", "attributes": {}}),
+        _state_changed("media_player.kitchen", {"entity_id": "media_player.kitchen", "state": "idle", "attributes": {"friendly_name": "Kitchen"}}),
+        _state_changed("media_player.office", None),
+    ])
+    received = []
+    connected = []
+    done = asyncio.Event()
+
+    async def on_state(entity_id, new_state):
+        received.append((entity_id, new_state))
+        if len(received) == 2:
+            done.set()
+
+    async def on_connect():
+        connected.append(True)
+
+    async with websockets.serve(stand_in.handler, "127.0.0.1", 0) as server:
+        host, port = server.sockets[0].getsockname()[:2]
+        client = SimpleNamespace(url_websocket=f"ws://{host}:{port}/api/websocket", token="token123")
+        events = MediaPlayerEvents(client=client, on_state=on_state, on_connect=on_connect)
+
+        task = asyncio.create_task(events.subscribe())
+        await asyncio.wait_for(done.wait(), timeout=5)
+        task.cancel()
+
+    assert stand_in.auth == {"type": "auth", "access_token": "token123"}
+    assert stand_in.subscription["type"] == "subscribe_events"
+    assert stand_in.subscription["event_type"] == "state_changed"
+    assert connected == [True]
+    assert [entity_id for entity_id, _ in received] == ["media_player.kitchen", "media_player.office"]
+    assert received[1][1] is None
+
+
+@pytest.mark.asyncio
+async def test_update_media_player_applies_incremental_changes():
+    published = []
+
+    async def select_state():
+        published.append(list(device.media_player_states.friendly_name.keys()))
+
+    device = SimpleNamespace(
+        media_player_states=IndexList([MediaState(entity_id="media_player.office", state="idle", friendly_name="Office")]),
+        select_media_player=SimpleNamespace(state=select_state),
+    )
+    device.publish_media_players = lambda: Amniotic.publish_media_players(device)
+
+    office = device.media_player_states.current
+
+    await Amniotic.update_media_player(device, "media_player.office", {"entity_id": "media_player.office", "state": "playing", "attributes": {"friendly_name": "Office"}})
+    await Amniotic.update_media_player(device, "media_player.kitchen", {"entity_id": "media_player.kitchen", "state": "idle", "attributes": {"friendly_name": "Kitchen"}})
+    await Amniotic.update_media_player(device, "media_player.office", None)
+
+    assert office.state == "idle"
+    assert published == [["Office", "Kitchen"], ["Kitchen"]]
+    assert device.media_player_states.current is None
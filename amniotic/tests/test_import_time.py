@@ -0,0 +1,46 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).parents[2]
+
+STARTUP_MODULES = ["amniotic.settings", "amniotic.client", "amniotic.device"]
+
+# Only imported on first use: a stream, an API launch or a download.
+DEFERRED_MODULES = ["av", "numpy", "fastapi", "starlette", "corio.youtube", "pytubefix", "amniotic.api"]
+
+# Cumulative import time of the startup modules, in seconds. Generous, as CI hosts vary; it's there to catch gross
+# regressions like a heavy dependency creeping back onto the import path.
+IMPORT_TIME_BUDGET = 5.0
+
+
+def _import_times(*modules) -> dict[str, float]:
+    """
+
+    Import `modules` in a fresh interpreter with `-X importtime` and return the cumulative time (seconds) of each module imported.
+
+    """
+    env = os.environ | dict(PYTHONPATH=str(ROOT))
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {', '.join(modules)}"],
+        cwd=ROOT, env=env, capture_output=True, text=True, check=True,
+    )
+
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.removeprefix("import time:").split("|")
+        times[name.strip()] = int(cumulative) / 1e6
+    return times
+
+
+def test_startup_imports_defer_heavy_dependencies():
+    times = _import_times(*STARTUP_MODULES)
+
+    assert set(STARTUP_MODULES) <= times.keys()
+    assert [module for module in DEFERRED_MODULES if module in times] == []
+
+    total = sum(times[module] for module in STARTUP_MODULES)
+    assert total < IMPORT_TIME_BUDGET, f"Startup imports took {total:.2f}s, over the {IMPORT_TIME_BUDGET}s budget."
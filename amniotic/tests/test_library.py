@@ -0,0 +1,163 @@
+import asyncio
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+import amniotic.device
+
+from amniotic.controls import SelectCategory, SelectRecording
+from amniotic.device import Amniotic
+from amniotic.library import CATEGORY_ROOT, Library
+from amniotic.theme import IndexInstances
+from corio import Path
+
+
+def _touch(path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b"")
+    return path
+
+
+@pytest.fixture
+def path_audio(tmp_path):
+    for name in ["Waves.mp3", "Rain/Heavy.mp3", "Rain/light.mp3", "Rain/Storm.mp3", "Rain/Drizzle.mp3", "Nature/Birds/Dawn.mp3"]:
+        _touch(tmp_path / name)
+    _touch(tmp_path / ".renditions" / "Waves.mp3.flac")
+    _touch(tmp_path / "Rain" / ".renditions" / "Heavy.mp3.flac")
+    _touch(tmp_path / "Rain" / ".DS_Store")
+    return Path(tmp_path)
+
+
+def _device(path_audio, page_size=100):
+    device = SimpleNamespace(path_audio=path_audio, metas=Library(page_size=page_size))
+    Amniotic.refresh_metas(device)
+    return device
+
+
+def test_refresh_metas_indexes_subfolders_and_skips_hidden(path_audio):
+    device = _device(path_audio)
+    library = device.metas
+
+    assert len(library) == 6
+    assert {meta.path.relative_to(path_audio).as_posix() for meta in library} == {
+        "Waves.mp3", "Rain/Heavy.mp3", "Rain/light.mp3", "Rain/Storm.mp3", "Rain/Drizzle.mp3", "Nature/Birds/Dawn.mp3",
+    }
+    assert library.path_str[str(path_audio / "Rain" / "Storm.mp3")].category == "Rain"
+    assert library.path[path_audio / "Waves.mp3"].category == ""
+
+    assert Amniotic.refresh_metas(device) is False
+    _touch(path_audio / "Rain" / "Hail.mp3")
+    assert Amniotic.refresh_metas(device) is True
+    assert library.path[path_audio / "Rain" / "Hail.mp3"].category == "Rain"
+
+
+def test_library_pages_categories_into_small_sorted_options(path_audio):
+    library = _device(path_audio, page_size=2).metas
+
+    assert list(library.options) == [CATEGORY_ROOT, "Nature/Birds", "Rain (1/2)", "Rain (2/2)"]
+    assert list(library.options["Rain (1/2)"]) == ["Drizzle", "Heavy"]
+    assert list(library.options["Rain (2/2)"]) == ["light", "Storm"]
+
+    storm = library.path[path_audio / "Rain" / "Storm.mp3"]
+    assert library.get_option(storm) == "Rain (2/2)"
+    assert library.get_page(storm) == library.options["Rain (2/2)"]
+    assert library.get_option(None) == CATEGORY_ROOT
+
+
+class FakeControl:
+    def __init__(self):
+        self.calls = 0
+
+    async def state(self):
+        self.calls += 1
+
+
+@pytest.mark.asyncio
+async def test_category_select_narrows_recording_select(path_audio):
+    device = _device(path_audio, page_size=2)
+    theme = SimpleNamespace(name="Sleep", instances=IndexInstances())
+    device.themes = SimpleNamespace(current=theme)
+    device.swt_play, device.nbr_volume = FakeControl(), FakeControl()
+
+    announced = []
+
+    async def announce(control):
+        announced.append((control.name, list(control.options)))
+
+    category = SelectCategory(options=[])
+    recording = SelectRecording(options=[])
+    for control in (category, recording):
+        control.device = device
+        object.__setattr__(control, "announce", lambda control=control: announce(control))
+    device.select_category, device.select_recording = category, recording
+
+    assert await recording.state() == "Dawn"
+    assert announced == [("Recording", ["Dawn"]), ("Recording Category", [CATEGORY_ROOT, "Nature/Birds", "Rain (1/2)", "Rain (2/2)"])]
+    assert await category.state() == "Nature/Birds"
+
+    announced.clear()
+    assert await category.command("Rain (2/2)") == "Rain (2/2)"
+    assert recording.instance.name == "light"
+    assert announced == [("Recording", ["light", "Storm"])]
+    assert await category.state() == "Rain (2/2)"
+
+    await recording.command("Storm")
+    assert recording.instance.path == str(path_audio / "Rain" / "Storm.mp3")
+    assert [instance.name for instance in theme.instances] == ["Dawn", "light", "Storm"]
+
+
+@pytest.mark.asyncio
+async def test_recordings_sharing_a_name_are_labelled_and_selected_by_file_name(path_audio):
+    _touch(path_audio / "Rain" / "Storm.flac")
+    device = _device(path_audio)
+    theme = SimpleNamespace(name="Sleep", instances=IndexInstances())
+    device.themes = SimpleNamespace(current=theme)
+    device.swt_play, device.nbr_volume = FakeControl(), FakeControl()
+
+    assert list(device.metas.options["Rain"]) == ["Drizzle", "Heavy", "light", "Storm.flac", "Storm.mp3"]
+
+    recording = SelectRecording(options=[])
+    recording.device = device
+    device.select_category, device.select_recording = FakeControl(), recording
+    object.__setattr__(recording, "announce", FakeControl().state)
+
+    recording.set_default(device.metas.path[path_audio / "Rain" / "Storm.mp3"])
+    assert await recording.state() == "Storm.mp3"
+    await recording.command("Storm.flac")
+    assert recording.instance.path == str(path_audio / "Rain" / "Storm.flac")
+    assert await recording.state() == "Storm.flac"
+
+
+@pytest.mark.asyncio
+async def test_refresh_task_walks_the_audio_path_off_the_event_loop_and_keeps_its_ingest(path_audio, monkeypatch):
+    device = _device(path_audio)
+    device.refresh_metas = lambda paths_disk=None: Amniotic.refresh_metas(device, paths_disk)
+    device.sns_undecodable, device.bsn_recordings_present, device.select_recording = FakeControl(), FakeControl(), FakeControl()
+    device.ingest_tasks = set()
+    ingested = asyncio.Event()
+
+    async def ingest():
+        await ingested.wait()
+
+    device.ingest = ingest
+
+    walked = []
+
+    def iter_paths_audio(path):
+        walked.append(threading.current_thread())
+        return iter_paths_audio_orig(path)
+
+    iter_paths_audio_orig = amniotic.device.iter_paths_audio
+    monkeypatch.setattr("amniotic.device.iter_paths_audio", iter_paths_audio)
+
+    _touch(path_audio / "Rain" / "Hail.mp3")
+    await Amniotic._refresh_metas_task_logic(device)
+
+    assert walked and walked[0] is not threading.main_thread()
+    assert path_audio / "Rain" / "Hail.mp3" in device.metas.path
+    task, = device.ingest_tasks
+
+    ingested.set()
+    await task
+    assert not device.ingest_tasks
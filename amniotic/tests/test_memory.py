@@ -0,0 +1,88 @@
+from types import SimpleNamespace
+
+from amniotic import memory
+from amniotic.admission import Admission
+from amniotic.memory import MB, MemoryManager
+
+
+class FakeLibc:
+    def __init__(self):
+        self.calls = 0
+
+    def malloc_trim(self, _padding):
+        self.calls += 1
+
+
+def _manager(monkeypatch, rss, **kwargs):
+    manager = MemoryManager(**kwargs)
+    manager.libc = FakeLibc()
+    monkeypatch.setattr(manager, "get_rss", lambda: rss[0] * MB)
+    return manager
+
+
+def test_memory_manager_trims_heap_periodically_when_under_budget(monkeypatch):
+    times = iter([100.0, 100.0, 101.0, 131.0, 131.0])
+    monkeypatch.setattr(memory.time, "monotonic", lambda: next(times))
+    manager = _manager(monkeypatch, rss=[100], budget=500, trim_interval=30)
+
+    manager.check()
+    manager.check()
+    manager.check()
+
+    assert manager.libc.calls == 1
+    assert not manager.is_exhausted
+
+
+def test_memory_manager_evicts_caches_in_order_until_under_budget(monkeypatch):
+    rss = [900]
+    evicted = []
+
+    def evictor(name, freed):
+        def evict():
+            evicted.append(name)
+            rss[0] -= freed
+        return evict
+
+    manager = _manager(monkeypatch, rss=rss, budget=500)
+    manager.register("seek tables", evictor("seek tables", 300))
+    manager.register("pcm", evictor("pcm", 300))
+    manager.register("renditions", evictor("renditions", 300))
+
+    manager.check()
+    assert evicted == ["seek tables", "pcm"]
+    assert not manager.is_exhausted
+    assert manager.libc.calls == 0
+
+
+def test_memory_manager_refuses_streams_while_budget_exhausted(monkeypatch):
+    rss = [900]
+    manager = _manager(monkeypatch, rss=rss, budget=500)
+    manager.register("seek tables", lambda: None)
+    admission = Admission(cpu_limit=None, reconnect_limit=None, memory=manager)
+    theme_def = SimpleNamespace(name="Sleep")
+
+    manager.check()
+    assert manager.is_exhausted
+    assert manager.libc.calls == 1
+    rejection = admission.check(streams=[], theme_def=theme_def, host="10.0.0.1")
+    assert rejection.reason == "Memory usage 900MB is over the budget of 500MB."
+
+    rss[0] = 400
+    manager.check()
+    assert not manager.is_exhausted
+    assert admission.check(streams=[], theme_def=theme_def, host="10.0.0.1") is None
+
+
+def test_memory_manager_collects_at_most_once_per_interval_while_over_budget(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(memory.time, "monotonic", lambda: now[0])
+    collections = []
+    monkeypatch.setattr(memory.gc, "collect", lambda: collections.append(now[0]))
+    manager = _manager(monkeypatch, rss=[900], budget=500, collect_interval=60)
+
+    for now[0] in range(0, 125, 5):
+        manager.check()
+
+    assert collections == [0, 60, 120]
+    assert manager.libc.calls == 3
+    assert manager.is_exhausted
@@ -0,0 +1,45 @@
+from contextlib import nullcontext
+
+from amniotic import profiling
+from amniotic.profiling import Profiler
+
+
+def test_profiler_samples_only_when_enabled():
+    profiler = Profiler(every=4)
+
+    assert [i for i in range(10) if profiler.is_sampled(i)] == []
+
+    profiler.set_enabled(True)
+
+    assert [i for i in range(10) if profiler.is_sampled(i)] == [0, 4, 8]
+
+
+def test_profiler_aggregates_stages_and_flushes_spans(monkeypatch):
+    spans = []
+
+    def fake_span(message, **attributes):
+        spans.append(attributes)
+        return nullcontext()
+
+    monkeypatch.setattr(profiling.logger, "span", fake_span)
+
+    clock = iter([1_000_000, 1_000_000, 4_000_000, 4_000_000, 5_000_000, 5_000_000])
+    monkeypatch.setattr(profiling.time, "perf_counter_ns", lambda: next(clock))
+
+    profiler = Profiler(every=1, flush_interval=60)
+    profiler.set_enabled(True)
+
+    started = profiler.record("decode", 0)
+    profiler.record("decode", started)
+
+    assert spans == []
+    assert profiler.stats["decode"].count == 2
+    assert profiler.stats["decode"].max_ms == 3.0
+
+    profiler.flush_interval = 0
+    profiler.record("encode", 4_000_000)
+
+    assert [span["stage"] for span in spans] == ["decode", "encode"]
+    assert spans[0]["samples"] == 2
+    assert spans[0]["mean_ms"] == 2.0
+    assert profiler.stats == {}
@@ -0,0 +1,65 @@
+import pytest
+
+from amniotic.client import ClientAmniotic
+from amniotic.publisher import StatePublisher
+
+
+class RecordingPublish:
+    def __init__(self):
+        self.calls = []
+
+    async def __call__(self, topic, payload, qos=0, retain=False):
+        self.calls.append((topic, payload, retain))
+
+
+@pytest.mark.asyncio
+async def test_publisher_coalesces_a_cascade_into_one_diff_only_flush():
+    publish = RecordingPublish()
+    publisher = StatePublisher(publish=publish)
+
+    await publisher.publish("amniotic/theme/state", "Sleep")
+    await publisher.publish("amniotic/streamable/state", "ON")
+    await publisher.publish("amniotic/streamable/state", "OFF")
+    await publisher.publish("amniotic/streamable/state", "ON")
+
+    assert publish.calls == []
+
+    await publisher.flush_task
+
+    assert publish.calls == [
+        ("amniotic/theme/state", "Sleep", True),
+        ("amniotic/streamable/state", "ON", True),
+    ]
+
+    await publisher.publish("amniotic/theme/state", "Sleep")
+    await publisher.publish("amniotic/volume/state", "20")
+    await publisher.flush_task
+
+    assert publish.calls[2:] == [("amniotic/volume/state", "20", True)]
+
+
+@pytest.mark.asyncio
+async def test_publisher_reset_republishes_after_reconnect():
+    publish = RecordingPublish()
+    publisher = StatePublisher(publish=publish)
+
+    await publisher.publish("amniotic/theme/state", "Sleep")
+    await publisher.flush_task
+    publisher.reset()
+    await publisher.publish("amniotic/theme/state", "Sleep")
+    await publisher.flush_task
+
+    assert len(publish.calls) == 2
+
+
+@pytest.mark.asyncio
+async def test_client_routes_retained_messages_through_publisher():
+    client = object.__new__(ClientAmniotic)
+    publish = RecordingPublish()
+    client.publisher = StatePublisher(publish=publish)
+
+    await ClientAmniotic.publish(client, "amniotic/theme/state", "Sleep", retain=True)
+    await ClientAmniotic.publish(client, "amniotic/theme/state", "Nap", retain=True)
+    await client.publisher.flush_task
+
+    assert publish.calls == [("amniotic/theme/state", "Nap", True)]
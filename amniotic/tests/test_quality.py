@@ -0,0 +1,76 @@
+from types import SimpleNamespace
+
+from amniotic.quality import QUALITY_LEVELS, QualityController
+from amniotic.tests.conftest import FakeRecordingStream
+
+
+def _streams(*aheads):
+    return [SimpleNamespace(ahead=ahead, chunks_sent=1) for ahead in aheads]
+
+
+def test_quality_controller_degrades_in_steps_and_recovers(clock):
+    quality = QualityController(hold=10, recover_after=60, clock=clock)
+
+    assert quality.update(_streams(0.02, 0.01)) is False
+    assert quality.update([SimpleNamespace(ahead=-5, chunks_sent=0)]) is False
+    assert quality.headroom is None
+
+    # Most streams falling behind is enough, but each step is held before the next.
+    assert quality.update(_streams(0.02, -0.5, -0.5)) is True
+    assert quality.level is QUALITY_LEVELS[1]
+    clock.now = 5
+    assert quality.update(_streams(-0.5)) is False
+    clock.now = 10
+    assert quality.update(_streams(-0.5)) is True
+    for clock.now in range(20, 100, 10):
+        quality.update(_streams(-0.5))
+    assert quality.level is QUALITY_LEVELS[-1]
+
+    # Recovery waits for a sustained period without lag, and is a step at a time too.
+    clock.now = 100
+    assert quality.update(_streams(0.01)) is False
+    clock.now = 159
+    assert quality.update(_streams(0.01)) is False
+    clock.now = 160
+    assert quality.update(_streams(0.01)) is True
+    assert quality.level is QUALITY_LEVELS[-2]
+    clock.now = 200
+    quality.update(_streams(-0.5))
+    clock.now = 259
+    assert quality.update(_streams(0.01)) is False
+    assert quality.index == 3
+
+
+def test_quality_controller_ignores_one_slow_reader_among_healthy_streams(clock):
+    quality = QualityController(hold=10, clock=clock)
+
+    for clock.now in range(0, 100, 10):
+        assert quality.update(_streams(0.02, 0.01, -30.0)) is False
+    assert quality.level is QUALITY_LEVELS[0]
+    assert quality.headroom == 0.01
+
+
+def test_theme_stream_switches_encoder_when_quality_changes(theme_stream):
+    quality = QualityController()
+    stream = theme_stream(recordings=[FakeRecordingStream()], quality=quality)
+
+    output = stream.__iter__()
+    next(output)
+    encoder = stream.output
+    assert stream.get_status()["quality"] == "Full"
+    assert stream.block_size == 1_152
+
+    quality.index = 2
+    next(output)
+    assert stream.output is not encoder
+    assert stream.quality_level.compression_level == 7
+    assert stream.get_status()["quality"] == "Fast Encoder, 100ms Blocks"
+    # Already-running streams keep their block size. Only new ones pick up the larger blocks.
+    assert stream.block_size == 1_152
+    output.close()
+
+    stream = theme_stream(recordings=[FakeRecordingStream()], quality=quality)
+    output = stream.__iter__()
+    next(output)
+    assert stream.block_size == 4 * 1_152
+    output.close()
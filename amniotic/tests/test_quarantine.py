@@ -0,0 +1,70 @@
+import os
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import numpy as np
+import pytest
+
+from amniotic.quarantine import Quarantine, quarantine
+from amniotic.theme import ThemeStream
+from corio import Path
+
+
+@pytest.fixture(autouse=True)
+def clear_quarantine():
+    quarantine.failures.clear()
+    yield
+    quarantine.failures.clear()
+
+
+def test_quarantine_backs_off_exponentially_and_lifts_when_file_changes(tmp_path):
+    path = Path(tmp_path / "bad.mp3")
+    path.write_text("not audio")
+    cache = Quarantine(initial=10, maximum=25)
+
+    assert not cache.is_blocked(path)
+    backoffs = []
+    for _ in range(3):
+        failure = cache.add(path, ValueError("Invalid data"))
+        backoffs.append(round(failure.backoff))
+        assert cache.is_blocked(path)
+    assert backoffs == [10, 20, 25]
+    assert cache.get_status()[str(path)] == dict(error="ValueError: Invalid data", failures=3, retry_in=25)
+
+    failure.retry_at = 0
+    assert not cache.is_blocked(path)
+
+    cache.add(path, ValueError("Invalid data"))
+    os.utime(path, (path.stat().st_mtime + 10,) * 2)
+    assert not cache.is_blocked(path)
+    assert len(cache) == 0
+
+
+def test_mixer_skips_undecodable_recording_with_silence(tmp_path):
+    path = Path(tmp_path / "bad.mp3")
+    path.write_text("not audio")
+    instance = SimpleNamespace(path=str(path), name="bad", volume=1.0, is_enabled=True, offset=None, meta=SimpleNamespace(path=path))
+    theme_def = SimpleNamespace(name="Sleep", instances=[instance], is_enabled=True)
+    stream = ThemeStream(theme_def=theme_def, request=SimpleNamespace(client=("127.0.0.1", 1234)))
+
+    from corio import av
+    with patch("corio.av.open", wraps=av.open) as open:
+        chunks = stream.iter_chunks()
+        for _ in range(50):
+            assert not np.any(next(chunks))
+        chunks.close()
+
+    # One probe, not one per chunk.
+    assert open.call_count == 1
+    assert quarantine.is_blocked(path)
+    assert stream.recording_streams[0].is_failed
+
+    quarantine.failures[path].retry_at = 0
+    with patch("corio.av.open", wraps=av.open) as open:
+        chunks = stream.iter_chunks()
+        next(chunks)
+        chunks.close()
+    assert open.call_count == 1
+    assert quarantine.failures[path].failures == 2
+
+    stream.close()
@@ -0,0 +1,99 @@
+import asyncio
+
+import pytest
+from starlette.background import BackgroundTask
+from starlette.concurrency import iterate_in_threadpool
+
+from amniotic.api import StreamResponse
+from amniotic.reaper import Reaper
+from amniotic.sessions import SessionCache
+from amniotic.tests.conftest import FakeRecordingStream
+
+
+def test_reaper_finds_streams_silent_or_disabled_for_too_long(theme_stream):
+    now = [0.0]
+    reaper = Reaper(silence=30, disabled=10, clock=lambda: now[0])
+    playing, silent, disabled = theme_stream(), theme_stream(), theme_stream(is_enabled=False)
+    for stream in (playing, silent, disabled):
+        stream.heard_at = 0.0
+
+    assert reaper.check([playing, silent, disabled]) == []
+
+    now[0] = 10 * 60
+    playing.heard_at = now[0]
+    assert reaper.check([playing, silent, disabled]) == [(disabled, 'Theme "Sleep" has had no recordings enabled for 10 minutes.')]
+
+    # Re-enabling restarts the clock.
+    disabled.theme_def.is_enabled = True
+    reaper.check([disabled])
+    disabled.theme_def.is_enabled = False
+    now[0] = 15 * 60
+    assert reaper.check([disabled]) == []
+
+    now[0] = 30 * 60
+    playing.heard_at = now[0]
+    idle = reaper.check([playing, silent])
+    assert [stream for stream, _reason in idle] == [silent]
+    assert reaper.disabled_since == {}
+
+    silent.stop("Idle.")
+    assert reaper.check([silent]) == []
+
+    assert Reaper(silence=None, disabled=None, clock=lambda: now[0]).check([silent, disabled]) == []
+
+
+def test_stopped_stream_ends_and_only_sound_counts_as_heard(theme_stream):
+    recordings = []
+    stream = theme_stream(recordings=recordings, sessions=SessionCache())
+    stream.heard_at = -1.0
+
+    output = iter(stream)
+    next(output)
+    assert stream.heard_at == -1.0
+
+    recordings.append(FakeRecordingStream(value=1))
+    next(output)
+    assert stream.heard_at > 0
+
+    stream.stop("Idle.")
+    assert list(output) == []
+    assert stream._is_closed
+    assert len(stream.sessions) == 0
+
+
+@pytest.mark.asyncio
+async def test_stopped_stream_stalled_on_a_paused_player_is_released_after_grace(monkeypatch, theme_stream):
+    monkeypatch.setattr("amniotic.api.STOP_POLL", 0.01)
+    stream = theme_stream()
+    released = []
+
+    async def release():
+        released.append(stream)
+
+    def blocks():
+        while True:
+            yield b"audio"
+
+    response = StreamResponse(stream, grace=0.05, background=BackgroundTask(release))
+    response.body_iterator = iterate_in_threadpool(blocks())
+
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+        if message.get("body"):
+            # A paused player: it stopped reading, so sending never completes.
+            await asyncio.Event().wait()
+
+    async def receive():
+        await asyncio.Event().wait()
+
+    serving = asyncio.create_task(response({"type": "http", "asgi": {"spec_version": "2.4"}}, receive, send))
+    await asyncio.sleep(0.05)
+    assert not serving.done() and not released
+
+    stream.stop("Idle.")
+    await asyncio.wait_for(serving, 1)
+
+    assert released == [stream]
+    assert sent[-1]["more_body"] is True
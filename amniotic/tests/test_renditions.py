@@ -0,0 +1,162 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import av
+import numpy as np
+import pytest
+
+from amniotic.recording import RecordingThemeStream
+from amniotic.renditions import Loudness, Transcoder, get_path_metadata, get_path_rendition, is_rendition_current, read_metadata, transcode
+from corio import Path
+
+
+def _write_wav(path, seconds=1.0, rate=48_000):
+    samples = int(seconds * rate)
+    tone = (np.sin(2 * np.pi * 440 * np.arange(samples) / rate) * 10_000).astype(np.int16)
+    data = np.ascontiguousarray(np.stack([tone, tone]).T.reshape(1, -1))
+
+    with av.open(str(path), mode="w") as output:
+        stream = output.add_stream("pcm_s16le", rate=rate, layout="stereo")
+        frame = av.AudioFrame.from_ndarray(data, format="s16", layout="stereo")
+        frame.rate = rate
+        for packet in [*stream.encode(frame), *stream.encode(None)]:
+            output.mux(packet)
+    return Path(path)
+
+
+def test_transcode_writes_mono_44k_flac_rendition(tmp_path):
+    path = _write_wav(tmp_path / "rain.wav")
+    path_rendition = get_path_rendition(path)
+
+    assert path_rendition == tmp_path / ".renditions" / "rain.wav.flac"
+    assert not is_rendition_current(path)
+
+    transcode(str(path), str(path_rendition))
+
+    with av.open(str(path_rendition)) as container:
+        stream = container.streams.audio[0]
+        assert (stream.codec_context.name, stream.rate, stream.layout.name) == ("flac", 44_100, "mono")
+        assert sum(frame.samples for frame in container.decode(stream)) == 44_100
+    assert is_rendition_current(path)
+    assert sorted(path_rendition.parent.iterdir()) == [path_rendition, get_path_metadata(path)]
+
+    # A 440Hz sine at about -10 dBFS peak: around -14 LUFS, so it's turned down to the -18 LUFS target.
+    loudness = read_metadata(path).loudness
+    assert loudness.loudness == pytest.approx(-14, abs=0.5)
+    assert loudness.peak == pytest.approx(10_000 / 32_768, abs=0.01)
+    assert loudness.gain_db == pytest.approx(-4, abs=0.5)
+
+    os.utime(path, (path_rendition.stat().st_mtime + 10,) * 2)
+    assert not is_rendition_current(path)
+
+
+def test_loudness_gain_respects_peak_ceiling_and_maximum():
+    assert Loudness(loudness=-30, peak=0.5).gain_db == pytest.approx(-1 + 20 * np.log10(2))
+    assert Loudness(loudness=-40, peak=0.01).gain_db == 12
+    assert Loudness(loudness=-70, peak=0).gain_db == 12
+    assert Loudness(loudness=-18, peak=0.5).gain == pytest.approx(1)
+
+
+@pytest.mark.asyncio
+async def test_transcoder_ingests_new_recordings_and_skips_failures(tmp_path):
+    progress = []
+
+    async def on_progress():
+        progress.append((transcoder.status, transcoder.percentage))
+
+    transcoder = Transcoder(on_progress=on_progress, progress_interval=0)
+    transcoder.executor = ThreadPoolExecutor(max_workers=1)
+
+    good = _write_wav(tmp_path / "rain.wav", seconds=0.2)
+    bad = Path(tmp_path / "notes.txt")
+    bad.write_text("not audio")
+
+    await transcoder.ingest([good, bad])
+
+    assert is_rendition_current(good)
+    assert transcoder.failed == {bad}
+    assert not get_path_rendition(bad).exists()
+    assert progress[0] == ("Transcoding 1 of 2...", 0)
+    assert progress[-1] == (None, None)
+
+    progress.clear()
+    await transcoder.ingest([good, bad])
+    assert progress == []
+
+    orphan = get_path_rendition(tmp_path / "deleted.wav")
+    orphan.write_bytes(b"")
+    transcoder.prune(Path(tmp_path), [good, bad])
+    assert not orphan.exists()
+    assert get_path_rendition(good).exists()
+
+
+def test_recording_stream_reads_normalised_rendition_without_resampling(tmp_path):
+    path = _write_wav(tmp_path / "rain.wav")
+    transcode(str(path), str(get_path_rendition(path)))
+
+    instance = SimpleNamespace(path=str(path), volume=1.0, meta=SimpleNamespace(path=path), name="rain", offset=0)
+    stream = RecordingThemeStream(instance=instance)
+    stream.resampler = None
+
+    # Chunks are only valid until the next one is requested, so keeping them means copying them.
+    chunks = np.concatenate([next(stream).copy() for _ in range(20)], axis=1)
+    assert stream.is_rendition is True
+    assert chunks.shape == (1, RecordingThemeStream.CHUNK_SIZE * 20)
+    assert chunks.dtype == np.int16
+    assert stream.gain == pytest.approx(read_metadata(path).loudness.gain)
+    assert np.abs(chunks).max() == pytest.approx(10_000 * stream.gain, rel=0.02)
+
+    stream.close()
+
+
+def test_transcode_indexes_packets_for_seeking(tmp_path):
+    path = _write_wav(tmp_path / "rain.wav")
+    transcode(str(path), str(get_path_rendition(path)))
+    seek = read_metadata(path).seek
+
+    assert seek.samples == 44_100
+    assert seek.offsets[0] == 0
+    assert seek.offsets == sorted(seek.offsets) and seek.positions == sorted(seek.positions)
+    assert seek.find(0) == (0, seek.positions[0])
+    assert seek.find(seek.offsets[2] + 1) == (seek.offsets[2], seek.positions[2])
+    assert seek.find(10**9) == (seek.offsets[-1], seek.positions[-1])
+
+    path_metadata = get_path_metadata(path)
+    path_metadata.write_text(path_metadata.read_text().replace('"version": 2', '"version": 1'))
+    assert read_metadata(path) is None
+    assert not is_rendition_current(path)
+
+
+def _decode(path):
+    with av.open(str(path)) as container:
+        return np.concatenate([frame.to_ndarray().reshape(-1) for frame in container.decode(container.streams.audio[0])])
+
+
+def test_recording_stream_resumes_from_offset_and_randomises_concurrent_starts(tmp_path, monkeypatch):
+    path = _write_wav(tmp_path / "rain.wav")
+    transcode(str(path), str(get_path_rendition(path)))
+    seek = read_metadata(path).seek
+    samples = _decode(get_path_rendition(path))
+    offset, _ = seek.find(20_000)
+
+    instance = SimpleNamespace(path=str(path), volume=0.5, meta=SimpleNamespace(path=path), name="rain", offset=20_000)
+    stream = RecordingThemeStream(instance=instance)
+    stream.resampler = None
+
+    chunk = next(stream).reshape(-1)
+    expected = samples[offset:offset + chunk.size] * 0.5 * stream.gain
+    assert np.abs(chunk - expected).max() <= 1
+    assert stream.position > offset
+
+    # A second stream of the same recording, while the first is still playing, starts somewhere random instead.
+    monkeypatch.setattr("amniotic.recording.random.randrange", lambda stop: 30_000)
+    other = RecordingThemeStream(instance=instance)
+    other.resampler = None
+    next(other)
+    assert other.get_status()["position"] > seek.find(30_000)[0]
+    other.close()
+
+    position = stream.position
+    stream.close()
+    assert instance.offset == position
@@ -0,0 +1,102 @@
+from types import SimpleNamespace
+
+from amniotic.renditions import get_path_rendition, transcode
+from amniotic.sessions import SessionCache
+from amniotic.tests.conftest import FakeRecordingStream
+from amniotic.tests.test_renditions import _write_wav
+
+
+def _stream(host="10.0.0.5", port=1234, theme="sleep", recordings=()):
+    stream = SimpleNamespace(request=SimpleNamespace(client=(host, port)), theme_def=SimpleNamespace(id=theme), recording_streams=list(recordings), block_size=1_152)
+    return stream
+
+
+def test_session_cache_resumes_same_client_and_theme_within_ttl(clock):
+    sessions = SessionCache(ttl=10, clock=clock)
+    healthy, failed = FakeRecordingStream(), FakeRecordingStream(is_failed=True)
+
+    closing = _stream(recordings=[healthy, failed])
+    assert sessions.keep(closing)
+    assert closing.recording_streams == [failed]
+
+    assert sessions.take(_stream(host="10.0.0.6")) == []
+    assert sessions.take(_stream(theme="rain")) == []
+
+    clock.now = 5.0
+    assert sessions.take(_stream(port=5678)) == [healthy]
+    assert not healthy.closed
+    assert len(sessions) == 0
+
+
+def test_session_cache_closes_what_is_not_picked_up(clock):
+    sessions = SessionCache(ttl=10, clock=clock)
+    expired, resized = FakeRecordingStream(), FakeRecordingStream()
+
+    sessions.keep(_stream(recordings=[expired]))
+    sessions.keep(_stream(theme="rain", recordings=[resized]))
+    clock.now = 5.0
+    assert sessions.take(SimpleNamespace(**vars(_stream(theme="rain")) | dict(block_size=4_608))) == []
+    assert resized.closed
+
+    sessions.expire()
+    assert not expired.closed
+    clock.now = 10.0
+    sessions.expire()
+    assert expired.closed and len(sessions) == 0
+
+    assert not SessionCache(ttl=0).keep(_stream(recordings=[FakeRecordingStream()]))
+
+
+def _theme_def(tmp_path):
+    path = _write_wav(tmp_path / "rain.wav")
+    transcode(str(path), str(get_path_rendition(path)))
+    instance = SimpleNamespace(path=str(path), volume=1.0, meta=SimpleNamespace(path=path), name="rain", offset=0, is_enabled=True)
+    return SimpleNamespace(name="Sleep", id="sleep", is_enabled=True, instances=[instance])
+
+
+def test_reconnecting_stream_continues_decoding_where_it_left_off(tmp_path, theme_stream):
+    theme_def = _theme_def(tmp_path)
+    sessions = SessionCache()
+
+    def play(port, blocks):
+        stream = theme_stream(theme_def=theme_def, client=("10.0.0.5", port), sessions=sessions)
+        output = iter(stream)
+        for _ in range(blocks):
+            next(output)
+        recording, = stream.recording_streams
+        position = recording.position
+        output.close()
+        return recording, position
+
+    first, position = play(1234, 20)
+    assert not first._is_closed and len(sessions) == 1
+
+    second, position_resumed = play(5678, 1)
+    assert second is first
+    assert position_resumed > position
+
+    sessions.clear()
+    assert first._is_closed
+
+
+def test_kept_recording_offsets_are_saved_on_disconnect_and_again_on_expiry(tmp_path, theme_stream, clock):
+    theme_def = _theme_def(tmp_path)
+    instance, = theme_def.instances
+    saved = []
+    sessions = SessionCache(ttl=10, clock=clock, on_close=lambda: saved.append(instance.offset))
+
+    stream = theme_stream(theme_def=theme_def, client=("10.0.0.5", 1234), sessions=sessions)
+    output = iter(stream)
+    for _ in range(20):
+        next(output)
+    recording, = stream.recording_streams
+    output.close()
+
+    # What the release of the stream saves, even though its recording is still open.
+    assert instance.offset == recording.position > 0
+    assert not recording._is_closed
+
+    clock.now = 10.0
+    sessions.expire()
+    assert recording._is_closed
+    assert saved == [instance.offset]
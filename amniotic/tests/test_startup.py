@@ -0,0 +1,27 @@
+import asyncio
+
+import pytest
+
+from amniotic.startup import Timeline
+
+
+@pytest.mark.asyncio
+async def test_timeline_records_concurrent_phases():
+    timeline = Timeline()
+
+    results = await asyncio.gather(
+        timeline.run("library", asyncio.sleep(0.05, result="library")),
+        timeline.run("media_players", asyncio.sleep(0.05, result="players")),
+    )
+
+    assert results == ["library", "players"]
+    assert {phase.name for phase in timeline.phases} == {"library", "media_players"}
+    assert all(phase.duration >= 0.04 for phase in timeline.phases)
+
+    # Each phase started before the other ended, i.e. they ran concurrently rather than one after the other.
+    library, players = sorted(timeline.phases, key=lambda phase: phase.name)
+    assert library.offset < players.offset + players.duration
+    assert players.offset < library.offset + library.duration
+
+    timeline.log()
+    assert timeline.is_logged is True
@@ -1,33 +1,18 @@
+import threading
 from types import SimpleNamespace
 
 import numpy as np
 import pytest
 
-from amniotic.api import ApiAmniotic, Stream
-from amniotic import recording
+from amniotic.api import ApiAmniotic, DebugStreams, Stream
+from amniotic.admission import Admission
+from amniotic.device import Amniotic
+from amniotic.reaper import Reaper
 from amniotic.recording import RecordingThemeStream
-from amniotic.theme import ThemeStream
-
-
-def test_native_heap_trim_is_rate_limited(monkeypatch):
-    class FakeLibc:
-        def __init__(self):
-            self.calls = 0
-
-        def malloc_trim(self, _padding):
-            self.calls += 1
-
-    libc = FakeLibc()
-    times = iter([100.0, 100.0, 101.0, 131.0, 131.0])
-    monkeypatch.setattr(recording, "_libc", libc)
-    monkeypatch.setattr(recording, "_heap_trim_last", 0.0)
-    monkeypatch.setattr(recording.time, "monotonic", lambda: next(times))
-
-    recording.trim_native_heap()
-    recording.trim_native_heap()
-    recording.trim_native_heap()
-
-    assert libc.calls == 2
+from amniotic.tests.conftest import FakeRecordingStream
+from amniotic.theme import IndexThemes, ThemeStream
+from corio import Path
+from corio.iterator import IndexList
 
 
 def test_recording_stream_chunks_sample_blocks_without_losing_samples(monkeypatch):
@@ -84,8 +69,8 @@ def test_recording_stream_close_releases_container(monkeypatch):
 
     container = FakeContainer()
 
-    monkeypatch.setattr("amniotic.recording.av.open", lambda *_args, **_kwargs: container)
-    monkeypatch.setattr("amniotic.recording.av.AudioResampler", lambda **_kwargs: FakeResampler())
+    monkeypatch.setattr("corio.av.open", lambda *_args, **_kwargs: container)
+    monkeypatch.setattr("corio.av.AudioResampler", lambda **_kwargs: FakeResampler())
 
     instance = SimpleNamespace(
         path="file.mp3",
@@ -119,8 +104,10 @@ def test_theme_stream_mixes_without_attenuating_enabled_recordings(monkeypatch):
     assert mixed.tolist() == [[20_000, np.iinfo(np.int16).max]]
 
 
-def test_theme_stream_generator_close_releases_output_and_children(monkeypatch):
+def test_theme_stream_generator_close_releases_output_and_children(monkeypatch, theme_stream):
     class FakeOutputStream:
+        codec_context = SimpleNamespace(open=lambda: None, frame_size=1_152)
+
         def encode(self, _frame):
             return [b"chunk"]
 
@@ -134,16 +121,6 @@ def test_theme_stream_generator_close_releases_output_and_children(monkeypatch):
         def close(self):
             self.closed = True
 
-    class FakeRecordingStream:
-        def __init__(self):
-            self.closed = False
-
-        def __next__(self):
-            return np.zeros((1, RecordingThemeStream.CHUNK_SIZE), dtype=np.int16)
-
-        def close(self):
-            self.closed = True
-
     outputs = []
 
     def fake_open(*_args, **_kwargs):
@@ -151,15 +128,10 @@ def test_theme_stream_generator_close_releases_output_and_children(monkeypatch):
         outputs.append(output)
         return output
 
-    monkeypatch.setattr("amniotic.theme.av.open", fake_open)
+    monkeypatch.setattr("corio.av.open", fake_open)
 
-    theme_def = SimpleNamespace(name="Sleep", is_enabled=True, instances=[])
-    request = SimpleNamespace(client=("127.0.0.1", 1234), is_disconnected=lambda: False)
-    stream = ThemeStream(theme_def=theme_def, request=request)
-
-    rec_stream = FakeRecordingStream()
-    stream.recording_streams.append(rec_stream)
-    monkeypatch.setattr(stream, "get_streams", lambda: iter([rec_stream]))
+    rec_stream = FakeRecordingStream(value=0)
+    stream = theme_stream(recordings=[rec_stream])
 
     gen = iter(stream)
     next(gen)
@@ -170,22 +142,50 @@ def test_theme_stream_generator_close_releases_output_and_children(monkeypatch):
     assert stream.output is None
 
 
+class FakeDevice:
+    add_stream = Amniotic.add_stream
+    release_stream = Amniotic.release_stream
+    publish_streams = Amniotic.publish_streams
+
+    def __init__(self, themes, admission=None):
+        self.themes = themes
+        self.admission = admission or Admission(cpu_limit=None)
+        self.is_loaded = True
+        self.block_duration = None
+        self.float_bus = False
+        self.quality = None
+        self.crossfade = 0
+        self.sessions = None
+        self.reaper = Reaper()
+        self.streams = IndexList()
+        self.published = []
+
+        async def streams_state():
+            self.published.append(len(self.streams))
+
+        self.sns_streams = SimpleNamespace(state=streams_state)
+
+    def save_offsets(self):
+        pass
+
+
 @pytest.mark.asyncio
 async def test_api_stream_response_registers_background_cleanup(monkeypatch):
     theme_def = SimpleNamespace(name="Sleep", id="sleep")
-    device = SimpleNamespace(themes=SimpleNamespace(id={"sleep": theme_def}))
+    device = FakeDevice(themes=SimpleNamespace(id={"sleep": theme_def}))
     client = SimpleNamespace(device=device)
     api = ApiAmniotic(client=client)
 
     created = {}
 
     class FakeThemeStream:
-        def __init__(self, theme_def, request):
+        def __init__(self, theme_def, request, block_duration=None, is_float=False, quality=None, crossfade=None, sessions=None):
             created["stream"] = self
             self.theme_def = theme_def
             self.request = request
             self.closed = False
             self.is_enabled = True
+            self.chunks_sent = 0
 
         def __iter__(self):
             return self
@@ -198,9 +198,223 @@ async def test_api_stream_response_registers_background_cleanup(monkeypatch):
 
     monkeypatch.setattr("amniotic.api.ThemeStream", FakeThemeStream)
 
-    request = SimpleNamespace(client=("127.0.0.1", 1234))
+    request = SimpleNamespace(method="GET", client=("127.0.0.1", 1234))
     response = await api.endpoints.cls[Stream].run("sleep", request)
 
     assert response.background is not None
-    response.background.func()
+    assert device.streams == [created["stream"]]
+
+    await response.background()
+
     assert created["stream"].closed is True
+    assert device.streams == []
+    assert device.published == [1, 0]
+
+
+@pytest.mark.asyncio
+async def test_api_debug_streams_lists_live_stream_status():
+    theme_def = SimpleNamespace(name="Sleep", is_enabled=True, instances=[])
+    request = SimpleNamespace(client=("127.0.0.1", 1234))
+    stream = ThemeStream(theme_def=theme_def, request=request)
+    stream.chunks_sent = 3
+    stream.bytes_sent = 1200
+    stream.ahead = 0.25
+
+    rec_stream = RecordingThemeStream.__new__(RecordingThemeStream)
+    rec_stream.instance = SimpleNamespace(name="Rain", path="/audio/rain.mp3")
+    rec_stream.started_at = stream.started_at
+    rec_stream.started_at_str = "test"
+    rec_stream.chunks_yielded = 3
+    rec_stream.container = object()
+    rec_stream._is_closed = False
+    stream.recording_streams.append(rec_stream)
+
+    device = FakeDevice(themes=SimpleNamespace(id={}))
+    device.streams.append(stream)
+    api = ApiAmniotic(client=SimpleNamespace(device=device))
+
+    statuses = await api.endpoints.cls[DebugStreams].run()
+
+    assert len(statuses) == 1
+    status = statuses[0]
+    assert status["theme"] == "Sleep"
+    assert status["client"] == "127.0.0.1:1234"
+    assert status["chunks_sent"] == 3
+    assert status["bytes_sent"] == 1200
+    assert status["lag"] == 0.25
+    assert status["recordings"] == [
+        {
+            "name": "Rain",
+            "path": "/audio/rain.mp3",
+            "is_rendition": False,
+            "is_failed": False,
+            "position": None,
+            "started_at": stream.started_at.isoformat(),
+            "chunks": 3,
+            "is_open": True,
+            "is_closed": False,
+        }
+    ]
+
+
+@pytest.mark.asyncio
+async def test_api_stream_refuses_over_limit_with_retry_after(monkeypatch):
+    theme_def = SimpleNamespace(name="Sleep", id="sleep")
+    device = FakeDevice(themes=SimpleNamespace(id={"sleep": theme_def}), admission=Admission(stream_limit_theme=1, cpu_limit=None, retry_after=7))
+    device.streams.append(SimpleNamespace(theme_def=theme_def))
+    api = ApiAmniotic(client=SimpleNamespace(device=device))
+
+    def fail_theme_stream(**_kwargs):
+        raise AssertionError("No pipeline should be built for a refused stream.")
+
+    monkeypatch.setattr("amniotic.api.ThemeStream", fail_theme_stream)
+
+    response = await api.endpoints.cls[Stream].run("sleep", SimpleNamespace(method="GET", client=("127.0.0.1", 1234)))
+
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "7"
+
+
+def test_admission_rate_limits_reconnecting_clients(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr("amniotic.admission.time.monotonic", lambda: now[0])
+    admission = Admission(reconnect_limit=3, reconnect_window=60, cpu_limit=None)
+    theme_def = SimpleNamespace(name="Sleep")
+
+    results = []
+    for _ in range(3):
+        results.append(admission.check(streams=[], theme_def=theme_def, host="10.0.0.5"))
+        admission.record("10.0.0.5")
+        now[0] += 1
+
+    # Refused attempts, however many, aren't counted, so retrying early doesn't push the lockout back.
+    for _ in range(10):
+        results.append(admission.check(streams=[], theme_def=theme_def, host="10.0.0.5"))
+    now[0] = 61.0
+    results.append(admission.check(streams=[], theme_def=theme_def, host="10.0.0.5"))
+
+    assert results[:3] == [None, None, None]
+    assert {rejection.retry_after for rejection in results[3:13]} == {58}
+    assert results[13] is None
+    assert admission.check(streams=[], theme_def=theme_def, host="10.0.0.6") is None
+
+
+def test_admission_refuses_on_sampled_cpu_usage(monkeypatch):
+    usages = iter([0.0, 95.0, 20.0])
+    monkeypatch.setattr("psutil.cpu_percent", lambda interval=None: next(usages))
+    admission = Admission(reconnect_limit=None, cpu_limit=90)
+    theme_def = SimpleNamespace(name="Sleep")
+
+    # The first sample is only a baseline, so nothing is refused on it.
+    admission.sample_cpu()
+    assert admission.cpu_usage is None
+    assert admission.check(streams=[], theme_def=theme_def, host="10.0.0.5") is None
+
+    admission.sample_cpu()
+    assert "95%" in admission.check(streams=[], theme_def=theme_def, host="10.0.0.5").reason
+    admission.sample_cpu()
+    assert admission.check(streams=[], theme_def=theme_def, host="10.0.0.5") is None
+
+
+@pytest.mark.asyncio
+async def test_api_stream_refuses_until_device_is_loaded():
+    device = FakeDevice(themes=SimpleNamespace(id={}))
+    device.is_loaded = False
+    api = ApiAmniotic(client=SimpleNamespace(device=device))
+
+    response = await api.endpoints.cls[Stream].run("sleep", SimpleNamespace(client=("127.0.0.1", 1234)))
+
+    assert response.status_code == 503
+    assert "Retry-After" in response.headers
+
+
+def test_api_stream_answers_head_probes_from_headers_alone(monkeypatch):
+    from fastapi.testclient import TestClient
+
+    theme_def = SimpleNamespace(name="Sleep", id="sleep")
+    device = FakeDevice(themes=SimpleNamespace(id={"sleep": theme_def}), admission=Admission(stream_limit=0, cpu_limit=None))
+    api = ApiAmniotic(client=SimpleNamespace(device=device))
+
+    def fail_theme_stream(**_kwargs):
+        raise AssertionError("No pipeline should be built for a probe.")
+
+    monkeypatch.setattr("amniotic.api.ThemeStream", fail_theme_stream)
+
+    response = TestClient(api.app).head("/stream/sleep")
+
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "audio/mpeg"
+    assert "content-length" not in response.headers
+    assert device.streams == [] and device.published == []
+
+
+def test_theme_stream_opens_nothing_for_clients_gone_before_reading(monkeypatch):
+    def fail_open(*_args, **_kwargs):
+        raise AssertionError("No encoder should be opened for a probe.")
+
+    monkeypatch.setattr("corio.av.open", fail_open)
+
+    theme_def = SimpleNamespace(name="Sleep", is_enabled=True, instances=[])
+    stream = ThemeStream(theme_def=theme_def, request=SimpleNamespace(client=("127.0.0.1", 1234)))
+    monkeypatch.setattr(stream, "_is_disconnected", lambda: True)
+
+    assert list(stream) == []
+    assert stream._is_closed and stream.iter_chunks_gen is None
+
+
+def test_theme_stream_keeps_one_recording_stream_per_path_even_with_shared_names(monkeypatch, theme_stream):
+    class FakeRecordingThemeStream(FakeRecordingStream):
+        CHUNK_SIZE = RecordingThemeStream.CHUNK_SIZE
+
+        def __init__(self, instance, **_kwargs):
+            super().__init__()
+            self.instance = instance
+
+    monkeypatch.setattr("amniotic.theme.RecordingThemeStream", FakeRecordingThemeStream)
+
+    instances = [
+        SimpleNamespace(name="rain", path=f"{category}/rain.flac", meta=SimpleNamespace(path=f"/audio/{category}/rain.flac"), is_enabled=True)
+        for category in ["forest", "city"]
+    ]
+    stream = theme_stream(theme_def=SimpleNamespace(name="Sleep", is_enabled=True, instances=instances))
+
+    first = list(stream.get_streams())
+    second = list(stream.get_streams())
+
+    assert [recording.instance for recording in first] == instances
+    assert second == first
+    assert len(stream.recording_streams) == 2
+
+
+@pytest.mark.asyncio
+async def test_release_stream_saves_offsets_off_the_event_loop_only_for_streams_that_played():
+    device = FakeDevice(themes=SimpleNamespace(id={}))
+    saved = []
+    device.save_offsets = lambda: saved.append(threading.current_thread())
+
+    request = SimpleNamespace(client=("10.0.0.5", 1234))
+    probe = SimpleNamespace(chunks_sent=0, close=lambda: None, request=request)
+    played = SimpleNamespace(chunks_sent=3, close=lambda: None, request=request)
+    await device.release_stream(probe)
+    await device.release_stream(played)
+
+    assert len(saved) == 1
+    assert saved[0] is not threading.main_thread()
+    # Only the stream that played counts towards the client's reconnect rate.
+    assert len(device.admission.connects["10.0.0.5"]) == 1
+
+
+def test_theme_saves_from_any_thread_never_interleave(tmp_path, monkeypatch):
+    path = Path(tmp_path / "themes.json")
+    monkeypatch.setattr(IndexThemes, "get_path_themes", classmethod(lambda cls: path))
+    themes = [IndexThemes([SimpleNamespace(model_dump=lambda size=size: dict(name="x" * size))]) for size in (10, 10_000)]
+
+    threads = [threading.Thread(target=theme.save) for theme in themes * 20]
+    for thread in threads:
+        thread.start()
+    themes[0].save()
+    for thread in threads:
+        thread.join()
+
+    assert path.read_json() in ([dict(name="x" * 10)], [dict(name="x" * 10_000)])
+    assert [file.name for file in Path(tmp_path).iterdir()] == ["themes.json"]
@@ -0,0 +1,43 @@
+from amniotic.tests.conftest import FakeRecordingStream
+from amniotic.writer import PacketWriter
+
+
+def test_packet_writer_flushes_by_size_or_interval(clock):
+    writer = PacketWriter(size=1_000, interval=0.1, clock=clock)
+
+    assert writer.poll() is None
+    assert writer.write(b"a" * 400) == 400
+    assert writer.write(b"b" * 400) == 400
+    assert writer.poll() is None
+
+    writer.write(b"c" * 400)
+    data = writer.poll()
+    assert isinstance(data, memoryview)
+    assert bytes(data) == b"a" * 400 + b"b" * 400 + b"c" * 400
+
+    # Flushed data is handed over, so later writes can't overwrite it.
+    writer.write(b"d" * 10)
+    assert bytes(data) == b"a" * 400 + b"b" * 400 + b"c" * 400
+    assert writer.poll() is None
+    clock.now = 0.1
+    assert bytes(writer.poll()) == b"d" * 10
+    assert (writer.writes, writer.flushes) == (4, 2)
+
+
+def test_theme_stream_coalesces_mp3_packets(monkeypatch, theme_stream):
+    monkeypatch.setattr("amniotic.theme.LOG_THRESHOLD", 10 ** 9)
+
+    stream = theme_stream(recordings=[FakeRecordingStream()])
+    stream.writer = PacketWriter(clock=lambda: stream.audio_time)
+
+    output = stream.__iter__()
+    writes = []
+    while stream.audio_time < 10:
+        writes.append(next(output))
+    output.close()
+
+    # Around 38 packets a second, at 128kbps, go out as around 4 writes.
+    assert all(isinstance(data, memoryview) for data in writes)
+    assert sum(data.nbytes for data in writes) == stream.bytes_sent
+    assert stream.writer.writes >= 9 * len(writes)
+    assert stream.get_status()["writes_sent"] == len(writes)
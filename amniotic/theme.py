@@ -1,16 +1,23 @@
 from __future__ import annotations
 
+import itertools
+import threading
 import time
 
 import anyio
-import numpy as np
 import typing
 from functools import cached_property
-from starlette.requests import Request
 
+from amniotic.channel import CROSSFADE, Crossfade
+from amniotic.limiter import Limiter
 from amniotic.obs import logger
+from amniotic.profiling import profiler
+from amniotic.quarantine import quarantine
+from amniotic.quality import QualityController, QualityLevel
 from amniotic.recording import LOG_THRESHOLD, RecordingThemeInstance, RecordingThemeStream
-from corio import av, dt
+from amniotic.sessions import SessionCache
+from amniotic.writer import PacketWriter
+from corio import dt
 from corio.constants import Constants
 from corio.iterator import IndexList
 from corio.strings import sanitize
@@ -18,17 +25,79 @@ from haco.base import Base
 from pydantic import Field
 
 if typing.TYPE_CHECKING:
+    from starlette.requests import Request
     from amniotic.device import Amniotic
     AmnioticRef = Amniotic
 else:
     AmnioticRef = object
 
+OUTPUT_CODEC = 'mp3'
+OUTPUT_RATE = 44_100
+OUTPUT_BITRATE = 128_000
+
+
+def get_block_size(frame_size: int, duration: int | None = None, rate: int = OUTPUT_RATE) -> int:
+    """
+
+    Samples per mixed block: a whole number of encoder frames, so the encoder never has to buffer a partial one. One
+    frame by default, for the lowest latency, or as many as best fit `duration` (in milliseconds), trading latency for
+    less per-block overhead. Codecs without a fixed frame size just take blocks of `duration`, or the default chunk size.
+
+    """
+    if not frame_size:
+        return round(duration / 1000 * rate) if duration else RecordingThemeStream.CHUNK_SIZE
+    frames = max(round(duration / 1000 * rate / frame_size), 1) if duration else 1
+    return frames * frame_size
+
 
 class IndexInstances(IndexList[RecordingThemeInstance]):
 
     def model_dump(self):
         return [item.model_dump() for item in self]
 
+class IndexRecordingStreams(IndexList[RecordingThemeStream]):
+    """
+
+    A stream's recording streams, with a lookup by recording path that's only rebuilt when the list changes, rather than
+    on every block. Paths, not names, as recordings in different categories can share a name.
+
+    """
+
+    def __init__(self, iterable=()):
+        super().__init__(iterable)
+        self.paths_map: dict[str, RecordingThemeStream] | None = None
+
+    @property
+    def paths(self) -> dict[str, RecordingThemeStream]:
+        if self.paths_map is None:
+            self.paths_map = {stream.instance.path: stream for stream in self}
+        return self.paths_map
+
+    def append(self, stream):
+        self.paths_map = None
+        super().append(stream)
+
+    def extend(self, streams):
+        self.paths_map = None
+        super().extend(streams)
+
+    def insert(self, index, stream):
+        self.paths_map = None
+        super().insert(index, stream)
+
+    def remove(self, stream):
+        self.paths_map = None
+        super().remove(stream)
+
+    def pop(self, index=-1):
+        self.paths_map = None
+        return super().pop(index)
+
+    def clear(self):
+        self.paths_map = None
+        super().clear()
+
+
 class ThemeDefinition(Base):
     """
 
@@ -119,59 +188,252 @@ class ThemeStream:
     ThemeStream: One instance per client/connection. Has a RecordingStream for each recording in the ThemeDefinition.
     When a user modifies a themeDefinition, like change recording volume, all live ThemeStreams are updated.
 
+    A stream can also be switched to another ThemeDefinition entirely, crossfading over `crossfade` milliseconds (see
+    `Channel`).
+
+    With `sessions`, a closed stream's recording streams are kept open for a while, and a stream of the same theme
+    for the same client picks them back up where they left off (see `SessionCache`).
+
+    Streams can be told to `stop`, e.g. when idle (see `Reaper`), and end at their next block.
+
     """
 
-    def __init__(self, theme_def: ThemeDefinition, request: Request):
+    def __init__(self, theme_def: ThemeDefinition, request: Request, block_duration: int | None = None, is_float: bool = False, quality: QualityController | None = None,
+                 crossfade: int = CROSSFADE, sessions: SessionCache | None = None):
         self.theme_def = theme_def
+        self.theme_next: ThemeDefinition | None = None
+        self.crossfade = crossfade
+        self.fade: Crossfade | None = None
         self.request = request
+        self.block_duration = block_duration
+        self.is_float = is_float
+        self.quality = quality
+        self.sessions = sessions
+        self.quality_level: QualityLevel | None = None
+        self.block_size = RecordingThemeStream.CHUNK_SIZE
+        self.writer = PacketWriter()
         self.started_at = dt.now()
         self.started_at_str = self.started_at.strftime(Constants.DATETIME_FILENAME_FORMAT)
-        self.recording_streams = IndexList[RecordingThemeStream]()
+        self.recording_streams = IndexRecordingStreams()
+        self.fading_streams = IndexRecordingStreams()
         self.iter_chunks_gen = None
         self.output = None
+        self.chunks_sent = 0
+        self.bytes_sent = 0
+        self.audio_time = 0.0
+        self.ahead = 0.0
+        self.heard_at = time.monotonic()
+        self.stop_reason: str | None = None
         self._is_closed = False
         logger.info(f'Initialized {repr(self)}')
 
     @cached_property
     def chunk_silence(self):
-        from amniotic.recording import RecordingThemeStream
-        data = np.zeros((1, RecordingThemeStream.CHUNK_SIZE), np.int16)
+        import numpy as np
+        data = np.zeros((1, self.block_size), np.float32 if self.is_float else np.int16)
         return data
 
+    @cached_property
+    def limiter(self) -> Limiter:
+        return Limiter(rate=OUTPUT_RATE)
+
+    @property
+    def sample_format(self) -> str:
+        """
+
+        Format mixed blocks are handed to the encoder in. On a float bus, that's the encoder's own, planar float (the
+        same layout as packed, in mono), so the encoder takes them as they are.
+
+        """
+        return 'fltp' if self.is_float else 's16'
+
     @property
     def is_enabled(self):
         return self.theme_def.is_enabled
 
     def get_streams(self):
-        names_map = self.recording_streams.name
+        paths = self.recording_streams.paths
         for instance in self.theme_def.instances:
             if not instance.is_enabled:
                 continue
-            stream = names_map.get(instance.name)
+            if quarantine.is_blocked(instance.meta.path):
+                continue
+            stream = paths.get(instance.path)
+            if stream and stream.is_failed:
+                # Its backoff is over, so give the recording another go, with a fresh stream.
+                self.recording_streams.remove(stream)
+                stream = None
             if not stream:
-                stream = RecordingThemeStream(instance=instance)
+                stream = RecordingThemeStream(instance=instance, chunk_size=self.block_size, is_float=self.is_float)
                 self.recording_streams.append(stream)
             yield stream
 
+    def switch(self, theme_def: ThemeDefinition):
+        """
+
+        Switch to another theme. Only requested here: the mixer picks it up at its next block, on its own thread.
+
+        """
+        logger.info(f'{repr(self)}: Switching to Theme "{theme_def.name}"...')
+        self.theme_next = theme_def
+
+    def start_crossfade(self):
+        """
+
+        Hand the current recording streams over to be faded out, and start afresh on the requested theme. Switching
+        again mid-fade just cuts the one already fading out.
 
+        """
+        theme_def, self.theme_next = self.theme_next, None
+        if theme_def is self.theme_def:
+            return
+        self.close_fading()
+        self.fading_streams, self.recording_streams = self.recording_streams, IndexRecordingStreams()
+        self.theme_def = theme_def
+        self.fade = Crossfade(size=round(self.crossfade / 1000 * OUTPUT_RATE))
+        logger.info(f'{repr(self)}: Crossfading over {self.crossfade}ms...')
 
+    def close_fading(self):
+        self.fade = None
+        for stream in list(self.fading_streams):
+            try:
+                stream.close()
+            except Exception:
+                logger.exception(f'{repr(self)}: Error closing recording stream {repr(stream)}.')
+        self.fading_streams.clear()
 
     def iter_chunks(self):
+        """
+
+        Mix one chunk from each enabled recording, reading their (read-only) chunks in place. Samples are widened into a
+        reused 32-bit buffer and summed into another, so they can't wrap, then clipped and narrowed into a reused 16-bit
+        output buffer. Nothing is allocated per chunk: left to themselves, a mixed-type `add` and `clip` each allocate a
+        chunk-sized temporary. Like recording chunks, each mixed chunk is only valid until the next one is requested.
+
+        On a float bus, recordings are already float32 and unclipped, so they're summed directly, and the `Limiter` is
+        the only thing keeping the mix within full scale. The result goes to the encoder as it is.
+
+        While switching themes, the outgoing theme's recordings are summed into a second buffer, and crossfaded with
+        the incoming ones before clipping.
+
+        """
+        import numpy as np
+
         logger.debug(f'{repr(self)}: Starting to iterate chunks...')
-        while True:
+        low, high = np.int32(np.iinfo(np.int16).min), np.int32(np.iinfo(np.int16).max)
+        mix = mix_old = widened = output = None
+
+        def add(buffer, data_recs):
+            buffer.fill(0)
+            for data in data_recs:
+                if self.is_float:
+                    np.add(buffer, data.reshape(-1), out=buffer)
+                else:
+                    np.copyto(widened, data.reshape(-1))
+                    np.add(buffer, widened, out=buffer)
+
+        for i in itertools.count():
+            if self.theme_next is not None:
+                self.start_crossfade()
+
             streams = list(self.get_streams())
             data_recs = [next(stream) for stream in streams]
+            data_old = [next(stream) for stream in self.fading_streams] if self.fade else []
+
+            sampled = profiler.is_sampled(i)
+            if sampled:
+                started = time.perf_counter_ns()
+
             if not data_recs:
                 data_recs.append(self.chunk_silence)
-            data = np.vstack(data_recs)
-            data = data.sum(axis=0, dtype=np.int32)
-            data = np.clip(data, np.iinfo(np.int16).min, np.iinfo(np.int16).max)
-            yield data.astype(np.int16).reshape(1, -1)
+            if mix is None or mix.size != data_recs[0].size:
+                if self.is_float:
+                    mix = np.empty(data_recs[0].size, dtype=np.float32)
+                    output = mix.reshape(1, -1)
+                else:
+                    mix = np.empty(data_recs[0].size, dtype=np.int32)
+                    widened = np.empty_like(mix)
+                    output = np.empty((1, mix.size), dtype=np.int16)
+                mix_old = np.empty_like(mix)
+
+            add(mix, data_recs)
+            if self.fade:
+                add(mix_old, data_old)
+                self.fade.process(mix, mix_old)
+                if self.fade.is_done:
+                    logger.info(f'{repr(self)}: Crossfade complete.')
+                    self.close_fading()
+
+            if self.is_float:
+                self.limiter.process(mix)
+            else:
+                np.maximum(mix, low, out=mix)
+                np.minimum(mix, high, out=mix)
+                np.copyto(output.reshape(-1), mix, casting='unsafe')
+
+            if sampled:
+                profiler.record('mix', started)
+
+            yield output
+
+    def stop(self, reason: str):
+        """
+
+        End the stream at its next block. Only requested here, as it's encoding on its own thread.
+
+        """
+        logger.info(f'{repr(self)}: Stopping: {reason}')
+        self.stop_reason = reason
+
+    def get_block_duration(self) -> int | None:
+        """
+
+        The configured block duration, or a larger one if quality has been degraded (see `QualityController`).
+
+        """
+        durations = [duration for duration in [self.block_duration, self.quality_level and self.quality_level.block_duration] if duration]
+        return max(durations, default=None)
+
+    def open_encoder(self):
+        """
+
+        Open an encoder at the current quality level. Called again whenever the level changes, after flushing the last
+        one. MP3 frames are self-contained, so the two just follow one another in the stream.
+
+        """
+        from corio import av
+
+        self.quality_level = self.quality.level if self.quality else None
+        self.output = av.open(file=f'.{OUTPUT_CODEC}', mode="w")
+        out_stream = self.output.add_stream(codec_name=OUTPUT_CODEC, rate=OUTPUT_RATE, bit_rate=OUTPUT_BITRATE)
+        if self.is_float:
+            out_stream.codec_context.format = self.sample_format
+        if self.quality_level and self.quality_level.compression_level is not None:
+            out_stream.codec_context.options = dict(compression_level=str(self.quality_level.compression_level))
+        out_stream.codec_context.open()
+        return out_stream
 
     def __iter__(self):
-        self.output = av.open(file='.mp3', mode="w")
-        bitrate = 128_000
-        out_stream = self.output.add_stream(codec_name='mp3', rate=44100, bit_rate=bitrate)
+        """
+
+        Encode mixed blocks, pacing them to real-time. Nothing is opened until iteration starts, i.e. after the
+        response headers have gone out, and not at all if the client has already hung up by then, as players probing
+        a URL with a short GET often do.
+
+        """
+        import numpy as np
+        from corio import av
+
+        if self._is_disconnected():
+            logger.info(f'{repr(self)}: Client disconnected before reading any audio. Not starting stream.')
+            self.close()
+            return
+
+        out_stream = self.open_encoder()
+        self.block_size = get_block_size(out_stream.codec_context.frame_size, self.get_block_duration())
+        logger.info(f'{repr(self)}: Mixing blocks of {self.block_size} samples ({1000 * self.block_size / OUTPUT_RATE:.0f}ms).')
+        if self.sessions is not None:
+            self.recording_streams.extend(self.sessions.take(self))
         self.iter_chunks_gen = self.iter_chunks()
 
         start_time = time.time()
@@ -185,27 +447,54 @@ class ThemeStream:
                     if self._is_disconnected():
                         logger.info(f'{repr(self)}: Client disconnected. Stopping stream.')
                         return
+                    if self.stop_reason:
+                        return
+
+                    if self.quality and self.quality.level is not self.quality_level:
+                        logger.info(f'{repr(self)}: Switching encoder to quality "{self.quality.level.name}"...')
+                        for packet in out_stream.encode(None):
+                            self.writer.write(packet)
+                        self.output.close()
+                        out_stream = self.open_encoder()
+
+                    sampled = profiler.is_sampled(i)
+                    if sampled:
+                        started = time.perf_counter_ns()
 
-                    vol_rms = round(float(np.sqrt((data.astype(np.float32) ** 2).mean())), 2)
-                    frame = av.AudioFrame.from_ndarray(data, format='s16', layout='mono')
-                    frame.rate = 44100
+                    frame = av.AudioFrame.from_ndarray(data, format=self.sample_format, layout='mono')
+                    frame.rate = OUTPUT_RATE
 
                     frame_duration = frame.samples / frame.rate
                     audio_time += frame_duration
 
+                    packets = out_stream.encode(frame)
+
+                    if sampled:
+                        profiler.record('encode', started)
+
+                    if data.any():
+                        self.heard_at = time.monotonic()
+
                     size = 0
-                    for packet in out_stream.encode(frame):
-                        packet_bytes = bytes(packet)
-                        size += len(packet_bytes)
-                        yield packet_bytes
+                    for packet in packets:
+                        size += self.writer.write(packet)
+                    if data_out := self.writer.poll():
+                        self.bytes_sent += data_out.nbytes
+                        yield data_out
 
                     # Only sleep if we are ahead of real-time
                     now = time.time()
                     ahead = audio_time - (now - start_time)
+
+                    self.chunks_sent += 1
+                    self.audio_time = audio_time
+                    self.ahead = ahead
+
                     if ahead > 0:
                         time.sleep(ahead)
 
                     if i % LOG_THRESHOLD == 0:
+                        vol_rms = round(float(np.sqrt((data.astype(np.float32) ** 2).mean())), 2)
                         logger.info(f'{repr(self)}: Yielding chunk #{i} {vol_rms=} bytes={size}. Real-time delay {ahead:.5f}.')
 
         except Exception:
@@ -241,6 +530,14 @@ class ThemeStream:
         else:
             logger.debug(f'{repr(self)}: No chunk mixer iterator to close.')
 
+        self.close_fading()
+
+        if self.sessions is not None and not self.stop_reason:
+            try:
+                self.sessions.keep(self)
+            except Exception:
+                logger.exception(f'{repr(self)}: Error keeping recording streams for resumption.')
+
         logger.debug(f'{repr(self)}: Closing {len(self.recording_streams)} recording stream(s)...')
         for stream in list(self.recording_streams):
             try:
@@ -262,10 +559,42 @@ class ThemeStream:
 
         logger.info(f'{repr(self)}: Transcoder closed.')
 
+    @property
+    def client(self) -> str | None:
+        client = self.request.client
+        if not client:
+            return None
+        host, port = client
+        return f'{host}:{port}'
+
+    def get_status(self) -> dict:
+        """
+
+        Snapshot of this stream's state, for debugging live streams. Lag is how far ahead of real-time the encoder is, in seconds (negative means it's falling behind).
+
+        """
+        return dict(
+            theme=self.theme_def.name,
+            client=self.client,
+            started_at=self.started_at.isoformat(),
+            chunks_sent=self.chunks_sent,
+            bytes_sent=self.bytes_sent,
+            writes_sent=self.writer.flushes,
+            quality=self.quality_level and self.quality_level.name,
+            audio_seconds=round(self.audio_time, 3),
+            lag=round(self.ahead, 5),
+            is_closed=self._is_closed,
+            is_crossfading=bool(self.fade),
+            silent_seconds=round(time.monotonic() - self.heard_at, 1),
+            stop_reason=self.stop_reason,
+            recordings=[stream.get_status() for stream in list(self.recording_streams)],
+        )
+
     def __repr__(self):
         return f'{self.__class__.__name__}(name={repr(self.theme_def.name)}, request={repr(self.request.client)}, started_at={self.started_at_str!r})'
 
 class IndexThemes(IndexList[ThemeDefinition]):
+    saving = threading.Lock()
 
     @classmethod
     def get_path_themes(cls):
@@ -299,7 +628,16 @@ class IndexThemes(IndexList[ThemeDefinition]):
         return self
 
     def save(self):
+        """
+
+        Save under a lock, shared by every caller, on the event loop or off it. Writes go to a temporary file, which then
+        replaces the themes file, so an interrupted save can't leave it truncated or half-written.
+
+        """
         path = self.get_path_themes()
-        with logger.span(f'Saving {len(self)} themes to "{path}"'):
+        path_temp = path.with_name(f'{path.name}.tmp')
+        with self.saving, logger.span(f'Saving {len(self)} themes to "{path}"'):
             data = [theme.model_dump() for theme in self]
-            return path.write_json(data)
+            size = path_temp.write_json(data)
+            path_temp.replace(path)
+            return size
@@ -0,0 +1,62 @@
+import asyncio
+import math
+from typing import Awaitable, Callable
+
+from amniotic.obs import logger
+
+THROTTLE_INTERVAL = 0.05
+
+
+class Throttle:
+    """
+
+    Last-value-wins throttle for bursts of commands on the same entity (e.g. dragging a slider).
+
+    The first command after a quiet period is applied straight away. Commands arriving within `interval` seconds of the
+    last one applied are coalesced: only the latest is kept, and it's applied once the interval has elapsed. So the
+    final value always lands, but nothing is applied more than once per interval.
+
+    """
+
+    def __init__(self, interval: float = THROTTLE_INTERVAL):
+        self.interval = interval
+        self.applied_at = -math.inf
+        self.pending: Callable[[], Awaitable] | None = None
+        self.task: asyncio.Task | None = None
+
+    @property
+    def is_pending(self) -> bool:
+        return self.pending is not None
+
+    async def submit(self, apply: Callable[[], Awaitable], apply_deferred: Callable[[], Awaitable] | None = None) -> bool:
+        """
+
+        Apply now if allowed, otherwise queue. If queued, `apply_deferred` (default `apply`) is what eventually runs. Returns whether the value was applied immediately.
+
+        """
+        loop = asyncio.get_running_loop()
+        wait = self.applied_at + self.interval - loop.time()
+
+        if wait <= 0 and not self.task:
+            self.applied_at = loop.time()
+            await apply()
+            return True
+
+        self.pending = apply_deferred or apply
+        if not self.task:
+            self.task = asyncio.create_task(self.apply_later(wait))
+        return False
+
+    async def apply_later(self, wait: float):
+        try:
+            while self.pending:
+                await asyncio.sleep(max(wait, 0))
+                apply, self.pending = self.pending, None
+                self.applied_at = asyncio.get_running_loop().time()
+                try:
+                    await apply()
+                except Exception:
+                    logger.exception('Error applying throttled command.')
+                wait = self.interval
+        finally:
+            self.task = None
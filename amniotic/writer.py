@@ -0,0 +1,64 @@
+import time
+
+FLUSH_SIZE = 4_096
+FLUSH_INTERVAL = 0.25
+
+
+class PacketWriter:
+    """
+
+    Coalesces encoded packets into larger writes for the HTTP response. An MP3 packet is only a few hundred bytes, and
+    each one yielded separately costs a hop from the encoding thread to the event loop, an ASGI `send` and a socket
+    write. Packets are copied once, straight from PyAV's packet buffer into a bytearray, and flushed once `size` bytes
+    have built up or `interval` seconds have passed since the first buffered packet, whichever comes first.
+
+    Flushing hands the bytearray over, as a memoryview, and starts a new one. It's never written to again, so the
+    server can hold on to it for as long as it likes without it being overwritten.
+
+    """
+
+    def __init__(self, size: int = FLUSH_SIZE, interval: float = FLUSH_INTERVAL, clock=time.monotonic):
+        self.size = size
+        self.interval = interval
+        self.clock = clock
+        self.buffer = bytearray()
+        self.buffered_at = None
+        self.writes = 0
+        self.flushes = 0
+
+    def write(self, packet) -> int:
+        data = memoryview(packet)
+        if not self.buffer:
+            self.buffered_at = self.clock()
+        self.buffer += data
+        self.writes += 1
+        return data.nbytes
+
+    @property
+    def is_due(self) -> bool:
+        if not self.buffer:
+            return False
+        return len(self.buffer) >= self.size or self.clock() - self.buffered_at >= self.interval
+
+    def flush(self) -> memoryview | None:
+        """
+
+        Everything buffered, if there's anything.
+
+        """
+        if not self.buffer:
+            return None
+        data, self.buffer = self.buffer, bytearray()
+        self.buffered_at = None
+        self.flushes += 1
+        return memoryview(data)
+
+    def poll(self) -> memoryview | None:
+        """
+
+        Everything buffered, but only once a flush is due.
+
+        """
+        if not self.is_due:
+            return None
+        return self.flush()
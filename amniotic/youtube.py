@@ -0,0 +1,45 @@
+from typing import Iterator
+
+from corio import Path
+from corio import youtube
+from corio.youtube import AudioStreamData, AudioStreamDownloadError, Video
+
+
+class AudioStreamDownloader(youtube.AudioStreamDownloader):
+    """
+
+    Corio's downloader, but synchronous, as pytubefix blocks on network I/O, so it can run in a worker thread rather
+    than on the event loop. It also stages to a directory given by the caller, instead of the shared temp directory,
+    where concurrent downloads of same-titled videos would overwrite each other.
+
+    """
+
+    def iter_download(self, staging: Path) -> Iterator[AudioStreamData]:
+        """
+
+        Download the audio stream into `staging`, and yield chunks and progress information. Blocking.
+
+        """
+        yield AudioStreamData(message='Fetching video metadata...')
+        video = Video(self.url)
+
+        yield AudioStreamData('Finding audio streams...')
+
+        audio_streams = video.streams.filter(only_audio=True).order_by('bitrate')
+        if not audio_streams:
+            raise AudioStreamDownloadError(f'Error downloading: no audio streams found in "{video.title}"')
+
+        stream = audio_streams.last()
+        yield AudioStreamData(f'Found highest-bitrate audio stream: {stream.audio_codec}/{stream.subtype}@{stream.abr}')
+
+        if stream.filesize == 0:
+            raise AudioStreamDownloadError(f'Error downloading: empty audio stream found in "{video.title}"')
+
+        self.path = staging / stream.default_filename
+
+        yield AudioStreamData('Downloading...')
+
+        with self.path.open('wb') as out_file:
+            for data in self.iter_data(stream):
+                out_file.write(data.chunk)
+                yield data
@@ -0,0 +1,60 @@
+"""
+
+Benchmark: CPU time to mix three recordings and encode each second of audio, per block size, against the latency each
+block adds. See `amniotic.theme.get_block_size`.
+
+    python scripts/benchmark_block_size.py
+
+"""
+import time
+
+import av
+import numpy as np
+
+from amniotic.theme import OUTPUT_BITRATE, OUTPUT_CODEC, OUTPUT_RATE, get_block_size
+
+SECONDS = 5
+DURATIONS = [None, 50, 100, 200]
+
+
+def get_encoder():
+    output = av.open(f".{OUTPUT_CODEC}", mode="w")
+    stream = output.add_stream(codec_name=OUTPUT_CODEC, rate=OUTPUT_RATE, bit_rate=OUTPUT_BITRATE)
+    stream.codec_context.open()
+    return output, stream
+
+
+def measure(duration: int | None) -> tuple[int, float]:
+    output, stream = get_encoder()
+    block_size = get_block_size(stream.codec_context.frame_size, duration)
+    recordings = [np.full((1, block_size), 1_000, np.int16) for _ in range(3)]
+    mix = np.empty(block_size, np.int32)
+    widened = np.empty_like(mix)
+    data = np.empty((1, block_size), np.int16)
+
+    blocks = SECONDS * OUTPUT_RATE // block_size
+    started = time.perf_counter()
+    for _ in range(blocks):
+        mix.fill(0)
+        for recording in recordings:
+            np.copyto(widened, recording.reshape(-1))
+            np.add(mix, widened, out=mix)
+        np.copyto(data.reshape(-1), mix, casting="unsafe")
+        frame = av.AudioFrame.from_ndarray(data, format="s16", layout="mono")
+        frame.rate = OUTPUT_RATE
+        stream.encode(frame)
+    cost = (time.perf_counter() - started) / (blocks * block_size / OUTPUT_RATE)
+    output.close()
+    return block_size, cost
+
+
+def main():
+    print("duration  block  latency  blocks/s  CPU per audio second")
+    for duration in DURATIONS:
+        block_size, cost = measure(duration)
+        latency = 1000 * block_size / OUTPUT_RATE
+        print(f"{str(duration or '-'):>8}  {block_size:>5}  {latency:>5.0f}ms  {OUTPUT_RATE / block_size:>8.1f}  {cost * 1000:>6.2f}ms ({cost:.2%})")
+
+
+if __name__ == "__main__":
+    main()